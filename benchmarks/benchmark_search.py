@@ -0,0 +1,64 @@
+import argparse
+import time
+
+from datasets import create_benchmark_app, generate_dataset
+from grants.helpers.utils import QueryBuilder
+from grants.helpers.stats import HouseholdStatsMaintainer
+
+SEARCHES = {
+    'household types': {'set_household_types': ['HDB']},
+    'family member name': {'set_family_member_names': ['Wei Ming Tan']},
+    'adults': {'set_limits_num_adults': [1, 0]},
+    'babies': {'set_limits_num_babies': [1, 0]},
+    'income': {'set_total_annual_income_limits': [0, 150000]},
+    'elders + children + income': {
+        'set_limits_num_elders': [1, 0], 'set_limits_num_children': [1, 0], 'set_total_annual_income_limits': [0, 150000]
+    },
+    'six filters': {
+        'set_limits_num_family_members': [2, 6], 'set_limits_num_adults': [1, 0], 'set_limits_num_elders': [1, 0],
+        'set_limits_num_children': [1, 0], 'set_limits_num_teenage_students': [0, 3], 'set_total_annual_income_limits': [0, 150000]
+    },
+}
+
+
+def build_query_builder(params):
+    query_builder = QueryBuilder()
+    for setter, value in params.items():
+        getattr(query_builder, setter)(value)
+    return query_builder
+
+
+def time_query(query_function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        household_ids = [household.id for household in query_function()]
+        timings.append(time.perf_counter() - start)
+    return min(timings), sorted(household_ids)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the search query engines against the legacy chained subquery query')
+    parser.add_argument('--people', type=int, nargs='+', default=[10000, 50000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    for num_people in args.people:
+        app = create_benchmark_app()
+        with app.app_context():
+            num_households, _ = generate_dataset(num_people)
+            HouseholdStatsMaintainer.rollover()
+            print(f'\n{num_people} people, {num_households} households')
+            print(f'{"search":<28}{"legacy (s)":>12}{"single pass (s)":>17}{"stats table (s)":>17}')
+
+            for name, params in SEARCHES.items():
+                query_builder = build_query_builder(params)
+                legacy_time, legacy_ids = time_query(query_builder.generate_legacy_query, args.repeat)
+                aggregate_time, aggregate_ids = time_query(query_builder.generate_aggregate_query, args.repeat)
+                stats_time, stats_ids = time_query(query_builder.generate_query, args.repeat)
+                assert legacy_ids == aggregate_ids == stats_ids, f'Results differ for {name}'
+                print(f'{name:<28}{legacy_time:>12.3f}{aggregate_time:>17.3f}{stats_time:>17.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+import argparse
+import json
+import time
+
+from datasets import create_benchmark_app, generate_dataset
+from grants import db
+from grants.models import Household
+from grants.helpers.utils import QueryBuilder
+from grants.helpers.serializers import SEARCH_SERIALIZER, orjson
+
+
+def serialize_to_json(households, family_members):
+    return json.dumps([
+        household.to_json(excludes=['ID'], family_excludes=['ID', 'Spouse'], family_members=family_members[household.id]) for household in households
+    ], sort_keys=True, separators=(',', ':'))
+
+
+def serialize_projection(households, family_members):
+    return json.dumps([SEARCH_SERIALIZER.household(household, family_members[household.id]) for household in households],
+                      sort_keys=True, separators=(',', ':'))
+
+
+def serialize_projection_orjson(households, family_members):
+    return orjson.dumps([SEARCH_SERIALIZER.household(household, family_members[household.id]) for household in households],
+                        option=orjson.OPT_SORT_KEYS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare Household.to_json with the serializer projections and the orjson backend')
+    parser.add_argument('--people', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    app = create_benchmark_app()
+    with app.app_context():
+        num_households, _ = generate_dataset(args.people)
+        households = Household.query.order_by(Household.id).all()
+        family_members = QueryBuilder.load_family_members(households)
+        print(f'{args.people} people, {num_households} households')
+
+        expected = json.loads(serialize_to_json(households, family_members))
+        serializers = [('to_json + json', serialize_to_json), ('projection + json', serialize_projection)]
+        if orjson is not None:
+            serializers.append(('projection + orjson', serialize_projection_orjson))
+
+        for name, serialize in serializers:
+            assert json.loads(serialize(households, family_members)) == expected, f'Output differs for {name}'
+            timings = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                serialize(households, family_members)
+                timings.append(time.perf_counter() - start)
+            print(f'{name:<24}{min(timings):>10.3f}s')
+
+        # Loading is excluded from the timings above
+        timings = []
+        for _ in range(args.repeat):
+            db.session.expunge_all()
+            start = time.perf_counter()
+            loaded_households = Household.query.order_by(Household.id).all()
+            QueryBuilder.load_family_members(loaded_households)
+            timings.append(time.perf_counter() - start)
+        print(f'{"(ORM query + load)":<24}{min(timings):>10.3f}s')
+
+        # SQL assembly also replaces the loading of households and members, so it is timed from the query
+        query = SEARCH_SERIALIZER.documents_query(Household.query.order_by(Household.id))
+        assert json.loads('[' + ','.join(row.document for row in query) + ']') == expected, 'Output differs for sql assembly'
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            '[' + ','.join(row.document for row in query) + ']'
+            timings.append(time.perf_counter() - start)
+        print(f'{"sql assembly (+ query)":<24}{min(timings):>10.3f}s')
+
+
+if __name__ == '__main__':
+    main()
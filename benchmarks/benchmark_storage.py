@@ -0,0 +1,84 @@
+import argparse
+import os
+import tempfile
+import time
+from multiprocessing import Pool
+from random import Random
+
+from datasets import create_benchmark_app, generate_dataset
+from grants import db
+from grants.helpers.storage import StorageProfiles
+
+SEARCH_DATA = {'HouseholdTypes': ['HDB'], 'NumAdultsLimits': [1, 0], 'TotalAnnualIncomeLimits': [0, 150000]}
+NEW_MEMBER_DATA = {
+    'Name': 'Benchmark Person', 'Gender': 'F', 'MaritalStatus': 'Single', 'OccupationType': 'Employed', 'AnnualIncome': 30000,
+    'DOB': '1990-01-01'
+}
+
+
+def run_worker(args):
+    # Runs in its own process like a gunicorn worker: readers search, writers register a household and add a member to another
+    path, profile, role, duration, num_households = args
+    random = Random(os.getpid())
+    app = create_benchmark_app(path, {'STORAGE_PROFILE': profile})
+    client = app.test_client()
+
+    requests = errors = 0
+    latencies = []
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        if role == 'reader':
+            response = client.post('/household/search', query_string={'limit': 50}, data=SEARCH_DATA)
+            ok = response.status_code == 200
+        else:
+            ok = client.post('/household/new', data={'Housing Type': 'HDB'}).status_code == 200
+            household_id = random.randint(1, num_households)
+            ok = client.post(f'/household/{household_id}/family/new', data=NEW_MEMBER_DATA).status_code == 200 and ok
+        latencies.append(time.perf_counter() - start)
+        requests += 1
+        errors += not ok
+    return role, requests, errors, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare concurrent read and write throughput of the storage profiles')
+    parser.add_argument('--people', type=int, default=10000)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--profiles', nargs='+', default=list(StorageProfiles.PROFILES))
+    args = parser.parse_args()
+
+    print(f'{args.people} people, {args.readers} readers, {args.writers} writers, {args.duration}s per profile')
+    print(f'{"profile":<14}{"reads/s":>10}{"writes/s":>10}{"p95 read (ms)":>15}{"p95 write (ms)":>16}{"errors":>8}')
+
+    for profile in args.profiles:
+        path = os.path.join(tempfile.mkdtemp(prefix='grants-benchmark-'), 'benchmark.sqlite')
+        app = create_benchmark_app(path, {'STORAGE_PROFILE': profile})
+        with app.app_context():
+            num_households, _ = generate_dataset(args.people)
+            db.session.remove()
+            db.engine.dispose()
+
+        workers = [(path, profile, 'reader', args.duration, num_households)] * args.readers + \
+            [(path, profile, 'writer', args.duration, num_households)] * args.writers
+        with Pool(len(workers)) as pool:
+            results = pool.map(run_worker, workers)
+
+        totals = {'reader': [0, []], 'writer': [0, []]}
+        num_errors = 0
+        for role, requests, errors, latencies in results:
+            totals[role][0] += requests
+            totals[role][1].extend(latencies)
+            num_errors += errors
+
+        def p95(latencies):
+            return sorted(latencies)[int(len(latencies) * 0.95)] * 1000 if latencies else 0.0
+
+        print(f'{profile:<14}{totals["reader"][0] / args.duration:>10.1f}{totals["writer"][0] / args.duration:>10.1f}'
+              f'{p95(totals["reader"][1]):>15.1f}{p95(totals["writer"][1]):>16.1f}{num_errors:>8}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import sys
+import time
+
+from flask import url_for
+from datasets import create_benchmark_app, generate_dataset
+from grants import db
+from grants.helpers.utils import QueryBuilder
+
+# Each QueryBuilder setter, with the value it is timed with
+SETTER_CASES = {
+    'set_household_types': ['HDB'],
+    'set_family_member_names': ['Wei Ming Tan'],
+    'set_limits_num_family_members': [2, 4],
+    'set_limits_num_babies': [1, 0],
+    'set_limits_num_children': [1, 0],
+    'set_limits_num_adults': [1, 0],
+    'set_limits_num_elders': [1, 0],
+    'set_limits_num_teenage_students': [1, 0],
+    'set_total_annual_income_limits': [0, 150000],
+}
+
+# name => (endpoint, url values, form data, json body), for each route of the households blueprint
+# Note: Lists are paged, so that their timings measure the query rather than the size of the whole dataset. Writes are timed last
+READ_ROUTE_CASES = {
+    'all households (page)': ('households.all_households', {'limit': 100}, None, None),
+    'all households (ndjson page)': ('households.all_households', {'limit': 1000, 'format': 'ndjson'}, None, None),
+    'search (household types)': ('households.search_households', {'limit': 100}, {'HouseholdTypes': ['HDB']}, None),
+    'search (six filters)': ('households.search_households', {'limit': 100}, {
+        'FamilyMembersLimits': [2, 6], 'NumAdultsLimits': [1, 0], 'NumEldersLimits': [1, 0], 'NumChildrenLimits': [1, 0],
+        'NumTeenageStudentsLimits': [0, 3], 'TotalAnnualIncomeLimits': [0, 150000]
+    }, None),
+    'search grants (filters)': ('households.search_households_grants', {'limit': 100}, {'NumEldersLimits': [1, 0]}, None),
+    'search grants (Elder Bonus)': ('households.search_households_grants', {'limit': 100}, {'GrantType': 'Elder Bonus'}, None),
+    'search all grants (page)': ('households.search_households_all_grants', {'limit': 100}, None, None),
+    'export (Elder Bonus csv)': ('households.export_disbursements', {'GrantType': 'Elder Bonus', 'format': 'csv'}, None, None),
+    'statement cache': ('households.search_statement_cache', {}, None, None),
+}
+WRITE_ROUTE_CASES = {
+    'create household': ('households.create_household', {}, {'Housing Type': 'HDB'}, None),
+    'add family member': ('households.add_person_to_household', {'household_id': 1}, {
+        'Name': 'Benchmark', 'Gender': 'F', 'MaritalStatus': 'Single', 'OccupationType': 'Employed', 'AnnualIncome': 1000, 'DOB': '1990-01-01'
+    }, None),
+    'bulk add family members': ('households.bulk_add_people_to_household', {'household_id': 2}, None, {'Family Members': [
+        {'Name': 'Benchmark', 'Gender': 'M', 'MaritalStatus': 'Single', 'OccupationType': 'Student', 'AnnualIncome': 0, 'DOB': '2012-01-01'}
+    ] * 10}),
+    'bulk create households': ('households.bulk_create_households', {}, None, {'Households': [
+        {'Housing Type': 'Landed', 'Family Members': [
+            {'Name': 'Benchmark', 'Gender': 'F', 'MaritalStatus': 'Single', 'OccupationType': 'Unemployed', 'AnnualIncome': 0, 'DOB': '1950-01-01'}
+        ] * 3}
+    ] * 100}),
+}
+
+
+def time_call(function, repeat):
+    # Median of repeat runs, after a warm up run that fills the statement cache
+    function()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def route_case(app, client, endpoint, values, form, body):
+    with app.test_request_context():
+        url = url_for(endpoint, **values)
+
+    def request():
+        if form is None and body is None:
+            response = client.get(url)
+        else:
+            response = client.post(url, data=form, json=body)
+        # Note: Reads the whole body, so that streamed responses are timed until their last chunk
+        response.get_data()
+        assert response.status_code == 200, f'{endpoint} responded {response.status_code}'
+    return request
+
+
+def check_coverage(app):
+    # Fails when a route, setter or grant was added without a benchmark case
+    routes = {rule.endpoint for rule in app.url_map.iter_rules() if rule.endpoint.startswith('households.')}
+    missing = routes - {case[0] for case in {**READ_ROUTE_CASES, **WRITE_ROUTE_CASES}.values()}
+    missing |= {name for name in dir(QueryBuilder) if name.startswith('set_')} - set(SETTER_CASES)
+    assert not missing, f'No benchmark case for {sorted(missing)}'
+
+
+def run_suite(app, repeat):
+    results = {}
+    with app.app_context():
+        for setter, value in SETTER_CASES.items():
+            query_builder = QueryBuilder.from_params({setter: value})
+            results[f'setter {setter}'] = time_call(lambda: query_builder.generate_query().all(), repeat)
+            db.session.remove()
+
+        for grant in sorted(QueryBuilder.valid_grant_types()):
+            results[f'grant {grant}'] = time_call(lambda: QueryBuilder.process_grants(grant).all(), repeat)
+            db.session.remove()
+
+        client = app.test_client()
+        for name, case in {**READ_ROUTE_CASES, **WRITE_ROUTE_CASES}.items():
+            results[f'route {name}'] = time_call(route_case(app, client, *case), repeat)
+    return results
+
+
+def compare(results, baseline, threshold, min_delta):
+    # Returns (size, case, baseline seconds, seconds) of each case slower than its baseline by more than threshold (and min_delta seconds)
+    regressions = []
+    for size, timings in results.items():
+        for case, seconds in timings.items():
+            baseline_seconds = baseline.get(size, {}).get(case)
+            if baseline_seconds is not None and seconds > baseline_seconds * (1 + threshold) and seconds - baseline_seconds > min_delta:
+                regressions.append((size, case, baseline_seconds, seconds))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time every households route, QueryBuilder setter and grant, and compare against a baseline')
+    parser.add_argument('--people', type=int, nargs='+', default=[10000, 100000], help='Dataset sizes, e.g. 10000 100000 1000000')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--baseline', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json'))
+    parser.add_argument('--output', help='Writes the results to this file')
+    parser.add_argument('--update-baseline', action='store_true', help='Writes the results to the baseline instead of comparing against it')
+    parser.add_argument('--threshold', type=float, default=0.25, help='Fraction a case may slow down by before it is reported')
+    parser.add_argument('--min-delta', type=float, default=0.005, help='Seconds a case may slow down by regardless of threshold')
+    args = parser.parse_args()
+
+    results = {}
+    for num_people in args.people:
+        app = create_benchmark_app()
+        check_coverage(app)
+        with app.app_context():
+            num_households, _ = generate_dataset(num_people)
+        print(f'\n{num_people} people, {num_households} households')
+
+        results[str(num_people)] = run_suite(app, args.repeat)
+        for case, seconds in results[str(num_people)].items():
+            print(f'{case:<56}{seconds * 1000:>12.2f} ms')
+
+    report = {
+        'repeat': args.repeat,
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2, sort_keys=True)
+
+    if args.update_baseline:
+        baseline = {'results': {}}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as file:
+                baseline = json.load(file)
+        # Note: Sizes that were not run keep their previous baseline
+        report['results'] = {**baseline['results'], **results}
+        with open(args.baseline, 'w') as file:
+            json.dump(report, file, indent=2, sort_keys=True)
+        print(f'\nUpdated {args.baseline}')
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f'\nNo baseline at {args.baseline}. Run with --update-baseline to record one')
+        return
+
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    regressions = compare(results, baseline['results'], args.threshold, args.min_delta)
+    print(f'\n{len(regressions)} regressions beyond {args.threshold:.0%} of the baseline')
+    for size, case, baseline_seconds, seconds in regressions:
+        print(f'{size:>8} {case:<56}{baseline_seconds * 1000:>10.2f} ms -> {seconds * 1000:.2f} ms')
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,18 @@
+import os
+import tempfile
+
+from grants import create_app
+from grants.helpers.seed import DatasetSeeder
+
+
+def create_benchmark_app(path=None, config=None):
+    if path is None:
+        path = os.path.join(tempfile.mkdtemp(prefix='grants-benchmark-'), 'benchmark.sqlite')
+    app_config = {'SQLALCHEMY_DATABASE_URI': f'sqlite:///{path}', 'SQLALCHEMY_TRACK_MODIFICATIONS': False}
+    app_config.update(config or {})
+    return create_app(config=app_config)
+
+
+def generate_dataset(num_people, seed=0):
+    # Writes roughly num_people people with a fixed seed, so that runs are comparable. Returns the number of households and people
+    return DatasetSeeder(seed).seed(num_people)
@@ -1,23 +1,113 @@
+import os
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 
 db = SQLAlchemy()
 
 
-def create_app(test=False):
+def create_app(test=False, config=None):
     app = Flask(__name__)
 
-    db.init_app(app)
-
     if test:
         app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///test.site.sqlite'
     else:
         app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///site.sqlite'
 
+    # Number of households fetched per query when streaming NDJSON responses
+    app.config['STREAM_CHUNK_SIZE'] = 1000
+
+    # Encoder of JSON responses: 'json', 'orjson' (requires the orjson package) or 'auto' (orjson if installed)
+    app.config['JSON_BACKEND'] = 'json'
+
+    # Where the JSON of listed households is built: 'python' (serializers) or 'sql' (by SQLite with json_object / json_group_array)
+    app.config['JSON_ASSEMBLY'] = 'python'
+
+    # Engine answering /household/search and /household/search/grants: 'sql' (SQLite queries) or 'columnar' (NumPy arrays held in
+    # memory by each worker, see grants.helpers.columnar)
+    app.config['SEARCH_ENGINE'] = 'sql'
+
+    # Named SQLite settings from grants.helpers.storage. 'concurrent' is recommended when running several gunicorn workers
+    app.config['STORAGE_PROFILE'] = 'default'
+
+    # Per request statement counts and timings, reported in Server-Timing headers and logged by grants.instrumentation
+    app.config['SQL_INSTRUMENTATION'] = False
+
+    # Statements slower than SLOW_QUERY_SECONDS (None to disable) are logged with their query plan to a file of up to
+    # SLOW_QUERY_LOG_MAX_BYTES, rotated with SLOW_QUERY_LOG_BACKUPS previous files kept. '{pid}' in the path is replaced by the ID of
+    # the worker process, which must each write to their own file (default: <instance path>/slow_queries.{pid}.log)
+    app.config['SLOW_QUERY_SECONDS'] = None
+    app.config['SLOW_QUERY_LOG'] = os.path.join(app.instance_path, 'slow_queries.{pid}.log')
+    app.config['SLOW_QUERY_LOG_MAX_BYTES'] = 10 * 1024 * 1024
+    app.config['SLOW_QUERY_LOG_BACKUPS'] = 5
+
+    # Prometheus metrics served at /metrics. Each worker process writes its metrics to its own file in METRICS_DIR (at most every
+    # METRICS_FLUSH_SECONDS), so that every worker reports the sum of all of them. Without METRICS_DIR, each worker reports its own
+    app.config['METRICS_ENABLED'] = True
+    app.config['METRICS_DIR'] = None
+    app.config['METRICS_FLUSH_SECONDS'] = 5
+
+    # Background jobs (grants.jobs): threads per worker process, seconds between the heartbeats that each process records for its queued
+    # and running jobs, seconds without a heartbeat after which a job counts as interrupted (must exceed the heartbeat interval), whether
+    # interrupted jobs are resumed by the first request the app handles (never by flask CLI commands), and where job results are written
+    # (default: <instance path>/jobs)
+    app.config['JOB_WORKERS'] = 2
+    app.config['JOB_HEARTBEAT_SECONDS'] = 10
+    app.config['JOB_STALE_SECONDS'] = 60
+    app.config['JOB_RESUME_ON_START'] = True
+    app.config['JOB_RESULTS_DIR'] = os.path.join(app.instance_path, 'jobs')
+
+    # Overrides for any of the defaults above, from FLASK_ prefixed environment variables (e.g. FLASK_STORAGE_PROFILE=concurrent)
+    # or from the given config, e.g. to point a benchmark at its own database
+    app.config.from_prefixed_env()
+    app.config.update(config or {})
+
+    db.init_app(app)
+
+    from grants.helpers.storage import StorageProfiles
+    from grants.helpers.serializers import JSONBackends
+
+    app.json = JSONBackends.provider_class(app.config['JSON_BACKEND'])(app)
+
+    engine_options = StorageProfiles.engine_options(app.config['STORAGE_PROFILE'])
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {**engine_options, **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {})}
+
     from grants.households.routes import households
+    from grants.jobs.routes import jobs
+    from grants.metrics.routes import metrics
+    from grants.helpers.stats import HouseholdStatsMaintainer, rollover_household_stats_command
+    from grants.helpers.migrations import SchemaMigrator, migrate_db_command
+    from grants.helpers.names import PersonNameIndex
+    from grants.helpers.export import export_disbursements_command
+    from grants.helpers.seed import seed_db_command
+    from grants.helpers.instrumentation import SQLInstrumentation
+    from grants.helpers.slow_queries import SlowQueryLog
+    from grants.helpers.columnar import ColumnarSearchEngine
 
     app.register_blueprint(households)
+    app.register_blueprint(jobs)
+    if app.config['METRICS_ENABLED']:
+        app.register_blueprint(metrics)
+    if app.config['SQL_INSTRUMENTATION']:
+        SQLInstrumentation.register(app)
+    if app.config['SEARCH_ENGINE'] == 'columnar':
+        ColumnarSearchEngine.register(app)
+    elif app.config['SEARCH_ENGINE'] != 'sql':
+        raise ValueError(f"Invalid search engine: {app.config['SEARCH_ENGINE']}")
+    if app.config['SLOW_QUERY_SECONDS'] is not None:
+        os.makedirs(os.path.dirname(app.config['SLOW_QUERY_LOG']), exist_ok=True)
+        SlowQueryLog.register(app)
+
+    HouseholdStatsMaintainer.register()
+    PersonNameIndex.register()
+    app.cli.add_command(rollover_household_stats_command)
+    app.cli.add_command(migrate_db_command)
+    app.cli.add_command(export_disbursements_command)
+    app.cli.add_command(seed_db_command)
 
     with app.app_context():
-        db.create_all()
+        StorageProfiles.register(db.engine, app.config['STORAGE_PROFILE'])
+        # Creates a new database, or brings an existing one up to the latest schema version
+        SchemaMigrator.migrate(db.engine)
+        # Warms the household stats and grant eligibility of an existing database, or brings them up to date with today's date
+        HouseholdStatsMaintainer.rollover()
     return app
@@ -0,0 +1,59 @@
+import calendar
+import numpy as np
+from datetime import date
+from grants.models import Person
+
+
+class AgeClassifier():
+    # Classifies the ages of many people at once from a numpy datetime64 array of their dates of birth.
+    # Ages are counted in whole months exactly as dateutil's relativedelta does (including month end clipping), so that every
+    # mask agrees with the per-person Person.is_baby / is_teenager / is_elder
+
+    @staticmethod
+    def ages_in_months(dates_of_birth, today=None):
+        today = today or date.today()
+        dates_of_birth = np.asarray(dates_of_birth, dtype='datetime64[D]')
+
+        months = dates_of_birth.astype('datetime64[M]')
+        birth_month_index = months.astype(np.int64)
+        birth_day = (dates_of_birth - months).astype(np.int64) + 1
+
+        today_month_index = (today.year - 1970) * 12 + today.month - 1
+        ages = today_month_index - birth_month_index
+
+        # A month is only complete once today reaches the birth day, clipped to the length of the current month
+        days_in_month = calendar.monthrange(today.year, today.month)[1]
+        ages -= today.day < np.minimum(birth_day, days_in_month)
+        return ages
+
+    @staticmethod
+    def classify(dates_of_birth, today=None):
+        # Age band => boolean mask over dates_of_birth
+        ages = AgeClassifier.ages_in_months(dates_of_birth, today)
+        years = ages // 12
+        return {
+            'baby': ages < 8,
+            'teenager': years <= 16,
+            'elder': years > 55,
+        }
+
+    @staticmethod
+    def criteria_mask(people, criteria, today=None):
+        # Boolean mask of the people meeting every one of the given Person criteria, computed with one pass over their dates of birth.
+        # Criteria other than the age bands and is_student are evaluated per person
+        mask = np.ones(len(people), dtype=bool)
+        if not people or not criteria:
+            return mask
+
+        age_band_criteria = {Person.is_baby: 'baby', Person.is_teenager: 'teenager', Person.is_elder: 'elder'}
+        bands = None
+        for criterion in criteria:
+            if criterion in age_band_criteria:
+                if bands is None:
+                    bands = AgeClassifier.classify([person.date_of_birth for person in people], today)
+                mask &= bands[age_band_criteria[criterion]]
+            elif criterion is Person.is_student:
+                mask &= np.array([person.occupation_type == 'Student' for person in people], dtype=bool)
+            else:
+                mask &= np.array([bool(criterion(person)) for person in people], dtype=bool)
+        return mask
@@ -0,0 +1,209 @@
+import math
+from grants import db
+from grants.models import Household, Person
+from grants.helpers.stats import HouseholdStatsMaintainer
+from grants.helpers.storage import StorageProfiles
+from sqlalchemy import bindparam, func
+
+
+class HouseholdImporter():
+    # Columns copied from a validated (transient) Person into its insert mapping
+    PERSON_FIELDS = ['name', 'gender', 'marital_status', 'occupation_type', 'annual_income', 'date_of_birth']
+
+    def __init__(self, households):
+        self.households = households if isinstance(households, list) else []
+
+        self.errors = []
+        self.household_rows = []
+        self.person_rows = []
+
+        # Batch reference ('Ref') => person row, used to resolve 'SpouseRef' within the batch
+        self.person_refs = {}
+        # (person row, existing spouse id, household index, member index), checked against the database in a single query
+        self.existing_spouses = []
+        # (person row, batch reference, household index, member index), resolved once every row has been validated
+        self.batch_spouses = []
+
+    def validate(self):
+        if not self.households:
+            self.add_error(None, None, 'No households given')
+
+        for household_index, household_data in enumerate(self.households):
+            self.validate_household(household_index, household_data)
+
+        self.resolve_spouses()
+        return not self.errors
+
+    def validate_household(self, household_index, household_data):
+        if not isinstance(household_data, dict):
+            self.add_error(household_index, None, 'Invalid household')
+            return
+
+        try:
+            household = Household(housing_type=household_data.get('Housing Type'))
+        except AssertionError as e:
+            self.add_error(household_index, None, str(e))
+            return
+
+        household_row = {'housing_type': household.housing_type}
+        self.household_rows.append(household_row)
+
+        family_members_data = household_data.get('Family Members', [])
+        if not isinstance(family_members_data, list):
+            self.add_error(household_index, None, 'Invalid Family Members')
+            return
+
+        for member_index, member_data in enumerate(family_members_data):
+            self.validate_person(household_index, member_index, member_data, household_row)
+
+    def validate_person(self, household_index, member_index, member_data, household_row):
+        if not isinstance(member_data, dict):
+            self.add_error(household_index, member_index, 'Invalid family member')
+            return
+
+        for field in ['Name', 'AnnualIncome']:
+            if member_data.get(field) is None:
+                self.add_error(household_index, member_index, f'Missing {field}')
+                return
+
+        # Note: Spouse is intentionally left out here as it is resolved in batch by resolve_spouses
+        try:
+            person = Person(name=member_data.get('Name'), gender=member_data.get('Gender'), marital_status=member_data.get('MaritalStatus'),
+                            occupation_type=member_data.get('OccupationType'), annual_income=float(member_data.get('AnnualIncome')),
+                            date_of_birth=member_data.get('DOB'))
+        except (AssertionError, ValueError, TypeError) as e:
+            self.add_error(household_index, member_index, str(e) or 'Invalid family member')
+            return
+
+        # Note: float() accepts 'nan' and 'inf', which cannot be compared against income limits (and NaN is stored as NULL)
+        if not math.isfinite(person.annual_income):
+            self.add_error(household_index, member_index, 'Invalid AnnualIncome')
+            return
+
+        # Note: References are used as dictionary keys, so only strings and integers are accepted
+        for field in ['Ref', 'SpouseRef']:
+            if not HouseholdImporter.valid_ref(member_data.get(field)):
+                self.add_error(household_index, member_index, f'Invalid {field}')
+                return
+
+        person_row = {field: getattr(person, field) for field in HouseholdImporter.PERSON_FIELDS}
+        person_row['household'] = household_row
+        person_row['spouse_id'] = None
+        self.person_rows.append(person_row)
+
+        ref = member_data.get('Ref')
+        if ref is not None:
+            if ref in self.person_refs:
+                self.add_error(household_index, member_index, f'Duplicate Ref {ref}')
+                return
+            self.person_refs[ref] = person_row
+
+        if member_data.get('SpouseRef') is not None:
+            self.batch_spouses.append((person_row, member_data.get('SpouseRef'), household_index, member_index))
+        elif member_data.get('Spouse') is not None:
+            try:
+                spouse_id = int(member_data.get('Spouse'))
+            except (ValueError, TypeError):
+                self.add_error(household_index, member_index, 'Invalid Spouse')
+                return
+            self.existing_spouses.append((person_row, spouse_id, household_index, member_index))
+
+    @staticmethod
+    def valid_ref(ref):
+        return ref is None or (isinstance(ref, (str, int)) and not isinstance(ref, bool))
+
+    def resolve_spouses(self):
+        for person_row, spouse_ref, household_index, member_index in self.batch_spouses:
+            spouse_row = self.person_refs.get(spouse_ref)
+            if spouse_row is None or spouse_row is person_row:
+                self.add_error(household_index, member_index, f'Unknown SpouseRef {spouse_ref}')
+                continue
+            person_row['spouse'] = spouse_row
+
+        if not self.existing_spouses:
+            return
+
+        spouse_ids = {spouse_id for _, spouse_id, _, _ in self.existing_spouses}
+        found_ids = {row.id for row in db.session.query(Person.id).filter(Person.id.in_(spouse_ids))}
+        for person_row, spouse_id, household_index, member_index in self.existing_spouses:
+            if spouse_id not in found_ids:
+                self.add_error(household_index, member_index, 'Spouse does not exist')
+                continue
+            person_row['spouse_id'] = spouse_id
+
+    def write(self):
+        # IDs are allocated up front so that households, members and spouse links can all be written with executemany inserts
+        StorageProfiles.lock_for_write(db.session.connection())
+        next_household_id = (db.session.query(func.max(Household.id)).scalar() or 0) + 1
+        next_person_id = (db.session.query(func.max(Person.id)).scalar() or 0) + 1
+
+        for offset, household_row in enumerate(self.household_rows):
+            household_row['id'] = next_household_id + offset
+        for offset, person_row in enumerate(self.person_rows):
+            person_row['id'] = next_person_id + offset
+
+        for person_row in self.person_rows:
+            if person_row.get('spouse') is not None:
+                person_row['spouse_id'] = person_row['spouse']['id']
+
+        spouse_backlinks = []
+        for person_row in self.person_rows:
+            spouse_row = person_row.pop('spouse', None)
+            if spouse_row is not None:
+                # Mirror add_person_to_household, where naming a spouse also links the spouse back to the new person
+                if spouse_row['spouse_id'] is None:
+                    spouse_row['spouse_id'] = person_row['id']
+            elif person_row['spouse_id'] is not None:
+                spouse_backlinks.append({'spouse_pk': person_row['spouse_id'], 'new_spouse_id': person_row['id']})
+
+        for person_row in self.person_rows:
+            person_row['household_id'] = person_row.pop('household')['id']
+
+        if self.household_rows:
+            db.session.execute(Household.__table__.insert(), self.household_rows)
+        if self.person_rows:
+            db.session.execute(Person.__table__.insert(), self.person_rows)
+        if spouse_backlinks:
+            table = Person.__table__
+            db.session.execute(
+                table.update().where(table.c.id == bindparam('spouse_pk')).values(spouse_id=bindparam('new_spouse_id')),
+                spouse_backlinks
+            )
+
+        household_ids = [household_row['id'] for household_row in self.household_rows]
+        # Note: Core inserts bypass the flush events that normally keep the household stats up to date
+        HouseholdStatsMaintainer.refresh(set(household_ids) | {person_row['household_id'] for person_row in self.person_rows}, db.session.connection())
+        db.session.commit()
+
+        return household_ids
+
+    def add_error(self, household_index, member_index, message):
+        self.errors.append({
+            'Household': household_index,
+            'FamilyMember': member_index,
+            'Error': message
+        })
+
+
+class FamilyMemberImporter(HouseholdImporter):
+    # Adds family members to an existing household in a single transaction, e.g. a married couple linked by 'Ref' and 'SpouseRef'
+
+    def __init__(self, household_id, family_members):
+        super().__init__([])
+        self.household_id = household_id
+        self.family_members = family_members if isinstance(family_members, list) else []
+
+    def validate(self):
+        if not self.family_members:
+            self.add_error(None, None, 'No family members given')
+
+        household_row = {'id': self.household_id}
+        for member_index, member_data in enumerate(self.family_members):
+            self.validate_person(None, member_index, member_data, household_row)
+
+        self.resolve_spouses()
+        return not self.errors
+
+    def write(self):
+        super().write()
+        return [person_row['id'] for person_row in self.person_rows]
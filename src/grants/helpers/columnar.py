@@ -0,0 +1,291 @@
+import json
+import threading
+import weakref
+import numpy as np
+from sqlalchemy import bindparam, event, literal_column, select, func
+from grants import db
+from grants.models import Household, Person
+from grants.helpers.utils import DateHelper, QueryBuilder
+from grants.helpers.etags import DataVersionHelper
+
+
+class HouseholdIds():
+    # Sorted household IDs found by the columnar engine, standing in for a household query: pages of it are loaded by ID
+    def __init__(self, ids, entities=None):
+        self.ids = ids
+        self.entities = entities
+
+    def with_entities(self, *entities):
+        return HouseholdIds(self.ids, entities)
+
+    def paginate(self, after_id=None, limit=None):
+        start = 0 if after_id is None else int(np.searchsorted(self.ids, after_id, side='right'))
+        page = self.ids[start:] if limit is None else self.ids[start:start + limit]
+
+        # Note: The page's IDs are bound as a single JSON array, so that pages of any size stay within SQLite's limit on bound parameters
+        page_ids = select([literal_column('value')]).select_from(func.json_each(bindparam('household_ids', json.dumps(page.tolist()))))
+        query = db.session.query(*self.entities) if self.entities else Household.query
+        return query.filter(Household.id.in_(page_ids)).order_by(Household.id)
+
+
+class ColumnarSearchEngine():
+    # Optional (SEARCH_ENGINE = 'columnar') in-memory snapshot of the columns searches filter on, held in NumPy arrays: each member's
+    # household, date of birth, occupation and income, and each household's housing type (indexed by household ID). Searches and
+    # grants are answered with vectorized masks over the members, counted per household with bincount.
+    # The snapshot is kept up to date with the writes of this worker by reloading the households they refreshed, and is reloaded in
+    # full when the data version shows that another process wrote to the database
+    HOUSING_TYPES = sorted(Household.valid_housing_types())
+    OCCUPATION_TYPES = sorted(Person.valid_occupation_types())
+    # Rows of the snapshot, with the housing and occupation types given by their index in the lists above, and dates of birth in days
+    # since 1970-01-01. Both are computed by SQLite, so that rows are converted to arrays without any work per row in Python
+    HOUSEHOLDS_SQL = 'SELECT id, CASE housing_type {} ELSE -1 END FROM household'.format(
+        ' '.join(f"WHEN '{value}' THEN {code}" for code, value in enumerate(HOUSING_TYPES))
+    )
+    PEOPLE_SQL = 'SELECT id, household_id, CAST(julianday(date_of_birth) - 2440587.5 AS INTEGER), CASE occupation_type {} ELSE -1 END, ' \
+        'annual_income FROM person'.format(' '.join(f"WHEN '{value}' THEN {code}" for code, value in enumerate(OCCUPATION_TYPES)))
+    HOUSEHOLD_DTYPE = [('id', np.int64), ('housing_type', np.int8)]
+    PERSON_DTYPE = [('id', np.int64), ('household_id', np.int64), ('date_of_birth', np.int64), ('occupation_type', np.int8), ('annual_income', np.float64)]
+
+    # Fraction of member rows that may be left unused by updates before the arrays are compacted
+    MAX_UNUSED_FRACTION = 0.25
+
+    # SQLAlchemy engine => its ColumnarSearchEngine
+    engines = weakref.WeakKeyDictionary()
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.stale_household_ids = set()
+
+        self.housing_types = np.full(0, -1, dtype=np.int8)
+        self.clear_people()
+
+    @staticmethod
+    def register(app):
+        with app.app_context():
+            engine = db.engine
+        search_engine = ColumnarSearchEngine()
+        app.extensions['grants.columnar'] = search_engine
+        ColumnarSearchEngine.engines[engine] = search_engine
+        event.listen(engine, 'commit', search_engine.after_commit)
+        event.listen(engine, 'rollback', ColumnarSearchEngine.after_rollback)
+        return search_engine
+
+    @staticmethod
+    def get(app):
+        return app.extensions['grants.columnar']
+
+    # Writes
+
+    @staticmethod
+    def record_refresh(household_ids, connection):
+        # Called by HouseholdStatsMaintainer.refresh, within the transaction writing to the households. Each refresh bumps the data version
+        if connection.engine not in ColumnarSearchEngine.engines:
+            return
+        pending = connection.info.setdefault('columnar_pending', {'household_ids': set(), 'versions': 0})
+        pending['household_ids'].update(household_ids)
+        pending['versions'] += 1
+
+    def after_commit(self, connection):
+        pending = connection.info.pop('columnar_pending', None)
+        if pending is None:
+            return
+        with self.lock:
+            self.stale_household_ids.update(pending['household_ids'])
+            if self.version is not None:
+                self.version += pending['versions']
+
+    @staticmethod
+    def after_rollback(connection):
+        connection.info.pop('columnar_pending', None)
+
+    # Snapshot
+
+    def sync(self):
+        # Brings the snapshot up to date. Must be called with the lock held
+        version = DataVersionHelper.current()
+        if self.version != version:
+            self.load(version)
+        elif self.stale_household_ids:
+            self.reload_households(sorted(self.stale_household_ids))
+        self.stale_household_ids = set()
+
+    def load(self, version):
+        # Note: The version is read before the data, so that writes made while loading are caught by the next sync
+        households = ColumnarSearchEngine.fetch(ColumnarSearchEngine.HOUSEHOLDS_SQL)
+        people = ColumnarSearchEngine.fetch(ColumnarSearchEngine.PEOPLE_SQL)
+
+        max_household_id = max((row[0] for row in households), default=0)
+        self.housing_types = np.full(max_household_id + 1, -1, dtype=np.int8)
+        self.set_households(households)
+
+        self.clear_people()
+        self.append_people(people)
+        self.version = version
+
+    def reload_households(self, household_ids):
+        # Replaces the households and members of the given households with their rows in the database
+        self.valid[:self.size] &= ~np.isin(self.household_ids[:self.size], household_ids)
+        self.housing_types[[household_id for household_id in household_ids if household_id < len(self.housing_types)]] = -1
+
+        for start in range(0, len(household_ids), QueryBuilder.MEMBER_BATCH_SIZE):
+            batch = json.dumps(household_ids[start:start + QueryBuilder.MEMBER_BATCH_SIZE])
+            self.set_households(ColumnarSearchEngine.fetch(f'{ColumnarSearchEngine.HOUSEHOLDS_SQL} WHERE id IN (SELECT value FROM json_each(?))', (batch,)))
+            self.append_people(ColumnarSearchEngine.fetch(
+                f'{ColumnarSearchEngine.PEOPLE_SQL} WHERE household_id IN (SELECT value FROM json_each(?))', (batch,)
+            ))
+
+        if np.count_nonzero(~self.valid[:self.size]) > self.size * ColumnarSearchEngine.MAX_UNUSED_FRACTION:
+            self.compact()
+
+    def clear_people(self):
+        # Member columns. Rows past size are spare capacity, and rows that are not valid were replaced by an update
+        self.size = 0
+        self.person_ids = np.zeros(0, dtype=np.int64)
+        self.household_ids = np.zeros(0, dtype=np.int64)
+        self.dates_of_birth = np.zeros(0, dtype='datetime64[D]')
+        self.occupation_types = np.zeros(0, dtype=np.int8)
+        self.annual_incomes = np.zeros(0, dtype=np.float64)
+        self.valid = np.zeros(0, dtype=bool)
+
+    @staticmethod
+    def fetch(statement, parameters=()):
+        # Rows as plain tuples from the driver, which NumPy converts to structured arrays directly
+        # Note: Run on the session's connection, so that the rows are read within its transaction
+        return db.session.connection().connection.cursor().execute(statement, parameters).fetchall()
+
+    def set_households(self, rows):
+        if not rows:
+            return
+        households = np.array(rows, dtype=ColumnarSearchEngine.HOUSEHOLD_DTYPE)
+        max_id = int(households['id'].max())
+        if max_id >= len(self.housing_types):
+            # Note: Grown by at least double, so that households added one at a time are copied a logarithmic number of times
+            grown = np.full(max(max_id + 1, 2 * len(self.housing_types)), -1, dtype=np.int8)
+            grown[:len(self.housing_types)] = self.housing_types
+            self.housing_types = grown
+        self.housing_types[households['id']] = households['housing_type']
+
+    def append_people(self, rows):
+        if not rows:
+            return
+        people = np.array(rows, dtype=ColumnarSearchEngine.PERSON_DTYPE)
+        end = self.size + len(people)
+        if end > len(self.valid):
+            self.grow(max(end, 2 * len(self.valid)))
+
+        self.person_ids[self.size:end] = people['id']
+        self.household_ids[self.size:end] = people['household_id']
+        self.dates_of_birth[self.size:end] = people['date_of_birth'].astype('datetime64[D]')
+        self.occupation_types[self.size:end] = people['occupation_type']
+        self.annual_incomes[self.size:end] = people['annual_income']
+        self.valid[self.size:end] = True
+        self.size = end
+
+    def grow(self, capacity):
+        for name in ['person_ids', 'household_ids', 'dates_of_birth', 'occupation_types', 'annual_incomes', 'valid']:
+            column = getattr(self, name)
+            grown = np.zeros(capacity, dtype=column.dtype)
+            grown[:self.size] = column[:self.size]
+            setattr(self, name, grown)
+
+    def compact(self):
+        valid = self.valid[:self.size]
+        for name in ['person_ids', 'household_ids', 'dates_of_birth', 'occupation_types', 'annual_incomes', 'valid']:
+            setattr(self, name, getattr(self, name)[:self.size][valid].copy())
+        self.size = len(self.valid)
+
+    @staticmethod
+    def codes(values, vocabulary):
+        lookup = {value: code for code, value in enumerate(vocabulary)}
+        return np.array([lookup.get(value, -1) for value in values], dtype=np.int8)
+
+    # Searches
+
+    def search(self, query_builder):
+        return HouseholdIds(self.matching_households([query_builder]))
+
+    def search_grant(self, grant):
+        # Households eligible for the grant, i.e. matching any of its searches, as process_grants does
+        return HouseholdIds(self.matching_households(QueryBuilder.grant_query_builders(grant)))
+
+    def matching_households(self, query_builders):
+        with self.lock:
+            self.sync()
+            counts = HouseholdCounts(self)
+            mask = np.zeros(len(self.housing_types), dtype=bool)
+            for query_builder in query_builders:
+                mask |= self.household_mask(query_builder, counts)
+            return np.flatnonzero(mask)
+
+    def household_mask(self, query_builder, counts):
+        # The same conditions as QueryBuilder.household_criteria, over every household ID at once
+        mask = self.housing_types >= 0
+        if query_builder.household_types:
+            codes = ColumnarSearchEngine.codes(query_builder.household_types, ColumnarSearchEngine.HOUSING_TYPES)
+            mask &= np.isin(self.housing_types, codes[codes >= 0])
+
+        if query_builder.family_member_names:
+            # Note: Names are not held in memory. The households with matching names are found by the person name index
+            names_query = QueryBuilder.from_params({'set_family_member_names': query_builder.family_member_names}).generate_query()
+            name_mask = np.zeros(len(mask), dtype=bool)
+            name_mask[[row.id for row in names_query.with_entities(Household.id) if row.id < len(mask)]] = True
+            mask &= name_mask
+
+        limits = query_builder.aggregate_limits()
+        if limits:
+            # Note: Households without members are excluded, as they are by the household_stats query
+            mask &= counts.get('num_family_members') >= 1
+        for name, (min_num, max_num) in limits.items():
+            values = counts.get(name)
+            mask &= values >= min_num
+            if max_num is not None:
+                mask &= values <= max_num
+        return mask
+
+
+class HouseholdCounts():
+    # Household aggregates of a snapshot (household ID => value), computed once per search and only for the aggregates it limits
+    def __init__(self, search_engine):
+        self.search_engine = search_engine
+        self.values = {}
+
+    def get(self, name):
+        if name not in self.values:
+            self.values[name] = self.compute(name)
+        return self.values[name]
+
+    def compute(self, name):
+        engine = self.search_engine
+        size = engine.size
+        valid = engine.valid[:size]
+        household_ids = engine.household_ids[:size]
+        num_households = len(engine.housing_types)
+
+        if name == 'total_annual_income':
+            return np.bincount(household_ids[valid], weights=engine.annual_incomes[:size][valid], minlength=num_households)
+        member_mask = valid & self.member_mask(name)
+        return np.bincount(household_ids[member_mask], minlength=num_households)
+
+    def member_mask(self, name):
+        # The same age bands as the QueryBuilder criteria, compared against today's date
+        engine = self.search_engine
+        dates_of_birth = engine.dates_of_birth[:engine.size]
+
+        def years_ago(years):
+            return np.datetime64(DateHelper.date_years_ago(years), 'D')
+
+        if name == 'num_family_members':
+            return np.ones(engine.size, dtype=bool)
+        if name == 'num_adults':
+            return (dates_of_birth <= years_ago(18)) & (dates_of_birth >= years_ago(55))
+        if name == 'num_elders':
+            return dates_of_birth < years_ago(55)
+        if name == 'num_teenage_students':
+            student = ColumnarSearchEngine.OCCUPATION_TYPES.index('Student')
+            return (dates_of_birth >= years_ago(16)) & (engine.occupation_types[:engine.size] == student)
+        if name == 'num_children':
+            return dates_of_birth > years_ago(18)
+        if name == 'num_babies':
+            return dates_of_birth > np.datetime64(DateHelper.date_months_ago(8), 'D')
+        raise ValueError(f'Invalid household aggregate: {name}')
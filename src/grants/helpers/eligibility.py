@@ -0,0 +1,59 @@
+from grants.models import Household, Person, GrantEligibility
+from grants.helpers.utils import QueryBuilder, statement_cache
+from grants.helpers.rules import GrantRules
+from sqlalchemy import bindparam, case, literal, select
+
+
+class GrantEligibilityStore():
+    # Maximum number of households refreshed by a single statement
+    BATCH_SIZE = 500
+
+    @staticmethod
+    def refresh(household_ids, connection):
+        # Recomputes the eligibility of the given households for every grant. Called by HouseholdStatsMaintainer whenever they change
+        table = GrantEligibility.__table__
+        delete_statement = statement_cache.get(
+            ('grant_eligibility_delete',), lambda: table.delete().where(table.c.household_id.in_(bindparam('household_ids', expanding=True)))
+        )
+
+        household_ids = sorted(household_ids)
+        for start in range(0, len(household_ids), GrantEligibilityStore.BATCH_SIZE):
+            batch = household_ids[start:start + GrantEligibilityStore.BATCH_SIZE]
+            connection.execute(delete_statement, {'household_ids': batch})
+            for grant in sorted(QueryBuilder.valid_grant_types()):
+                insert_statement = statement_cache.get(
+                    ('grant_eligibility_insert', grant),
+                    lambda: table.insert().from_select(['grant', 'household_id', 'person_id'], GrantEligibilityStore.eligibility_query(grant))
+                )
+                connection.execute(insert_statement, {'household_ids': batch})
+
+    @staticmethod
+    def eligibility_query(grant):
+        # Note: Eligibility is computed from person rows, as household_stats may not have been refreshed yet within the same flush.
+        # Only the members of the given households are aggregated, so that the cost of a refresh does not grow with the whole table
+        aggregates = select(
+            [Person.household_id.label('household_id')] + [column.label(name) for name, column in QueryBuilder.household_aggregate_columns().items()]
+        ).where(Person.household_id.in_(bindparam('household_ids', expanding=True))).group_by(Person.household_id).subquery()
+        eligible_household_ids = select([Household.id]).join(aggregates, aggregates.c.household_id == Household.id) \
+            .where(GrantRules.get(grant).household_criteria(aggregates.c))
+
+        query = select([literal(grant), Person.household_id, Person.id]).where(Person.household_id.in_(eligible_household_ids))
+        member_criteria = QueryBuilder.grant_member_criteria(grant)
+        if member_criteria is not None:
+            # Note: Wrapped in a CASE so that members are looked up by household. Otherwise SQLite may search every person matching the
+            # criteria (e.g. every teenage student) through ix_person_occupation_type_date_of_birth
+            query = query.where(case((member_criteria, 1), else_=0) == 1)
+        return query
+
+    @staticmethod
+    def households_query(grant):
+        from grants.helpers.stats import HouseholdStatsMaintainer
+
+        # Members may have crossed an age boundary since eligibility was last computed
+        HouseholdStatsMaintainer.rollover()
+        return Household.query.filter(Household.id.in_(select([GrantEligibility.household_id]).where(GrantEligibility.grant == grant))) \
+            .execution_options(query_origin={'grant': grant})
+
+    @staticmethod
+    def member_criteria(grant):
+        return Person.id.in_(select([GrantEligibility.person_id]).where(GrantEligibility.grant == grant))
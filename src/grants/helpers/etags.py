@@ -0,0 +1,26 @@
+from datetime import date
+from hashlib import sha1
+from grants import db
+from grants.models import DataVersion
+
+
+class DataVersionHelper():
+    VERSION_ID = 1
+
+    @staticmethod
+    def current():
+        return db.session.query(DataVersion.version).filter(DataVersion.id == DataVersionHelper.VERSION_ID).scalar() or 0
+
+    @staticmethod
+    def bump(connection):
+        table = DataVersion.__table__
+        result = connection.execute(table.update().where(table.c.id == DataVersionHelper.VERSION_ID).values(version=table.c.version + 1))
+        if result.rowcount == 0:
+            connection.execute(table.insert().values(id=DataVersionHelper.VERSION_ID, version=1))
+
+    @staticmethod
+    def etag(request, *extra):
+        # Age band membership also changes with the date, so the same data version yields a new ETag every day
+        params = sorted(request.args.items(multi=True)) + sorted(request.form.items(multi=True))
+        key = f'{DataVersionHelper.current()}|{date.today().isoformat()}|{request.path}|{params}|{extra}'
+        return sha1(key.encode()).hexdigest()
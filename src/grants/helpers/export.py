@@ -0,0 +1,141 @@
+import click
+import csv
+import io
+import time
+from flask import current_app
+from flask.cli import with_appcontext
+from grants.helpers.utils import QueryBuilder
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+class StreamBuffer(io.RawIOBase):
+    # Write-only file whose contents are drained after each chunk, so that a file format can be streamed without being held in memory
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class DisbursementExporter():
+    # Writes one row per qualifying member of every eligible household of the given grants, fetched chunk_size households at a time
+    COLUMNS = [
+        'Grant', 'HouseholdID', 'HouseholdType', 'PersonID', 'Name', 'Gender', 'MaritalStatus', 'OccupationType', 'AnnualIncome', 'DOB'
+    ]
+    FORMATS = {'csv', 'parquet'}
+
+    def __init__(self, grants=None, chunk_size=1000):
+        self.grants = grants or sorted(QueryBuilder.valid_grant_types())
+        self.chunk_size = chunk_size
+        self.row_counts = {grant: 0 for grant in self.grants}
+        self.elapsed = None
+
+    def validate(self, export_format):
+        # Returns an error message, or None if the export can be run
+        invalid_grants = [grant for grant in self.grants if grant not in QueryBuilder.valid_grant_types()]
+        if invalid_grants:
+            return f'Invalid grant type: {invalid_grants[0]}'
+        if export_format not in DisbursementExporter.FORMATS:
+            return f'Invalid export format: {export_format}'
+        if export_format == 'parquet' and pyarrow is None:
+            return 'Parquet export requires the pyarrow package'
+        return None
+
+    def iter_rows(self):
+        # Yields lists of rows, one per chunk of households
+        for _, _, rows in self.iter_chunks():
+            yield rows
+
+    def iter_chunks(self, grant_index=0, after_id=None):
+        # Yields (grant index, last household ID, rows) per chunk of households, starting after the given position so that an export can be resumed
+        start = time.perf_counter()
+        for index in range(grant_index, len(self.grants)):
+            grant = self.grants[index]
+            member_criteria = QueryBuilder.grant_member_criteria(grant)
+            households_query = QueryBuilder.process_grants(grant)
+            for households in QueryBuilder.iter_chunks(households_query, after_id if index == grant_index else None, chunk_size=self.chunk_size):
+                family_members = QueryBuilder.load_family_members(households, member_criteria)
+                rows = [
+                    (grant, household.id, household.housing_type, person.id, person.name, person.gender, person.marital_status,
+                     person.occupation_type, person.annual_income, person.date_of_birth)
+                    for household in households for person in family_members[household.id]
+                ]
+                self.row_counts[grant] += len(rows)
+                yield index, households[-1].id, rows
+        self.elapsed = time.perf_counter() - start
+
+    def iter_export(self, export_format):
+        if export_format == 'parquet':
+            return self.iter_parquet()
+        return self.iter_csv()
+
+    def iter_csv(self):
+        yield DisbursementExporter.csv_chunk([DisbursementExporter.COLUMNS])
+        for rows in self.iter_rows():
+            yield DisbursementExporter.csv_chunk(row[:-1] + (row[-1].isoformat(),) for row in rows)
+
+    @staticmethod
+    def csv_chunk(rows):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        return buffer.getvalue().encode()
+
+    def iter_parquet(self):
+        # Each chunk is written as a row group
+        schema = pyarrow.schema([
+            ('Grant', pyarrow.string()), ('HouseholdID', pyarrow.int64()), ('HouseholdType', pyarrow.string()), ('PersonID', pyarrow.int64()),
+            ('Name', pyarrow.string()), ('Gender', pyarrow.string()), ('MaritalStatus', pyarrow.string()),
+            ('OccupationType', pyarrow.string()), ('AnnualIncome', pyarrow.float64()), ('DOB', pyarrow.date32()),
+        ])
+        buffer = StreamBuffer()
+        writer = pyarrow.parquet.ParquetWriter(buffer, schema)
+        for rows in self.iter_rows():
+            if rows:
+                columns = [list(column) for column in zip(*rows)]
+                writer.write_table(pyarrow.Table.from_arrays(
+                    [pyarrow.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema
+                ))
+                yield buffer.drain()
+        writer.close()
+        yield buffer.drain()
+
+    def summary(self):
+        counts = ', '.join(f'{grant}: {count}' for grant, count in self.row_counts.items())
+        return f'Exported {sum(self.row_counts.values())} rows ({counts}) in {self.elapsed:.2f}s'
+
+
+@click.command('export-disbursements')
+@click.option('--format', 'export_format', type=click.Choice(sorted(DisbursementExporter.FORMATS)), default='csv')
+@click.option('--output', required=True, type=click.Path(dir_okay=False, writable=True))
+@click.option('--grant', 'grants', multiple=True, help='Grant to export. May be repeated (default: every grant)')
+@click.option('--chunk-size', type=click.IntRange(min=1), default=None, help='Households fetched per query (default: STREAM_CHUNK_SIZE)')
+@with_appcontext
+def export_disbursements_command(export_format, output, grants, chunk_size):
+    exporter = DisbursementExporter(list(grants), chunk_size or current_app.config['STREAM_CHUNK_SIZE'])
+    error = exporter.validate(export_format)
+    if error:
+        raise click.UsageError(error)
+
+    with open(output, 'wb') as file:
+        for data in exporter.iter_export(export_format):
+            file.write(data)
+    click.echo(exporter.summary())
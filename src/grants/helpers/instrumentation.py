@@ -0,0 +1,155 @@
+import json
+import logging
+import time
+from flask import g, has_request_context, request
+from flask.json.provider import JSONProvider
+from flask.logging import create_logger
+from sqlalchemy import event
+from grants import db
+
+logger = logging.getLogger('grants.instrumentation')
+
+
+class RequestMetrics():
+    # Work done on behalf of a single request
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.statements = 0
+        self.db_time = 0.0
+        self.serialization_time = 0.0
+        self.rows_loaded = 0
+        self.rows_written = 0
+
+    def server_timing(self):
+        # Note: Time not spent in the database or encoding JSON is reported as app, e.g. building ORM objects and projecting them
+        total = time.perf_counter() - self.start
+        return ', '.join([
+            f'db;dur={self.db_time * 1000:.2f};desc="{self.statements} statements"',
+            f'serialize;dur={self.serialization_time * 1000:.2f}',
+            f'app;dur={max(total - self.db_time - self.serialization_time, 0) * 1000:.2f}',
+            f'total;dur={total * 1000:.2f}',
+        ])
+
+    def to_json(self):
+        return {
+            'statements': self.statements,
+            'db_ms': round(self.db_time * 1000, 2),
+            'serialize_ms': round(self.serialization_time * 1000, 2),
+            'total_ms': round((time.perf_counter() - self.start) * 1000, 2),
+            'rows_loaded': self.rows_loaded,
+            'rows_written': self.rows_written,
+        }
+
+
+class InstrumentedJSONProvider(JSONProvider):
+    # Wraps the app's JSON provider, timing the encoding of responses (and of each NDJSON line)
+    def __init__(self, app, provider):
+        super().__init__(app)
+        self.provider = provider
+        self.mimetype = provider.mimetype
+
+    def dumps(self, obj, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self.provider.dumps(obj, **kwargs)
+        finally:
+            SQLInstrumentation.add_serialization_time(time.perf_counter() - start)
+
+    def loads(self, s, **kwargs):
+        return self.provider.loads(s, **kwargs)
+
+    def __getattr__(self, name):
+        # Settings of the wrapped provider, e.g. sort_keys
+        return getattr(self.provider, name)
+
+    def response(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self.provider.response(*args, **kwargs)
+        finally:
+            SQLInstrumentation.add_serialization_time(time.perf_counter() - start)
+
+
+class SQLInstrumentation():
+    # Opt-in (SQL_INSTRUMENTATION) per request statement counts, database, serialization and total time, and ORM rows loaded and rows
+    # written. Reported as a Server-Timing header and as one JSON log line per request on the grants.instrumentation logger
+    # Note: Streamed responses have sent their headers before their body is generated, so they are only reported by their log line
+
+    @staticmethod
+    def register(app):
+        # Note: grants.instrumentation is a child of the app's logger, so its lines are written by the app's log handlers. create_logger
+        # (which also backs app.logger) adds Flask's default handler to it when logging has not been configured
+        create_logger(app)
+        if logger.level == logging.NOTSET:
+            logger.setLevel(logging.INFO)
+
+        app.json = InstrumentedJSONProvider(app, app.json)
+        app.before_request(SQLInstrumentation.before_request)
+        app.after_request(SQLInstrumentation.after_request)
+
+        with app.app_context():
+            engine = db.engine
+        if not event.contains(engine, 'before_cursor_execute', SQLInstrumentation.before_cursor_execute):
+            event.listen(engine, 'before_cursor_execute', SQLInstrumentation.before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', SQLInstrumentation.after_cursor_execute)
+            event.listen(engine, 'handle_error', SQLInstrumentation.handle_error)
+        if not event.contains(db.Model, 'load', SQLInstrumentation.after_load):
+            event.listen(db.Model, 'load', SQLInstrumentation.after_load, propagate=True)
+
+    @staticmethod
+    def current():
+        # Metrics of the request being handled, or None (e.g. in a background job, or when instrumentation is disabled)
+        return g.get('request_metrics') if has_request_context() else None
+
+    @staticmethod
+    def before_request():
+        g.request_metrics = RequestMetrics()
+
+    @staticmethod
+    def after_request(response):
+        metrics = g.get('request_metrics')
+        if metrics is None:
+            return response
+
+        log_line = {'method': request.method, 'path': request.path, 'endpoint': request.endpoint, 'status': response.status_code}
+        if response.is_streamed:
+            response.call_on_close(lambda: logger.info(json.dumps({**log_line, **metrics.to_json()})))
+        else:
+            response.headers['Server-Timing'] = metrics.server_timing()
+            logger.info(json.dumps({**log_line, **metrics.to_json()}))
+        return response
+
+    # Note: Start times are kept by the statement's execution context, as a statement that raises never reaches after_cursor_execute
+
+    @staticmethod
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault('query_start', {})[context] = time.perf_counter()
+
+    @staticmethod
+    def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - connection.info['query_start'].pop(context)
+        metrics = SQLInstrumentation.current()
+        if metrics is None:
+            return
+        metrics.statements += 1
+        metrics.db_time += elapsed
+        # Note: The driver reports a row count of -1 for queries, and the number of rows changed by writes
+        if cursor.rowcount > 0:
+            metrics.rows_written += cursor.rowcount
+
+    @staticmethod
+    def handle_error(exception_context):
+        if exception_context.connection is not None:
+            exception_context.connection.info.get('query_start', {}).pop(exception_context.execution_context, None)
+
+    @staticmethod
+    def after_load(target, context):
+        metrics = SQLInstrumentation.current()
+        if metrics is not None:
+            metrics.rows_loaded += 1
+
+    @staticmethod
+    def add_serialization_time(seconds):
+        metrics = SQLInstrumentation.current()
+        if metrics is not None:
+            metrics.serialization_time += seconds
@@ -0,0 +1,111 @@
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import inspect
+from grants import db
+from grants.models import Household, Person, HouseholdStats, HouseholdStatsRollover, Job
+from grants.helpers.names import PersonNameIndex
+
+
+class SchemaMigrator():
+    # The schema version of a database is kept in SQLite's user_version pragma
+    # Note: A new database is created from the models and marked as up to date, so every migration must also be declared on the models.
+    # Migrations must be safe to run against a database that already has some of their changes (e.g. use checkfirst)
+
+    @staticmethod
+    def migrations():
+        return [
+            (1, 'Create missing tables', SchemaMigrator.create_missing_tables),
+            (2, 'Index household and person search predicates', SchemaMigrator.index_search_predicates),
+            (3, 'Index person names for substring search', PersonNameIndex.create),
+            (4, 'Store the total annual income of households', SchemaMigrator.store_household_income),
+            (5, 'Create the background job table', SchemaMigrator.create_job_table),
+            (6, 'Drop the person name index', SchemaMigrator.drop_person_name_index),
+            (7, 'Rename the pending job status to queued', SchemaMigrator.rename_pending_jobs),
+        ]
+
+    @staticmethod
+    def latest_version():
+        return SchemaMigrator.migrations()[-1][0]
+
+    @staticmethod
+    def migrate(engine):
+        # Returns the (version, description) of each migration applied
+        with engine.connect() as connection:
+            with connection.begin():
+                # Note: Takes the write lock up front, so that workers starting together apply each migration once
+                connection.exec_driver_sql('BEGIN IMMEDIATE')
+                current_version = connection.exec_driver_sql('PRAGMA user_version').scalar()
+
+                if not inspect(connection).has_table(Household.__tablename__):
+                    db.metadata.create_all(connection)
+                    applied = [(SchemaMigrator.latest_version(), 'Create tables')]
+                else:
+                    applied = []
+                    for version, description, upgrade in SchemaMigrator.migrations():
+                        if version > current_version:
+                            upgrade(connection)
+                            applied.append((version, description))
+
+                if applied:
+                    connection.exec_driver_sql(f'PRAGMA user_version = {SchemaMigrator.latest_version()}')
+        return applied
+
+    @staticmethod
+    def current_version(engine):
+        with engine.connect() as connection:
+            return connection.exec_driver_sql('PRAGMA user_version').scalar()
+
+    # Migrations
+
+    @staticmethod
+    def create_missing_tables(connection):
+        # Databases created before migrations existed, which may be missing tables added since
+        db.metadata.create_all(connection)
+
+    @staticmethod
+    def index_search_predicates(connection):
+        SchemaMigrator.create_indexes(connection, Household, ['ix_household_housing_type'])
+        SchemaMigrator.create_indexes(connection, Person, [
+            'ix_person_date_of_birth', 'ix_person_household_id_date_of_birth', 'ix_person_occupation_type_date_of_birth'
+        ])
+
+    @staticmethod
+    def store_household_income(connection):
+        # Moves total_annual_income from household_stats to household. household_stats is recreated without it, and the rollover
+        # record is removed, so that the next rollover (when the app starts) computes the stats and income of every household
+        if 'total_annual_income' not in {column['name'] for column in inspect(connection).get_columns('household')}:
+            connection.exec_driver_sql('ALTER TABLE household ADD COLUMN total_annual_income FLOAT NOT NULL DEFAULT 0')
+        SchemaMigrator.create_indexes(connection, Household, ['ix_household_total_annual_income'])
+
+        HouseholdStats.__table__.drop(connection, checkfirst=True)
+        HouseholdStats.__table__.create(connection)
+        connection.execute(HouseholdStatsRollover.__table__.delete())
+
+    @staticmethod
+    def create_job_table(connection):
+        Job.__table__.create(connection, checkfirst=True)
+
+    @staticmethod
+    def drop_person_name_index(connection):
+        # Names are matched as substrings (LIKE '%name%'), which a B-tree index cannot serve. They are matched through person_name_fts
+        connection.exec_driver_sql('DROP INDEX IF EXISTS ix_person_name')
+
+    @staticmethod
+    def rename_pending_jobs(connection):
+        table = Job.__table__
+        connection.execute(table.update().where(table.c.status == 'pending').values(status='queued'))
+
+    @staticmethod
+    def create_indexes(connection, model, names):
+        indexes = {index.name: index for index in model.__table__.indexes}
+        for name in names:
+            indexes[name].create(connection, checkfirst=True)
+
+
+@click.command('migrate-db')
+@with_appcontext
+def migrate_db_command():
+    applied = SchemaMigrator.migrate(db.engine)
+    for version, description in applied:
+        click.echo(f'Applied migration {version}: {description}')
+    click.echo(f'Database is at schema version {SchemaMigrator.current_version(db.engine)}')
@@ -0,0 +1,79 @@
+import sqlite3
+from sqlalchemy import column, event, or_, select, table, union
+from grants.models import Household, Person
+
+
+class PersonNameIndex():
+    # FTS5 index of person names using the trigram tokenizer, so that substring (LIKE '%name%') searches are answered from the index
+    # instead of scanning person. It is an external content table over person, kept in sync by triggers on every write path
+    # Note: The trigram tokenizer requires SQLite 3.34. Older versions fall back to scanning person
+    SUPPORTED = sqlite3.sqlite_version_info >= (3, 34, 0)
+
+    TABLE = table('person_name_fts', column('rowid'), column('name'))
+
+    CREATE_STATEMENTS = [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS person_name_fts USING fts5(name, content='person', content_rowid='id', tokenize='trigram')",
+        '''CREATE TRIGGER IF NOT EXISTS person_name_fts_insert AFTER INSERT ON person BEGIN
+            INSERT INTO person_name_fts (rowid, name) VALUES (new.id, new.name);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS person_name_fts_delete AFTER DELETE ON person BEGIN
+            INSERT INTO person_name_fts (person_name_fts, rowid, name) VALUES ('delete', old.id, old.name);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS person_name_fts_update AFTER UPDATE OF id, name ON person BEGIN
+            INSERT INTO person_name_fts (person_name_fts, rowid, name) VALUES ('delete', old.id, old.name);
+            INSERT INTO person_name_fts (rowid, name) VALUES (new.id, new.name);
+        END''',
+    ]
+
+    @staticmethod
+    def register():
+        # Creates the index along with the person table, e.g. when a new database is created
+        if not event.contains(Person.__table__, 'after_create', PersonNameIndex.after_create):
+            event.listen(Person.__table__, 'after_create', PersonNameIndex.after_create)
+            event.listen(Person.__table__, 'after_drop', PersonNameIndex.after_drop)
+
+    @staticmethod
+    def after_create(target, connection, **kwargs):
+        PersonNameIndex.create(connection)
+
+    @staticmethod
+    def after_drop(target, connection, **kwargs):
+        # Note: The triggers are dropped along with person
+        if PersonNameIndex.SUPPORTED:
+            connection.exec_driver_sql('DROP TABLE IF EXISTS person_name_fts')
+
+    @staticmethod
+    def create(connection):
+        if not PersonNameIndex.SUPPORTED:
+            return
+        for statement in PersonNameIndex.CREATE_STATEMENTS:
+            connection.exec_driver_sql(statement)
+        # Indexes the names of existing people
+        connection.exec_driver_sql("INSERT INTO person_name_fts (person_name_fts) VALUES ('rebuild')")
+
+    @staticmethod
+    def drop_insert_trigger(connection):
+        # For bulk loads, whose names are indexed by index_people in a single statement instead of one trigger per row
+        if PersonNameIndex.SUPPORTED:
+            connection.exec_driver_sql('DROP TRIGGER IF EXISTS person_name_fts_insert')
+
+    @staticmethod
+    def index_people(connection, first_person_id):
+        # Indexes the names of people from first_person_id onwards, and restores the insert trigger
+        if not PersonNameIndex.SUPPORTED:
+            return
+        connection.exec_driver_sql('INSERT INTO person_name_fts (rowid, name) SELECT id, name FROM person WHERE id >= ?', (first_person_id,))
+        connection.exec_driver_sql(PersonNameIndex.CREATE_STATEMENTS[1])
+
+    @staticmethod
+    def households_matching(patterns):
+        # Households with a member whose name is LIKE any of the given bound pattern parameters
+        # Note: With the trigram tokenizer, LIKE on the FTS table keeps the case insensitive semantics of LIKE on person.name.
+        # Patterns of fewer than 3 characters cannot use the index, and are answered by scanning the FTS table instead
+        if not PersonNameIndex.SUPPORTED:
+            return Household.family_members.any(or_(*[Person.name.like(pattern) for pattern in patterns]))
+
+        name_table = PersonNameIndex.TABLE
+        matching_ids = [select([name_table.c.rowid]).where(name_table.c.name.like(pattern)) for pattern in patterns]
+        matching_ids = matching_ids[0] if len(matching_ids) == 1 else union(*matching_ids)
+        return Household.id.in_(select([Person.household_id]).where(Person.id.in_(matching_ids)))
@@ -0,0 +1,109 @@
+from collections import OrderedDict
+from sqlalchemy import and_, case, or_, select, true
+from grants import db
+from grants.models import Household, Person, HouseholdStats
+from grants.helpers.utils import QueryBuilder
+
+
+class GrantRule():
+    # A grant, declared as the searches that make a household eligible (any of them) and the criteria of its qualifying members
+    def __init__(self, name, household_searches, member_criteria=None):
+        # household_searches: List of {QueryBuilder setter: value}
+        # member_criteria: QueryBuilder criteria function of the qualifying members. None indicates that every member qualifies
+        self.name = name
+        self.household_searches = household_searches
+        self.member_criteria_function = member_criteria
+
+    def query_builders(self):
+        return [QueryBuilder.from_params(params) for params in self.household_searches]
+
+    def member_criteria(self):
+        return self.member_criteria_function() if self.member_criteria_function is not None else None
+
+    def household_criteria(self, aggregates):
+        # Eligibility of a household as a boolean expression over the given household aggregate columns
+        return or_(*[query_builder.household_criteria(aggregates) for query_builder in self.query_builders()])
+
+
+class GrantRules():
+    RULES = OrderedDict((rule.name, rule) for rule in [
+        GrantRule(
+            'Student Encouragement Bonus',
+            [{'set_limits_num_teenage_students': [1, 0], 'set_total_annual_income_limits': [0, 200000]}],
+            QueryBuilder.teenage_student_criteria
+        ),
+        GrantRule(
+            'Multigeneration Scheme',
+            [
+                {'set_limits_num_adults': [1, 0], 'set_limits_num_elders': [1, 0], 'set_total_annual_income_limits': [0, 150000]},
+                {'set_limits_num_children': [1, 0], 'set_limits_num_elders': [1, 0], 'set_total_annual_income_limits': [0, 150000]},
+            ]
+        ),
+        GrantRule(
+            'Elder Bonus',
+            [{'set_limits_num_elders': [1, 0], 'set_household_types': ['HDB']}],
+            QueryBuilder.elder_criteria
+        ),
+        GrantRule(
+            'Baby Sunshine Grant',
+            [{'set_limits_num_babies': [1, 0]}],
+            QueryBuilder.baby_criteria
+        ),
+        GrantRule(
+            'YOLO GST Grant',
+            [{'set_household_types': ['HDB'], 'set_total_annual_income_limits': [0, 200000]}]
+        ),
+    ])
+
+    @staticmethod
+    def get(name):
+        rule = GrantRules.RULES.get(name)
+        if rule is None:
+            raise ValueError(f'Invalid grant type: {name}')
+        return rule
+
+    @staticmethod
+    def names():
+        return list(GrantRules.RULES)
+
+    # All Grants Evaluation
+
+    @staticmethod
+    def households_query():
+        # Households eligible for any grant, judged from their household_stats and stored income
+        from grants.helpers.stats import HouseholdStatsMaintainer
+
+        HouseholdStatsMaintainer.rollover()
+        aggregates = QueryBuilder.stored_aggregate_columns()
+        return Household.query.outerjoin(HouseholdStats, HouseholdStats.household_id == Household.id) \
+            .filter(or_(*[rule.household_criteria(aggregates) for rule in GrantRules.RULES.values()]))
+
+    @staticmethod
+    def members_statement(household_ids):
+        # Members of the given households, with a flag per grant for whether they qualify for it. Computed in one pass over the
+        # households' stats and members, instead of one query per grant
+        aggregates = QueryBuilder.stored_aggregate_columns()
+        flags = []
+        for index, rule in enumerate(GrantRules.RULES.values()):
+            member_criteria = rule.member_criteria()
+            qualifies = and_(rule.household_criteria(aggregates), member_criteria if member_criteria is not None else true())
+            flags.append(case((qualifies, 1), else_=0).label(f'grant_{index}'))
+
+        return select([Person] + flags).select_from(Household) \
+            .join(Person, Person.household_id == Household.id) \
+            .outerjoin(HouseholdStats, HouseholdStats.household_id == Household.id) \
+            .where(Household.id.in_(household_ids)).order_by(Person.household_id, Person.id)
+
+    @staticmethod
+    def qualifying_members(households):
+        # Household ID => {grant: [qualifying members]} for the given households
+        rules = list(GrantRules.RULES.values())
+        members = {household.id: {rule.name: [] for rule in rules} for household in households}
+        for start in range(0, len(households), QueryBuilder.MEMBER_BATCH_SIZE):
+            household_ids = [household.id for household in households[start:start + QueryBuilder.MEMBER_BATCH_SIZE]]
+            for row in db.session.execute(GrantRules.members_statement(household_ids)):
+                person = row.Person
+                for index, rule in enumerate(rules):
+                    if getattr(row, f'grant_{index}'):
+                        members[person.household_id][rule.name].append(person)
+        return members
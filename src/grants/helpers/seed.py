@@ -0,0 +1,169 @@
+import click
+import time
+from datetime import date, timedelta
+from random import Random
+from flask.cli import with_appcontext
+from sqlalchemy import func
+from grants import db
+from grants.models import Household, Person
+from grants.helpers.stats import HouseholdStatsMaintainer
+from grants.helpers.names import PersonNameIndex
+from grants.helpers.storage import StorageProfiles
+
+
+class DatasetSeeder():
+    # Generates realistic households from a fixed seed, with the same kinds of families as the test fixtures (married couples with
+    # teenage students or babies, multigeneration households with elders, single elders and adults), and writes them in batches
+    # Note: Dates of birth are relative to today, so a seed always gives the same people at the same ages
+    HOUSING_TYPES = ['HDB', 'HDB', 'HDB', 'Condominium', 'Landed']
+    MALE_NAMES = ['Ahmad', 'Benjamin', 'Chen Wei', 'Daniel', 'Ethan', 'Faisal', 'Gabriel', 'Harish', 'Isaac', 'Jun Jie', 'Kumar', 'Lucas',
+                  'Muhammad', 'Nathan', 'Omar', 'Prakash', 'Ryan', 'Samuel', 'Wei Ming', 'Zhi Hao']
+    FEMALE_NAMES = ['Aisha', 'Bernice', 'Chloe', 'Divya', 'Emily', 'Farah', 'Grace', 'Hui Min', 'Isabelle', 'Jia Hui', 'Kavitha', 'Li Ting',
+                    'Mei Ling', 'Nur', 'Priya', 'Rachel', 'Siti', 'Sophia', 'Xin Yi', 'Zara']
+    FAMILY_NAMES = ['Abdullah', 'Chua', 'Fernandez', 'Goh', 'Ismail', 'Koh', 'Kumar', 'Lee', 'Lim', 'Menon', 'Ng', 'Ong', 'Pillai', 'Rahman',
+                    'Tan', 'Teo', 'Wong', 'Yeo']
+
+    # Ages in days, within the ages given by the builders' baby(), teenager(), adult() and elder()
+    AGE_RANGES = {
+        'baby': (30, 220),
+        'teenager': (10 * 366, 16 * 365 - 30),
+        'adult': (19 * 366, 55 * 365 - 30),
+        'elder': (57 * 366, 99 * 365),
+    }
+
+    PERSON_COLUMNS = ['id', 'name', 'gender', 'marital_status', 'spouse_id', 'occupation_type', 'annual_income', 'date_of_birth', 'household_id']
+
+    def __init__(self, seed=0, batch_size=50000):
+        self.random = Random(seed)
+        self.batch_size = batch_size
+        self.today = date.today()
+
+        # (weight, method) of each kind of household
+        household_kinds = [
+            (4, self.couple_with_students),
+            (2, self.couple_with_babies),
+            (3, self.multigeneration),
+            (2, self.single_elder),
+            (2, self.single_adult),
+            (1, self.shared_adults),
+        ]
+        self.household_weights = [weight for weight, _ in household_kinds]
+        self.household_kinds = [kind for _, kind in household_kinds]
+
+    def seed(self, num_people):
+        # Writes at least num_people people (completing the last household). Returns the number of households and people written
+        StorageProfiles.lock_for_write(db.session.connection())
+        last_household_id = db.session.query(func.max(Household.id)).scalar() or 0
+        last_person_id = db.session.query(func.max(Person.id)).scalar() or 0
+        household_id, person_id = last_household_id, last_person_id
+
+        # Note: Everything is written in one transaction, so other connections never see the indexes or the name index trigger missing.
+        # Indexes are only rebuilt when more people are added than exist, as rebuilding them costs as much as the whole table
+        connection = db.session.connection()
+        rebuilt_indexes = DatasetSeeder.secondary_indexes() if num_people > db.session.query(func.count(Person.id)).scalar() else []
+        for index in rebuilt_indexes:
+            index.drop(connection)
+        PersonNameIndex.drop_insert_trigger(connection)
+
+        household_rows, person_rows = [], []
+        while person_id - last_person_id < num_people:
+            household_id += 1
+            household_rows.append((household_id, self.random.choice(DatasetSeeder.HOUSING_TYPES)))
+
+            # Note: Spouses are given by their index within the household, as member IDs are only allocated here
+            first_member_id = person_id + 1
+            for name, gender, marital_status, spouse_index, occupation_type, annual_income, age_in_days in self.household_members():
+                person_id += 1
+                spouse_id = None if spouse_index is None else first_member_id + spouse_index
+                date_of_birth = (self.today - timedelta(days=age_in_days)).isoformat()
+                person_rows.append((person_id, name, gender, marital_status, spouse_id, occupation_type, annual_income, date_of_birth, household_id))
+
+            if len(person_rows) >= self.batch_size:
+                DatasetSeeder.write(connection, household_rows, person_rows)
+                household_rows, person_rows = [], []
+        DatasetSeeder.write(connection, household_rows, person_rows)
+
+        for index in rebuilt_indexes:
+            index.create(connection)
+        PersonNameIndex.index_people(connection, last_person_id + 1)
+        # The stats, income and eligibility of the new households are computed once every batch has been written
+        HouseholdStatsMaintainer.refresh(range(last_household_id + 1, household_id + 1), connection)
+        db.session.commit()
+        return household_id - last_household_id, person_id - last_person_id
+
+    @staticmethod
+    def secondary_indexes():
+        return list(Household.__table__.indexes) + list(Person.__table__.indexes)
+
+    @staticmethod
+    def write(connection, household_rows, person_rows):
+        # Rows are already in column order, so they are passed straight to the driver's executemany
+        if household_rows:
+            connection.exec_driver_sql('INSERT INTO household (id, housing_type) VALUES (?, ?)', household_rows)
+        if person_rows:
+            columns = DatasetSeeder.PERSON_COLUMNS
+            connection.exec_driver_sql(f'INSERT INTO person ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})', person_rows)
+
+    # Households, as lists of (name, gender, marital status, spouse index, occupation type, annual income, age in days)
+
+    def household_members(self):
+        kind = self.random.choices(self.household_kinds, self.household_weights)[0]
+        return kind(self.random.choice(DatasetSeeder.FAMILY_NAMES))
+
+    def couple_with_students(self, family_name):
+        return self.couple(family_name, 0) + [
+            self.member(family_name, 'teenager', occupation_type='Student') for _ in range(self.random.randint(1, 3))
+        ]
+
+    def couple_with_babies(self, family_name):
+        members = self.couple(family_name, 0) + [self.member(family_name, 'baby') for _ in range(self.random.randint(1, 3))]
+        if self.random.random() < 0.3:
+            members.append(self.member(family_name, 'teenager'))
+        return members
+
+    def multigeneration(self, family_name):
+        members = [self.member(family_name, 'elder', marital_status=self.random.choice(['Widowed', 'Married'])) for _ in range(self.random.randint(1, 2))]
+        members += self.couple(family_name, len(members))
+        return members + [
+            self.member(family_name, 'teenager', occupation_type=self.random.choice(['Student', 'Unemployed'])) for _ in range(self.random.randint(0, 3))
+        ]
+
+    def single_elder(self, family_name):
+        occupation_type = 'Employed' if self.random.random() < 0.2 else 'Unemployed'
+        return [self.member(family_name, 'elder', occupation_type=occupation_type, marital_status=self.random.choice(['Single', 'Widowed', 'Divorced']))]
+
+    def single_adult(self, family_name):
+        return [self.member(family_name, 'adult', occupation_type='Employed', marital_status=self.random.choice(['Single', 'Separated', 'Divorced']))]
+
+    def shared_adults(self, family_name):
+        members = [self.member(family_name, 'elder')]
+        return members + [
+            self.member(family_name, 'adult', occupation_type=self.random.choice(['Employed', 'Unemployed', 'Student']),
+                        marital_status=self.random.choice(['Single', 'Separated']))
+            for _ in range(self.random.randint(2, 3))
+        ]
+
+    def couple(self, family_name, index):
+        # Husband and wife, at index and index + 1 of their household, married to each other
+        return [
+            self.member(family_name, 'adult', 'M', 'Employed', 'Married', index + 1),
+            self.member(family_name, 'adult', 'F', self.random.choice(['Employed', 'Employed', 'Unemployed']), 'Married', index),
+        ]
+
+    def member(self, family_name, age_band, gender=None, occupation_type='Unemployed', marital_status='Single', spouse_index=None):
+        gender = gender or self.random.choice('MF')
+        first_name = self.random.choice(DatasetSeeder.MALE_NAMES if gender == 'M' else DatasetSeeder.FEMALE_NAMES)
+        annual_income = float(self.random.randint(10, 150) * 1000) if occupation_type == 'Employed' else 0.0
+        age_in_days = self.random.randint(*DatasetSeeder.AGE_RANGES[age_band])
+        return f'{first_name} {family_name}', gender, marital_status, spouse_index, occupation_type, annual_income, age_in_days
+
+
+@click.command('seed-db')
+@click.option('--people', type=click.IntRange(min=1), default=10000, help='Number of people to add, in new households')
+@click.option('--seed', type=int, default=0, help='Random seed. The same seed always generates the same households')
+@click.option('--batch-size', type=click.IntRange(min=1), default=50000, help='People written per batch of inserts')
+@with_appcontext
+def seed_db_command(people, seed, batch_size):
+    start = time.perf_counter()
+    num_households, num_people = DatasetSeeder(seed, batch_size).seed(people)
+    click.echo(f'Seeded {num_people} people in {num_households} households in {time.perf_counter() - start:.2f}s')
@@ -0,0 +1,122 @@
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import func, select
+from grants.models import Household, Person
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def format_date(value):
+    # Note: Same output as strftime('%Y-%m-%d'), without parsing a format string for every date
+    return value.isoformat()
+
+
+class HouseholdSerializer():
+    # Precomputed projection of Household.to_json / Person.to_json, so that excluded fields are never read or built
+    # Field key => model attribute
+    HOUSEHOLD_FIELDS = [('ID', 'id'), ('HouseholdType', 'housing_type')]
+    PERSON_FIELDS = [
+        ('ID', 'id'), ('Name', 'name'), ('Gender', 'gender'), ('MaritalStatus', 'marital_status'), ('Spouse', 'spouse_id'),
+        ('OccupationType', 'occupation_type'), ('AnnualIncome', 'annual_income'), ('DOB', 'date_of_birth'),
+    ]
+    # Field key => formatter of its value
+    FORMATTERS = {'DOB': format_date}
+
+    def __init__(self, excludes=[], family_excludes=[]):
+        self.household_fields = [(key, attribute) for key, attribute in HouseholdSerializer.HOUSEHOLD_FIELDS if key not in excludes]
+        self.person_fields = [(key, attribute) for key, attribute in HouseholdSerializer.PERSON_FIELDS if key not in family_excludes]
+        self.person_formatters = [(key, formatter) for key, formatter in HouseholdSerializer.FORMATTERS.items() if key not in family_excludes]
+        self.include_family_members = 'Family Members' not in excludes
+
+    def household(self, household, family_members):
+        data = HouseholdSerializer.project(household, self.household_fields)
+        if self.include_family_members:
+            person = self.person
+            data['Family Members'] = [person(family_member) for family_member in family_members]
+        return data
+
+    def person(self, person):
+        data = HouseholdSerializer.project(person, self.person_fields)
+        for key, formatter in self.person_formatters:
+            data[key] = formatter(data[key])
+        return data
+
+    def documents_query(self, query, member_criteria=None):
+        # Household query => query of (id, document) rows, where document is the household's JSON built by SQLite, so that no
+        # household or person is loaded into Python. Keys are sorted like the JSON provider, and dates are already stored as ISO strings
+        # Note: json() keeps the family members array as JSON (rather than a string) when it is returned from the subquery
+        member_fields = sorted(self.person_fields)
+        members = select([getattr(Person, attribute).label(key) for key, attribute in member_fields]) \
+            .where(Person.household_id == Household.id).order_by(Person.id).correlate(Household)
+        if member_criteria is not None:
+            members = members.where(member_criteria)
+        members = members.subquery()
+
+        document_fields = [(key, getattr(Household, attribute)) for key, attribute in self.household_fields]
+        if self.include_family_members:
+            member_document = func.json_object(*[argument for key, _ in member_fields for argument in (key, members.c[key])])
+            family_members = select([func.json_group_array(member_document)]).select_from(members).scalar_subquery()
+            document_fields.append(('Family Members', func.json(family_members)))
+
+        document = func.json_object(*[argument for key, value in sorted(document_fields, key=lambda field: field[0]) for argument in (key, value)])
+        return query.with_entities(Household.id.label('id'), document.label('document'))
+
+    @staticmethod
+    def project(instance, fields):
+        # Note: Loaded column values are read straight from the instance's __dict__, which is much cheaper than going through the
+        # ORM's attribute descriptors. Expired or unloaded instances fall back to attribute access, which loads them
+        values = instance.__dict__
+        try:
+            return {key: values[attribute] for key, attribute in fields}
+        except KeyError:
+            return {key: getattr(instance, attribute) for key, attribute in fields}
+
+
+# Projections of each endpoint
+ALL_HOUSEHOLDS_SERIALIZER = HouseholdSerializer(excludes=['ID'])
+SEARCH_SERIALIZER = HouseholdSerializer(excludes=['ID'], family_excludes=['ID', 'Spouse'])
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    # Encodes responses with orjson, which is several times faster than the json module for large responses.
+    # Responses decode to the same values as DefaultJSONProvider's: keys are sorted, and dates and other types orjson does not handle
+    # the same way are passed to DefaultJSONProvider.default (e.g. dates are HTTP dates). Non-ASCII characters are not escaped.
+    # Note: dumps is always compact (unless debugging), where the json module separates items with ', '. It falls back to the json
+    # module when given any of its arguments
+    def options(self, compact=None):
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if compact is False or (compact is None and self._app.debug):
+            option |= orjson.OPT_INDENT_2
+        return option
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=self.options()).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=self.default, option=self.options(self.compact)), mimetype=self.mimetype)
+
+
+class JSONBackends():
+    @staticmethod
+    def provider_class(name):
+        # 'auto' uses orjson when it is installed
+        if name == 'auto':
+            name = 'orjson' if orjson is not None else 'json'
+
+        if name == 'json':
+            return DefaultJSONProvider
+        if name == 'orjson':
+            if orjson is None:
+                raise ValueError('JSON_BACKEND orjson requires the orjson package')
+            return OrjsonProvider
+        raise ValueError(f'Invalid JSON backend: {name}')
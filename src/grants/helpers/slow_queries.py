@@ -0,0 +1,97 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from logging.handlers import RotatingFileHandler
+from flask import has_request_context, request
+from sqlalchemy import event
+from grants import db
+
+# Statements that EXPLAIN QUERY PLAN can describe without running them
+EXPLAINABLE_STATEMENTS = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE')
+
+
+class SlowQueryLog():
+    # Opt-in (SLOW_QUERY_SECONDS) log of the statements that took longer than the threshold to execute, written as one JSON line per
+    # statement to a rotating log file, with their parameters, duration, the QueryBuilder filters or grant they were built for (from the
+    # query_origin execution option) and SQLite's EXPLAIN QUERY PLAN of them
+    # Note: The duration covers the execution of the statement by SQLite up to its first row, not fetching the remaining rows
+    logger = logging.getLogger('grants.slow_queries')
+
+    def __init__(self, threshold, path, max_bytes, backups):
+        self.threshold = threshold
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.lock = threading.Lock()
+        self.pid = None
+        self.handler = None
+
+    @staticmethod
+    def register(app):
+        slow_query_log = SlowQueryLog(
+            app.config['SLOW_QUERY_SECONDS'], app.config['SLOW_QUERY_LOG'], app.config['SLOW_QUERY_LOG_MAX_BYTES'], app.config['SLOW_QUERY_LOG_BACKUPS']
+        )
+        with app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', slow_query_log.before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', slow_query_log.after_cursor_execute)
+        event.listen(engine, 'handle_error', slow_query_log.handle_error)
+        return slow_query_log
+
+    # Note: Start times are kept by the statement's execution context, as a statement that raises never reaches after_cursor_execute
+    def before_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault('slow_query_start', {})[context] = time.perf_counter()
+
+    def after_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - connection.info['slow_query_start'].pop(context)
+        if duration < self.threshold:
+            return
+
+        # Note: Of an executemany, only the first set of parameters is logged and explained
+        if executemany:
+            parameters = parameters[0] if parameters else ()
+        entry = {
+            'duration_ms': round(duration * 1000, 2),
+            'sql': statement,
+            'parameters': parameters,
+            'origin': context.execution_options.get('query_origin') if context is not None else None,
+            'endpoint': request.endpoint if has_request_context() else None,
+            'plan': SlowQueryLog.explain(cursor.connection, statement, parameters),
+        }
+        # Note: Written straight to this app's handler, so that apps with different log files never write to each other's
+        record = SlowQueryLog.logger.makeRecord(SlowQueryLog.logger.name, logging.WARNING, __file__, 0, json.dumps(entry, default=str), None, None)
+        self.process_handler().handle(record)
+
+    def handle_error(self, exception_context):
+        if exception_context.connection is not None:
+            exception_context.connection.info.get('slow_query_start', {}).pop(exception_context.execution_context, None)
+
+    def process_handler(self):
+        # Handler of this process's log file, with any '{pid}' in the path replaced by the process ID.
+        # Note: A RotatingFileHandler can only rotate a file written by a single process, so each worker needs a file of its own. The
+        # handler is created by the process that first logs a statement, as gunicorn may fork its workers after the app was created
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.handler = RotatingFileHandler(self.path.replace('{pid}', str(self.pid)), maxBytes=self.max_bytes, backupCount=self.backups, delay=True)
+            return self.handler
+
+    @staticmethod
+    def explain(dbapi_connection, statement, parameters):
+        # Lines of the query plan, indented by their depth in the plan's tree.
+        # Note: Explained on a cursor of its own, so that the rows of the slow statement are left for its caller to fetch
+        if not statement.lstrip().upper().startswith(EXPLAINABLE_STATEMENTS):
+            return None
+        try:
+            rows = dbapi_connection.cursor().execute(f'EXPLAIN QUERY PLAN {statement}', parameters).fetchall()
+        except sqlite3.Error as e:
+            return [f'Could not explain the statement: {e}']
+
+        depths, lines = {0: -1}, []
+        for node_id, parent_id, _, detail in rows:
+            depths[node_id] = depths.get(parent_id, -1) + 1
+            lines.append('  ' * depths[node_id] + detail)
+        return lines
@@ -0,0 +1,126 @@
+import click
+from datetime import date
+from dateutil.relativedelta import relativedelta
+from flask.cli import with_appcontext
+from sqlalchemy import bindparam, event, func, or_, select
+from sqlalchemy.orm.util import identity_key
+from grants import db
+from grants.models import Household, Person, HouseholdStats, HouseholdStatsRollover
+from grants.helpers.utils import QueryBuilder, statement_cache
+from grants.helpers.eligibility import GrantEligibilityStore
+from grants.helpers.etags import DataVersionHelper
+from grants.helpers.columnar import ColumnarSearchEngine
+
+
+class HouseholdStatsMaintainer():
+    # Maximum number of households refreshed by a single statement
+    BATCH_SIZE = 500
+    ROLLOVER_ID = 1
+
+    # Ages at which a person moves into or out of one of the age bands counted in HouseholdStats
+    AGE_BAND_BOUNDARIES = [relativedelta(months=8), relativedelta(years=16), relativedelta(years=18), relativedelta(years=55)]
+
+    @staticmethod
+    def register():
+        if not event.contains(db.session, 'after_flush', HouseholdStatsMaintainer.after_flush):
+            event.listen(db.session, 'after_flush', HouseholdStatsMaintainer.after_flush)
+            event.listen(db.session, 'after_flush_postexec', HouseholdStatsMaintainer.after_flush_postexec)
+
+    @staticmethod
+    def after_flush(session, flush_context):
+        household_ids = set()
+        for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+            if isinstance(instance, Household):
+                household_ids.add(instance.id)
+            elif isinstance(instance, Person):
+                household_ids.add(instance.household_id)
+                # Members that moved household also change the counts of the household they left
+                household_ids.update(db.inspect(instance).attrs.household_id.history.deleted)
+
+        household_ids.discard(None)
+        if household_ids:
+            HouseholdStatsMaintainer.refresh(household_ids, session.connection())
+            # Note: Households are only expired after the flush, as pending households cannot be expired yet
+            session.info.setdefault('refreshed_household_ids', set()).update(household_ids)
+
+    @staticmethod
+    def after_flush_postexec(session, flush_context):
+        # The stored total annual income of refreshed households was updated without the ORM, so it is reloaded when next read
+        for household_id in session.info.pop('refreshed_household_ids', ()):
+            household = session.identity_map.get(identity_key(Household, household_id))
+            if household is not None:
+                session.expire(household, ['total_annual_income'])
+
+    @staticmethod
+    def refresh(household_ids, connection):
+        # Recomputes the stats, total annual income and grant eligibility of the given households from their members
+        # Note: Households that no longer exist lose their stats row
+        statements = statement_cache.get(('household_stats_refresh',), HouseholdStatsMaintainer.build_refresh_statements)
+
+        household_ids = sorted(household_ids)
+        for start in range(0, len(household_ids), HouseholdStatsMaintainer.BATCH_SIZE):
+            batch = household_ids[start:start + HouseholdStatsMaintainer.BATCH_SIZE]
+            for statement in statements:
+                connection.execute(statement, {'household_ids': batch})
+
+        GrantEligibilityStore.refresh(household_ids, connection)
+        ColumnarSearchEngine.record_refresh(household_ids, connection)
+        # Note: Every write to households and their members passes through here, so it is also where the data version changes
+        if household_ids:
+            DataVersionHelper.bump(connection)
+
+    @staticmethod
+    def build_refresh_statements():
+        table = HouseholdStats.__table__
+        aggregates = QueryBuilder.household_aggregate_columns()
+        total_annual_income = aggregates.pop('total_annual_income')
+
+        stats_query = select(
+            [Household.id.label('household_id')] + [func.coalesce(column, 0).label(name) for name, column in aggregates.items()]
+        ).select_from(Household).outerjoin(Person, Person.household_id == Household.id) \
+            .where(Household.id.in_(bindparam('household_ids', expanding=True))).group_by(Household.id)
+
+        delete_statement = table.delete().where(table.c.household_id.in_(bindparam('household_ids', expanding=True)))
+        insert_statement = table.insert().from_select(['household_id'] + list(aggregates), stats_query)
+
+        household_table = Household.__table__
+        income_query = select([func.coalesce(total_annual_income, 0)]).where(Person.household_id == household_table.c.id).scalar_subquery()
+        income_statement = household_table.update().where(household_table.c.id.in_(bindparam('household_ids', expanding=True))) \
+            .values(total_annual_income=income_query)
+        return delete_statement, insert_statement, income_statement
+
+    @staticmethod
+    def rollover():
+        # Brings the age band counts up to date with today's date. Returns None when they are already current
+        today = date.today()
+        rollover = db.session.get(HouseholdStatsRollover, HouseholdStatsMaintainer.ROLLOVER_ID)
+        if rollover is not None and rollover.rolled_over_on == today:
+            return None
+
+        if rollover is None or rollover.rolled_over_on > today:
+            household_ids = [row.id for row in db.session.query(Household.id)]
+        else:
+            household_ids = HouseholdStatsMaintainer.households_crossing_age_bands(rollover.rolled_over_on, today)
+
+        HouseholdStatsMaintainer.refresh(household_ids, db.session.connection())
+        db.session.merge(HouseholdStatsRollover(id=HouseholdStatsMaintainer.ROLLOVER_ID, rolled_over_on=today))
+        db.session.commit()
+        return len(household_ids)
+
+    @staticmethod
+    def households_crossing_age_bands(since, until):
+        # Only members born within a band boundary of the days since the last rollover can have changed age band
+        born_on_boundary = [
+            Person.date_of_birth.between(since - boundary, until - boundary) for boundary in HouseholdStatsMaintainer.AGE_BAND_BOUNDARIES
+        ]
+        return [row.household_id for row in db.session.query(Person.household_id).filter(or_(*born_on_boundary)).distinct()]
+
+
+@click.command('rollover-household-stats')
+@with_appcontext
+def rollover_household_stats_command():
+    num_households = HouseholdStatsMaintainer.rollover()
+    if num_households is None:
+        click.echo('Household stats are already up to date')
+    else:
+        click.echo(f'Refreshed the stats of {num_households} households')
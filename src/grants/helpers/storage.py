@@ -0,0 +1,90 @@
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+
+class StorageProfiles():
+    # Named SQLite settings. Pragmas are applied to every new connection, pool settings to the engine
+    PROFILES = {
+        # SQLite defaults (rollback journal, one connection per checkout). Suitable for tests and a single worker
+        'default': {
+            'pragmas': {},
+            'busy_timeout': None,
+            'pool_size': None,
+            'max_overflow': None,
+        },
+        # Several gunicorn workers: readers do not block the writer, and writers wait for each other instead of failing
+        'concurrent': {
+            'pragmas': {
+                'journal_mode': 'WAL',
+                'synchronous': 'NORMAL',
+                'mmap_size': 268435456,
+                'cache_size': -65536,
+                'temp_store': 'MEMORY',
+            },
+            'busy_timeout': 5000,
+            'pool_size': 5,
+            'max_overflow': 10,
+        },
+        # Mostly searches and exports over a large database: more of it is kept in memory
+        'read_heavy': {
+            'pragmas': {
+                'journal_mode': 'WAL',
+                'synchronous': 'NORMAL',
+                'mmap_size': 1073741824,
+                'cache_size': -262144,
+                'temp_store': 'MEMORY',
+            },
+            'busy_timeout': 5000,
+            'pool_size': 10,
+            'max_overflow': 20,
+        },
+        # As concurrent, but every commit is synced to disk before it returns
+        'durable': {
+            'pragmas': {
+                'journal_mode': 'WAL',
+                'synchronous': 'FULL',
+                'cache_size': -65536,
+            },
+            'busy_timeout': 10000,
+            'pool_size': 5,
+            'max_overflow': 10,
+        },
+    }
+
+    @staticmethod
+    def get(name):
+        profile = StorageProfiles.PROFILES.get(name)
+        if profile is None:
+            raise ValueError(f'Invalid storage profile: {name}')
+        return profile
+
+    @staticmethod
+    def engine_options(name):
+        profile = StorageProfiles.get(name)
+        options = {}
+        if profile['busy_timeout'] is not None:
+            # Note: pysqlite waits up to timeout seconds for a lock, which sets SQLite's busy timeout
+            options['connect_args'] = {'timeout': profile['busy_timeout'] / 1000, 'check_same_thread': False}
+        if profile['pool_size'] is not None:
+            options.update(poolclass=QueuePool, pool_size=profile['pool_size'], max_overflow=profile['max_overflow'])
+        return options
+
+    @staticmethod
+    def register(engine, name):
+        pragmas = StorageProfiles.get(name)['pragmas']
+        if not pragmas:
+            return
+
+        @event.listens_for(engine, 'connect')
+        def apply_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for pragma, value in pragmas.items():
+                cursor.execute(f'PRAGMA {pragma} = {value}')
+            cursor.close()
+
+    @staticmethod
+    def lock_for_write(connection):
+        # Takes SQLite's write lock before IDs are read to be allocated (e.g. max(id) + 1), so that concurrent writers allocate them in turn
+        # Note: pysqlite only begins a transaction before its first write, after which the write lock is already held
+        if not connection.connection.in_transaction:
+            connection.exec_driver_sql('BEGIN IMMEDIATE')
@@ -1,12 +1,20 @@
-from grants.models import Household, Person
-from sqlalchemy import or_, func, and_
+from grants import db
+from grants.models import Household, Person, HouseholdStats
+from grants.helpers.names import PersonNameIndex
+from grants.helpers.serializers import SEARCH_SERIALIZER
+from sqlalchemy import or_, and_, bindparam, case, func, select, true
+from sqlalchemy.types import Date
+from collections import OrderedDict
 from datetime import date
 from dateutil.relativedelta import relativedelta
 from functools import reduce
-from sqlalchemy.orm import contains_eager
+from threading import Lock
 
 
 class QueryBuilder():
+    # Maximum number of households whose members are loaded by a single query
+    MEMBER_BATCH_SIZE = 500
+
     def __init__(self):
         # Dictionary of values to lists
         self.query = Household.query
@@ -109,7 +117,141 @@ class QueryBuilder():
         return self
 
     def generate_query(self):
-        # Construct query with every param, then run it and return the result
+        # Household counts are read from the indexed household_stats columns, which HouseholdStatsMaintainer keeps up to date
+        from grants.helpers.stats import HouseholdStatsMaintainer
+
+        if self.aggregate_limits():
+            HouseholdStatsMaintainer.rollover()
+        query = statement_cache.get(('stats',) + self.shape(), self.build_stats_query)
+        return query.with_session(db.session()).params(**self.params()).execution_options(query_origin=self.origin())
+
+    def generate_aggregate_query(self):
+        query = statement_cache.get(('aggregate',) + self.shape(), self.build_aggregate_query)
+        return query.with_session(db.session()).params(**self.params()).execution_options(query_origin=self.origin())
+
+    def build_stats_query(self):
+        query = self.build_household_query()
+
+        constraints = self.aggregate_constraints(QueryBuilder.stored_aggregate_columns())
+        if constraints:
+            # Note: Households without members are excluded, since the legacy query only grouped households that had members
+            query = query.join(HouseholdStats, HouseholdStats.household_id == Household.id) \
+                .filter(HouseholdStats.num_family_members >= 1, *constraints)
+        return query
+
+    def build_aggregate_query(self):
+        # Every household count is computed by a single GROUP BY pass over person, with all the limits applied in one HAVING
+        query = self.build_household_query()
+
+        constraints = self.aggregate_constraints(QueryBuilder.household_aggregate_columns())
+        if constraints:
+            aggregates = select([Person.household_id.label('household_id')]) \
+                .group_by(Person.household_id).having(and_(*constraints)).subquery()
+            query = query.join(aggregates, aggregates.c.household_id == Household.id)
+        return query
+
+    def build_household_query(self):
+        query = Household.query
+
+        if self.household_types:
+            query = query.filter(Household.housing_type.in_(bindparam('household_types', expanding=True)))
+
+        if self.family_member_names:
+            query = query.filter(PersonNameIndex.households_matching(
+                [bindparam(f'family_member_name_{index}') for index in range(len(self.family_member_names))]
+            ))
+        return query
+
+    @staticmethod
+    def from_params(params):
+        # {setter: value} => QueryBuilder, e.g. {'set_household_types': ['HDB']}
+        query_builder = QueryBuilder()
+        for setter, value in params.items():
+            getattr(query_builder, setter)(value)
+        return query_builder
+
+    def household_criteria(self, aggregates):
+        # This search as a boolean expression over the given household aggregate columns, with its values inlined, so that the
+        # criteria of several searches can be combined in one statement
+        criteria = []
+        if self.household_types:
+            criteria.append(Household.housing_type.in_(list(self.household_types)))
+        if self.family_member_names:
+            criteria.append(PersonNameIndex.households_matching([f'%{name}%' for name in self.family_member_names]))
+
+        limits = self.aggregate_limits()
+        if limits:
+            # Note: Households without members are excluded, as with the other engines
+            criteria.append(aggregates['num_family_members'] >= 1)
+        for name, (min_num, max_num) in limits.items():
+            criteria.append(aggregates[name] >= min_num)
+            if max_num is not None:
+                criteria.append(aggregates[name] <= max_num)
+        return and_(true(), *criteria)
+
+    def aggregate_constraints(self, aggregates):
+        constraints = []
+        for name, (min_num, max_num) in self.aggregate_limits().items():
+            constraints.append(aggregates[name] >= bindparam(f'min_{name}'))
+            if max_num is not None:
+                constraints.append(aggregates[name] <= bindparam(f'max_{name}'))
+        return constraints
+
+    def aggregate_limits(self):
+        # Household count => (min, max) for every count that is limited. A max of None is unbounded
+        limits = {}
+
+        if self.num_family_members_flag:
+            limits['num_family_members'] = (self.min_num_family_members, self.max_num_family_members)
+
+        # Note: The minimum of each age band is at least 1, since the legacy query only grouped households that had a member in the band
+        band_limits = [
+            ('num_adults', self.num_adults_flag, self.min_num_adults, self.max_num_adults),
+            ('num_elders', self.num_elders_flag, self.min_num_elders, self.max_num_elders),
+            ('num_teenage_students', self.num_teenage_students_flag, self.min_num_teenage_students, self.max_num_teenage_students),
+            ('num_children', self.num_children_flag, self.min_num_children, self.max_num_children),
+            ('num_babies', self.num_babies_flag, self.min_num_babies, self.max_num_babies),
+        ]
+        for name, flag, min_num, max_num in band_limits:
+            if flag:
+                limits[name] = (max(int(min_num), 1), int(max_num))
+
+        if self.total_annual_income_flag:
+            max_income = self.max_total_annual_income if self.max_total_annual_income != float('inf') else None
+            limits['total_annual_income'] = (self.min_total_annual_income, max_income)
+        return limits
+
+    def shape(self):
+        # Searches with the same shape generate the same statement, differing only in the values of its bound parameters
+        limits = self.aggregate_limits()
+        return (bool(self.household_types), len(self.family_member_names)) + \
+            tuple(sorted((name, max_num is not None) for name, (_, max_num) in limits.items()))
+
+    def params(self):
+        params = {}
+        if self.household_types:
+            params['household_types'] = list(self.household_types)
+        for index, name in enumerate(self.family_member_names):
+            params[f'family_member_name_{index}'] = f'%{name}%'
+        for name, (min_num, max_num) in self.aggregate_limits().items():
+            params[f'min_{name}'] = min_num
+            if max_num is not None:
+                params[f'max_{name}'] = max_num
+        return params
+
+    def origin(self):
+        # Filters of the search, which statements built from it are tagged with (e.g. for the slow query log)
+        origin = {}
+        if self.household_types:
+            origin['household_types'] = list(self.household_types)
+        if self.family_member_names:
+            origin['family_member_names'] = list(self.family_member_names)
+        for name, (min_num, max_num) in self.aggregate_limits().items():
+            origin[name] = [min_num, max_num]
+        return {'filters': origin}
+
+    def generate_legacy_query(self):
+        # Previous query engine, which joins together a separately grouped subquery per param. Kept as a reference for tests and benchmarks
         subqueries = []
 
         if self.household_types:
@@ -121,7 +263,7 @@ class QueryBuilder():
                 lambda name: Household.family_members.any(Person.name.like(f'%{name}%')),
                 self.family_member_names
             )
-            subquery = Household.query.join(Household.family_members).filter(names_queries)
+            subquery = Household.query.filter(names_queries)
             subqueries.append(subquery)
 
         if self.num_family_members_flag:
@@ -156,9 +298,10 @@ class QueryBuilder():
             subqueries.append(subquery)
 
         if self.total_annual_income_flag:
+            total_annual_income = select([func.sum(Person.annual_income)]).where(Person.household_id == Household.id).scalar_subquery()
             subquery = Household.query.filter(
-                (Household.total_annual_income >= int(self.min_total_annual_income)) &
-                (Household.total_annual_income <= int(self.max_total_annual_income))
+                (total_annual_income >= int(self.min_total_annual_income)) &
+                (total_annual_income <= int(self.max_total_annual_income))
             )
             subqueries.append(subquery)
 
@@ -176,14 +319,113 @@ class QueryBuilder():
 
         if subqueries:
             return QueryBuilder.combine_queries(subqueries)
-        return Household.query.all()
+        return Household.query
 
-    def run(self, grant=None):
+    def final_query(self, grant=None):
         if grant:
-            final_query = QueryBuilder.process_grants(grant=grant)
-        else:
-            final_query = self.generate_query()
-        return [household.to_json(excludes=['ID'], family_excludes=['ID', 'Spouse']) for household in final_query]
+            return QueryBuilder.process_grants(grant=grant)
+        return self.generate_query()
+
+    def run(self, grant=None, after_id=None, limit=None):
+        households = QueryBuilder.paginate(self.final_query(grant=grant), after_id, limit).all()
+        member_criteria = QueryBuilder.grant_member_criteria(grant)
+        return list(QueryBuilder.serialize_households(households, QueryBuilder.household_to_json, member_criteria))
+
+    @staticmethod
+    def household_to_json(household, family_members):
+        return SEARCH_SERIALIZER.household(household, family_members)
+
+    @staticmethod
+    def serialize_households(households, serialize, member_criteria=None):
+        family_members = QueryBuilder.load_family_members(households, member_criteria)
+        for household in households:
+            yield serialize(household, family_members[household.id])
+
+    @staticmethod
+    def load_family_members(households, member_criteria=None):
+        # Loads members with one query per MEMBER_BATCH_SIZE households, instead of one lazy load per household
+        household_ids = [household.id for household in households]
+        family_members = {household_id: [] for household_id in household_ids}
+
+        for start in range(0, len(household_ids), QueryBuilder.MEMBER_BATCH_SIZE):
+            query = Person.query.filter(Person.household_id.in_(household_ids[start:start + QueryBuilder.MEMBER_BATCH_SIZE]))
+            if member_criteria is not None:
+                query = query.filter(member_criteria)
+            for person in query.order_by(Person.id):
+                family_members[person.household_id].append(person)
+        return family_members
+
+    @staticmethod
+    def paginate(query, after_id=None, limit=None):
+        # Keyset pagination on the household primary key, so that every page is an index range scan regardless of its depth
+        if after_id is not None:
+            query = query.filter(Household.id > after_id)
+        query = query.order_by(Household.id)
+        if limit is not None:
+            query = query.limit(limit)
+        return query
+
+    @staticmethod
+    def iter_chunks(query, after_id=None, limit=None, chunk_size=1000, paginate=None):
+        # Yields lists of at most chunk_size households, so that only one chunk is ever held in memory. Pages are taken with paginate
+        # (default: QueryBuilder.paginate), given the query, after_id and limit
+        paginate = paginate or QueryBuilder.paginate
+        remaining = limit
+        while remaining is None or remaining > 0:
+            size = chunk_size if remaining is None else min(chunk_size, remaining)
+            chunk = paginate(query, after_id, size).all()
+            if chunk:
+                yield chunk
+
+            if len(chunk) < size:
+                return
+            after_id = chunk[-1].id
+            if remaining is not None:
+                remaining -= len(chunk)
+
+    @staticmethod
+    def household_aggregate_columns():
+        def count_where(criteria):
+            return func.sum(case((criteria, 1), else_=0))
+
+        return {
+            'num_family_members': func.count(Person.id),
+            'num_adults': count_where(QueryBuilder.adult_criteria()),
+            'num_elders': count_where(QueryBuilder.elder_criteria()),
+            'num_teenage_students': count_where(QueryBuilder.teenage_student_criteria()),
+            'num_children': count_where(QueryBuilder.child_criteria()),
+            'num_babies': count_where(QueryBuilder.baby_criteria()),
+            'total_annual_income': func.sum(Person.annual_income),
+        }
+
+    @staticmethod
+    def stored_aggregate_columns():
+        # Columns holding the maintained value of each household aggregate
+        columns = {name: getattr(HouseholdStats, name) for name in QueryBuilder.household_aggregate_columns() if name != 'total_annual_income'}
+        columns['total_annual_income'] = Household.total_annual_income
+        return columns
+
+    # Age Band Criteria
+
+    @staticmethod
+    def adult_criteria():
+        return (Person.date_of_birth <= DateHelper.date_years_ago_param(18)) & (Person.date_of_birth >= DateHelper.date_years_ago_param(55))
+
+    @staticmethod
+    def elder_criteria():
+        return Person.date_of_birth < DateHelper.date_years_ago_param(55)
+
+    @staticmethod
+    def teenage_student_criteria():
+        return (Person.date_of_birth >= DateHelper.date_years_ago_param(16)) & (Person.occupation_type == 'Student')
+
+    @staticmethod
+    def child_criteria():
+        return Person.date_of_birth > DateHelper.date_years_ago_param(18)
+
+    @staticmethod
+    def baby_criteria():
+        return Person.date_of_birth > DateHelper.date_months_ago_param(8)
 
     @staticmethod
     def generate_or_query(query_function, items):
@@ -210,52 +452,32 @@ class QueryBuilder():
         return reduced_query
 
     @staticmethod
-    def process_grants(grant):
-        if grant == 'Student Encouragement Bonus':
-            query = QueryBuilder().set_limits_num_teenage_students([1, 0]).set_total_annual_income_limits([0, 200000]).generate_query()
-
-            constraint = Household.query.outerjoin(Person, and_(
-                Person.household_id == Household.id,
-                (Person.date_of_birth >= DateHelper.date_years_ago(16)) & (Person.occupation_type == 'Student')
-            )).options(contains_eager(Household.family_members))
-
-            final_query = QueryBuilder.query_reducer(query, constraint)
-        elif grant == 'YOLO GST Grant':
-            query = QueryBuilder().set_household_types(['HDB']).set_total_annual_income_limits([0, 200000]).generate_query()
-            constraint = None  # Explicitly set to none for clarity that this grant does not have a constraint
-
-            final_query = query
-        elif grant == 'Baby Sunshine Grant':
-            query = QueryBuilder().set_limits_num_babies([1, 0]).generate_query()
-
-            constraint = Household.query.outerjoin(Person, and_(
-                Person.household_id == Household.id,
-                Person.date_of_birth > DateHelper.date_months_ago(8)
-            )).options(contains_eager(Household.family_members))
-
-            final_query = QueryBuilder.query_reducer(query, constraint)
-        elif grant == 'Elder Bonus':
-            query = QueryBuilder().set_limits_num_elders([1, 0]).set_household_types(['HDB']).generate_query()
-
-            constraint = Household.query.outerjoin(Person, and_(
-                Person.household_id == Household.id,
-                Person.date_of_birth < DateHelper.date_years_ago(55)
-            )).options(contains_eager(Household.family_members))
-
-            final_query = QueryBuilder.query_reducer(query, constraint)
-        elif grant == 'Multigeneration Scheme':
-            query1 = QueryBuilder().set_limits_num_adults([1, 0]).set_limits_num_elders([1, 0]) \
-                .set_total_annual_income_limits([0, 150000]).generate_query()
-            query2 = QueryBuilder().set_limits_num_children([1, 0]).set_limits_num_elders([1, 0]) \
-                .set_total_annual_income_limits([0, 150000]).generate_query()
-            unioned_query = query1.union(query2)
-            constraint = None
-
-            final_query = unioned_query
-        if constraint:
-            # TODO: Investigate why this line causes the SQL Logic to fail when removed.
-            constraint = (list(constraint))
-        return final_query
+    def valid_grant_types():
+        from grants.helpers.rules import GrantRules
+        return set(GrantRules.names())
+
+    @staticmethod
+    def process_grants(grant, aggregate=False):
+        # aggregate computes the household counts from person rows instead of reading them from household_stats
+        queries = [
+            query_builder.generate_aggregate_query() if aggregate else query_builder.generate_query()
+            for query_builder in QueryBuilder.grant_query_builders(grant)
+        ]
+        return reduce(lambda query1, query2: query1.union(query2), queries).execution_options(query_origin={'grant': grant})
+
+    @staticmethod
+    def grant_query_builders(grant):
+        # A household is eligible for a grant if it matches any of the returned searches
+        from grants.helpers.rules import GrantRules
+        return GrantRules.get(grant).query_builders()
+
+    @staticmethod
+    def grant_member_criteria(grant):
+        # Criteria for the qualifying members of a grant. None indicates that every member of the household qualifies
+        from grants.helpers.rules import GrantRules
+        if grant not in GrantRules.RULES:
+            return None
+        return GrantRules.get(grant).member_criteria()
 
 
 class DateHelper():
@@ -268,6 +490,15 @@ class DateHelper():
     def date_months_ago(months):
         return date.today() - relativedelta(months=months)
 
+    # Note: The value of these params is evaluated every time the statement is executed, so cached statements always use today's date
+    @staticmethod
+    def date_years_ago_param(years):
+        return bindparam(f'date_{years}_years_ago', callable_=lambda: DateHelper.date_years_ago(years), type_=Date())
+
+    @staticmethod
+    def date_months_ago_param(months):
+        return bindparam(f'date_{months}_months_ago', callable_=lambda: DateHelper.date_months_ago(months), type_=Date())
+
     @staticmethod
     def age_from_dob(date_of_birth):
         age = relativedelta(date.today(), date_of_birth)
@@ -275,3 +506,41 @@ class DateHelper():
             'years': age.years,
             'months': age.months
         }
+
+
+class StatementCache():
+    # Caches built statements by their shape, so that each shape is only constructed (and compiled by SQLAlchemy) once
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.statements = OrderedDict()
+        self.lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build):
+        with self.lock:
+            statement = self.statements.get(key)
+            if statement is not None:
+                self.hits += 1
+                self.statements.move_to_end(key)
+                return statement
+            self.misses += 1
+
+        statement = build()
+        with self.lock:
+            self.statements[key] = statement
+            if len(self.statements) > self.max_size:
+                self.statements.popitem(last=False)
+        return statement
+
+    def to_json(self):
+        with self.lock:
+            return {
+                'Hits': self.hits,
+                'Misses': self.misses,
+                'Size': len(self.statements)
+            }
+
+
+statement_cache = StatementCache()
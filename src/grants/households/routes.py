@@ -1,10 +1,36 @@
-from flask import Blueprint, request
+from flask import Blueprint, Response, current_app, g, make_response, request, stream_with_context
 from grants.models import Household, Person
 from grants import db
-from grants.helpers.utils import QueryBuilder
+from grants.helpers.utils import QueryBuilder, statement_cache
+from grants.helpers.bulk import HouseholdImporter, FamilyMemberImporter
+from grants.helpers.eligibility import GrantEligibilityStore
+from grants.helpers.etags import DataVersionHelper
+from grants.helpers.serializers import ALL_HOUSEHOLDS_SERIALIZER, SEARCH_SERIALIZER
+from grants.helpers.rules import GrantRules
+from grants.helpers.export import DisbursementExporter
+from grants.helpers.columnar import ColumnarSearchEngine, HouseholdIds
 
 households = Blueprint('households', __name__)
 
+# Endpoints whose responses only change with the data version, and so support conditional requests through ETags
+CONDITIONAL_ENDPOINTS = {
+    'households.all_households', 'households.search_households', 'households.search_households_grants', 'households.search_households_all_grants'
+}
+
+
+@households.before_request
+def handle_conditional_request():
+    if request.endpoint not in CONDITIONAL_ENDPOINTS:
+        return None
+
+    # Note: Only the data version is read, so clients with a current copy are answered without running their search
+    g.etag = DataVersionHelper.etag(request, wants_ndjson(request))
+    if request.if_none_match.contains(g.etag):
+        response = make_response('', 304)
+        response.set_etag(g.etag)
+        return response
+    return None
+
 
 @households.route('/household/new', methods=['POST'])
 def create_household():
@@ -36,33 +62,207 @@ def add_person_to_household(household_id):
         return str(e), 400
 
     db.session.add(person)
-    db.session.commit()
     if spouse_id:
-        spouse = Person.query.get(spouse_id)
-        spouse.spouse_id = person.id
-        db.session.commit()
+        # Note: The spouse was loaded by validate_spouse_id, and is linked back within the same transaction as the new person
+        db.session.flush()
+        Person.query.get(spouse_id).spouse_id = person.id
+    db.session.commit()
     return {}
 
 
+@households.route('/household/<int:household_id>/family/bulk/new', methods=['POST'])
+def bulk_add_people_to_household(household_id):
+    Household.query.get_or_404(household_id)
+
+    data = request.get_json(silent=True)
+    family_members_data = data.get('Family Members') if isinstance(data, dict) else None
+
+    importer = FamilyMemberImporter(household_id, family_members_data)
+    if not importer.validate():
+        return {'Errors': importer.errors}, 400
+
+    person_ids = importer.write()
+    return {'Family Members': person_ids}
+
+
+@households.route('/household/bulk/new', methods=['POST'])
+def bulk_create_households():
+    data = request.get_json(silent=True)
+    households_data = data.get('Households') if isinstance(data, dict) else None
+
+    importer = HouseholdImporter(households_data)
+    if not importer.validate():
+        return {'Errors': importer.errors}, 400
+
+    household_ids = importer.write()
+    return {'Households': household_ids}
+
+
 @households.route('/household/all')
 def all_households():
-    return [household.to_json(excludes=['ID']) for household in Household.query.all()]
+    return households_response(Household.query, ALL_HOUSEHOLDS_SERIALIZER)
 
 
 @households.route('/household/search', methods=['POST'])
 def search_households():
     query = handle_search_query(request)
-    return query.run()
+    if current_app.config['SEARCH_ENGINE'] == 'columnar':
+        return columnar_response(ColumnarSearchEngine.get(current_app).search(query))
+    return households_response(query.final_query(), SEARCH_SERIALIZER)
 
 
 @households.route('/household/search/grants', methods=['POST'])
 def search_households_grants():
     query = handle_search_query(request)
     grant_type = request.form.get('GrantType')
-    return query.run(grant=grant_type)
+    columnar = current_app.config['SEARCH_ENGINE'] == 'columnar'
+    if not grant_type:
+        if columnar:
+            return columnar_response(ColumnarSearchEngine.get(current_app).search(query))
+        return households_response(query.final_query(), SEARCH_SERIALIZER)
+
+    if grant_type not in QueryBuilder.valid_grant_types():
+        return "Invalid grant type", 400
+    if columnar:
+        return columnar_response(ColumnarSearchEngine.get(current_app).search_grant(grant_type), QueryBuilder.grant_member_criteria(grant_type))
+    return households_response(
+        GrantEligibilityStore.households_query(grant_type), SEARCH_SERIALIZER, GrantEligibilityStore.member_criteria(grant_type)
+    )
+
+
+@households.route('/household/search/grants/all')
+def search_households_all_grants():
+    try:
+        after_id, limit = parse_pagination_params(request)
+    except ValueError:
+        return "Invalid pagination params", 400
+
+    query = GrantRules.households_query()
+    if limit is not None and not wants_ndjson(request):
+        page = QueryBuilder.paginate(query, after_id, limit).all()
+        response = make_response(list(all_grants_json(page)))
+        set_page_headers(response, page, limit)
+        return response
+
+    # Note: Without a limit, households are streamed a chunk at a time, so that memory usage does not grow with the number of households
+    chunks = QueryBuilder.iter_chunks(query, after_id, limit, current_app.config['STREAM_CHUNK_SIZE'])
+    if wants_ndjson(request):
+        lines = (''.join(current_app.json.dumps(household_json) + '\n' for household_json in all_grants_json(chunk)) for chunk in chunks)
+        response = Response(stream_with_context(lines), mimetype='application/x-ndjson')
+    else:
+        response = Response(stream_with_context(json_array(chunks, all_grants_json)), mimetype='application/json')
+    response.set_etag(g.etag)
+    return response
+
+
+@households.route('/household/export')
+def export_disbursements():
+    export_format = request.args.get('format', 'csv')
+    exporter = DisbursementExporter(request.args.getlist('GrantType'), current_app.config['STREAM_CHUNK_SIZE'])
+    error = exporter.validate(export_format)
+    if error:
+        return error, 400
+
+    def generate():
+        yield from exporter.iter_export(export_format)
+        current_app.logger.info(exporter.summary())
+
+    mimetype = 'text/csv' if export_format == 'csv' else 'application/vnd.apache.parquet'
+    response = Response(stream_with_context(generate()), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename=disbursements.{export_format}'
+    return response
+
+
+@households.route('/household/search/cache')
+def search_statement_cache():
+    # Hit and miss counters of this worker's statement cache
+    return statement_cache.to_json()
 
 
 # Helpers
+def columnar_response(household_ids, member_criteria=None):
+    # Households found by the columnar engine, loaded by ID a page at a time
+    return households_response(household_ids, SEARCH_SERIALIZER, member_criteria, HouseholdIds.paginate)
+
+
+def households_response(query, serializer, member_criteria=None, paginate=QueryBuilder.paginate):
+    try:
+        after_id, limit = parse_pagination_params(request)
+    except ValueError:
+        return "Invalid pagination params", 400
+
+    # Note: With SQL assembly, each household's JSON document is built by SQLite and written out as is
+    sql_assembly = current_app.config['JSON_ASSEMBLY'] == 'sql'
+    if sql_assembly:
+        query = serializer.documents_query(query, member_criteria)
+
+    if wants_ndjson(request):
+        chunk_size = current_app.config['STREAM_CHUNK_SIZE']
+        if sql_assembly:
+            lines = (row.document + '\n' for chunk in QueryBuilder.iter_chunks(query, after_id, limit, chunk_size, paginate) for row in chunk)
+        else:
+            lines = (current_app.json.dumps(household_json) + '\n'
+                     for chunk in QueryBuilder.iter_chunks(query, after_id, limit, chunk_size, paginate)
+                     for household_json in QueryBuilder.serialize_households(chunk, serializer.household, member_criteria))
+        response = Response(stream_with_context(lines), mimetype='application/x-ndjson')
+        response.set_etag(g.etag)
+        return response
+
+    page = paginate(query, after_id, limit).all()
+    if sql_assembly:
+        response = current_app.response_class('[' + ','.join(row.document for row in page) + ']', mimetype='application/json')
+    else:
+        response = make_response(list(QueryBuilder.serialize_households(page, serializer.household, member_criteria)))
+    set_page_headers(response, page, limit)
+    return response
+
+
+def all_grants_json(households):
+    qualifying_members = GrantRules.qualifying_members(households)
+    for household in households:
+        yield {
+            'HouseholdType': household.housing_type,
+            'Grants': {
+                grant: [SEARCH_SERIALIZER.person(person) for person in members]
+                for grant, members in qualifying_members[household.id].items() if members
+            }
+        }
+
+
+def json_array(chunks, serialize):
+    # JSON array of the serialized households, written out a chunk at a time
+    separator = ''
+    yield '['
+    for chunk in chunks:
+        yield separator + ','.join(current_app.json.dumps(household_json) for household_json in serialize(chunk))
+        separator = ','
+    yield ']'
+
+
+def set_page_headers(response, page, limit):
+    if limit is not None and len(page) == limit:
+        # Cursor for the next page, since household IDs are not part of the response body
+        response.headers['X-Next-After-Id'] = page[-1].id
+    response.set_etag(g.etag)
+
+
+def parse_pagination_params(request):
+    return parse_optional_int(request.args.get('after_id'), minimum=0), parse_optional_int(request.args.get('limit'), minimum=1)
+
+
+def parse_optional_int(value, minimum):
+    if value is None:
+        return None
+    value = int(value)
+    if value < minimum:
+        raise ValueError
+    return value
+
+
+def wants_ndjson(request):
+    return request.args.get('format') == 'ndjson' or request.accept_mimetypes.best == 'application/x-ndjson'
+
+
 def handle_search_query(request):
     query = QueryBuilder()
 
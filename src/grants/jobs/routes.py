@@ -0,0 +1,56 @@
+import os
+from flask import Blueprint, request, send_file, url_for
+from grants.models import Job
+from grants.jobs.runner import JobRunner
+
+jobs = Blueprint('jobs', __name__)
+
+
+@jobs.before_app_request
+def resume_interrupted_jobs():
+    JobRunner.resume_on_first_request()
+
+
+@jobs.route('/jobs/new', methods=['POST'])
+def submit_job():
+    kind = request.form.get('Kind')
+    # Note: GrantType may be repeated for disbursement exports, which export every grant when none is given
+    if kind == 'disbursement_export':
+        params = {'GrantType': request.form.getlist('GrantType')}
+    else:
+        params = {'GrantType': request.form.get('GrantType')}
+
+    error = JobRunner.validate(kind, params)
+    if error:
+        return error, 400
+
+    job = JobRunner.submit(kind, params)
+    return {'ID': job.id}, 202, {'Location': url_for('jobs.job_status', job_id=job.id)}
+
+
+@jobs.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = Job.query.get_or_404(job_id)
+    return job.to_json(JobRunner.status(job))
+
+
+@jobs.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    job = Job.query.get_or_404(job_id)
+    if job.status != 'completed':
+        return "Job has not completed", 409
+
+    path = JobRunner.result_path(job)
+    if not os.path.exists(path):
+        return "Job result no longer exists", 410
+
+    kind = JobRunner.KINDS[job.kind]
+    return send_file(path, mimetype=kind.MIMETYPE, as_attachment=True, download_name=f'{job.kind}.{kind.EXTENSION}')
+
+
+@jobs.route('/jobs/<job_id>/resume', methods=['POST'])
+def resume_job(job_id):
+    Job.query.get_or_404(job_id)
+    if not JobRunner.resume(job_id):
+        return "Only failed or interrupted jobs can be resumed", 409
+    return {'ID': job_id}, 202, {'Location': url_for('jobs.job_status', job_id=job_id)}
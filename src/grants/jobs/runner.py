@@ -0,0 +1,312 @@
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import SQLAlchemyError
+from grants import db
+from grants.models import Job
+from grants.helpers.utils import QueryBuilder
+from grants.helpers.eligibility import GrantEligibilityStore
+from grants.helpers.export import DisbursementExporter
+from grants.helpers.serializers import SEARCH_SERIALIZER
+
+
+class JobInterrupted(Exception):
+    # Raised when the job was taken over by another run (e.g. resumed by another worker after being left stale)
+    pass
+
+
+class DisbursementExportJob():
+    # CSV of DisbursementExporter, resumed from the grant and household it stopped at
+    # Note: Parquet is not offered, as a parquet file cannot be appended to once its footer is missing
+    MIMETYPE = 'text/csv'
+    EXTENSION = 'csv'
+
+    def __init__(self, params, chunk_size):
+        self.exporter = DisbursementExporter(params.get('GrantType'), chunk_size)
+
+    @staticmethod
+    def validate(params):
+        return DisbursementExporter(params.get('GrantType')).validate('csv')
+
+    def header(self):
+        return DisbursementExporter.csv_chunk([DisbursementExporter.COLUMNS])
+
+    def iter_chunks(self, position):
+        grant_index, after_id = position or (0, None)
+        for grant_index, after_id, rows in self.exporter.iter_chunks(grant_index, after_id):
+            yield [grant_index, after_id], DisbursementExporter.csv_chunk(row[:-1] + (row[-1].isoformat(),) for row in rows), len(rows)
+
+
+class GrantSearchJob():
+    # NDJSON of the households eligible for a grant, as listed by /household/search/grants, resumed from the household it stopped at
+    MIMETYPE = 'application/x-ndjson'
+    EXTENSION = 'ndjson'
+
+    def __init__(self, params, chunk_size):
+        self.grant = params.get('GrantType')
+        self.chunk_size = chunk_size
+
+    @staticmethod
+    def validate(params):
+        if params.get('GrantType') not in QueryBuilder.valid_grant_types():
+            return 'Invalid grant type'
+        return None
+
+    def header(self):
+        return b''
+
+    def iter_chunks(self, after_id):
+        member_criteria = GrantEligibilityStore.member_criteria(self.grant)
+        query = GrantEligibilityStore.households_query(self.grant)
+        for households in QueryBuilder.iter_chunks(query, after_id, chunk_size=self.chunk_size):
+            lines = ''.join(
+                current_app.json.dumps(household_json) + '\n'
+                for household_json in QueryBuilder.serialize_households(households, SEARCH_SERIALIZER.household, member_criteria)
+            )
+            yield households[-1].id, lines.encode(), len(households)
+
+
+class JobRunner():
+    # Runs jobs on a pool of threads within each worker process. Job state is kept in the database, so that the status of a job can be
+    # read by every worker, and an interrupted job can be resumed by any of them from its last checkpoint
+    KINDS = {
+        'disbursement_export': DisbursementExportJob,
+        'grant_search': GrantSearchJob,
+    }
+
+    # Statuses of the jobs that are waiting for or being run by a process, and become interrupted if it stops
+    ACTIVE_STATUSES = ['queued', 'running']
+
+    lock = threading.Lock()
+
+    @staticmethod
+    def executor(app):
+        with JobRunner.lock:
+            if 'grants.jobs' not in app.extensions:
+                app.extensions['grants.jobs'] = {
+                    'executor': ThreadPoolExecutor(max_workers=app.config['JOB_WORKERS'], thread_name_prefix='grants-job'),
+                    'futures': {},
+                    # Job ID => token of the jobs queued or running in this process, kept fresh by the heartbeat
+                    'tokens': {},
+                    'heartbeat': None,
+                }
+            return app.extensions['grants.jobs']
+
+    @staticmethod
+    def validate(kind, params):
+        # Returns an error message, or None if the job can be submitted
+        if kind not in JobRunner.KINDS:
+            return 'Invalid job kind'
+        return JobRunner.KINDS[kind].validate(params)
+
+    @staticmethod
+    def new_token():
+        # Note: Names the process that owns the run, so that the owner of a job can be told from its row
+        return f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}'
+
+    @staticmethod
+    def submit(kind, params):
+        job = Job(id=uuid.uuid4().hex, kind=kind, params=params, status='queued', token=JobRunner.new_token())
+        db.session.add(job)
+        db.session.commit()
+        JobRunner.enqueue(job.id, job.token)
+        return job
+
+    @staticmethod
+    def enqueue(job_id, token):
+        app = current_app._get_current_object()
+        jobs = JobRunner.executor(app)
+        with JobRunner.lock:
+            jobs['tokens'][job_id] = token
+            if jobs['heartbeat'] is None:
+                jobs['heartbeat'] = threading.Thread(target=JobRunner.heartbeat, args=(app, jobs), name='grants-job-heartbeat', daemon=True)
+                jobs['heartbeat'].start()
+        future = jobs['executor'].submit(JobRunner.run, app, job_id, token)
+        jobs['futures'][job_id] = future
+
+        def forget(done):
+            with JobRunner.lock:
+                if jobs['tokens'].get(job_id) == token:
+                    del jobs['tokens'][job_id]
+            if jobs['futures'].get(job_id) is done:
+                del jobs['futures'][job_id]
+        future.add_done_callback(forget)
+        return future
+
+    @staticmethod
+    def heartbeat(app, jobs):
+        # Refreshes updated_at of every job queued or running in this process, however long it waits for a thread or takes per chunk,
+        # so that only the jobs of a process that stopped become stale. Exits once the process has no jobs left
+        while True:
+            time.sleep(app.config['JOB_HEARTBEAT_SECONDS'])
+            with JobRunner.lock:
+                tokens = list(jobs['tokens'].values())
+                if not tokens:
+                    jobs['heartbeat'] = None
+                    return
+
+            with app.app_context():
+                table = Job.__table__
+                try:
+                    db.session.execute(
+                        table.update().where(and_(table.c.token.in_(tokens), table.c.status.in_(JobRunner.ACTIVE_STATUSES)))
+                        .values(updated_at=datetime.utcnow())
+                    )
+                    db.session.commit()
+                except SQLAlchemyError:
+                    db.session.rollback()
+                    app.logger.exception('Could not record the heartbeat of jobs')
+                finally:
+                    db.session.remove()
+
+    @staticmethod
+    def wait(job_id, timeout=None):
+        # Blocks until this worker's run of the job finishes
+        future = JobRunner.executor(current_app._get_current_object())['futures'].get(job_id)
+        if future is not None:
+            future.result(timeout)
+
+    @staticmethod
+    def run(app, job_id, token):
+        with app.app_context():
+            try:
+                JobRunner.process(db.session.get(Job, job_id), token)
+            except JobInterrupted:
+                app.logger.info(f'Job {job_id} was taken over by another run')
+            except Exception as e:
+                db.session.rollback()
+                app.logger.exception(f'Job {job_id} failed')
+                try:
+                    JobRunner.save(job_id, token, status='failed', error=str(e) or type(e).__name__)
+                except JobInterrupted:
+                    pass
+
+    @staticmethod
+    def process(job, token):
+        # Writes the output to a file of this run's own, and checkpoints the position of each chunk and the length of the file after it.
+        # A resumed run copies the output of the run it took over up to its last checkpoint, and the file of the run that completes is
+        # renamed into place as the result. A run that was taken over (e.g. it was stalled for longer than JOB_STALE_SECONDS) may still
+        # write a chunk to its own file, but never to the file of the run that took over
+        job_id = job.id
+        JobRunner.save(job_id, token, status='running', error=None)
+        path = JobRunner.run_path(job, token)
+        checkpoint = job.checkpoint or {}
+        num_rows = job.num_rows
+        previous_path = JobRunner.run_path(job, checkpoint['token']) if checkpoint.get('token') else None
+        if previous_path is None or not os.path.exists(previous_path):
+            checkpoint, num_rows = {}, 0
+
+        kind = JobRunner.KINDS[job.kind](job.params, current_app.config['STREAM_CHUNK_SIZE'])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as file:
+            if checkpoint:
+                with open(previous_path, 'rb') as previous_file:
+                    JobRunner.copy(previous_file, file, checkpoint['offset'])
+            else:
+                file.write(kind.header())
+
+            for position, data, chunk_rows in kind.iter_chunks(checkpoint.get('position')):
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+                num_rows += chunk_rows
+                JobRunner.save(job_id, token, checkpoint={'token': token, 'position': position, 'offset': file.tell()}, num_rows=num_rows)
+                # Note: The previous run's output is only needed until this run has a checkpoint of its own
+                if previous_path is not None:
+                    JobRunner.remove(previous_path)
+                    previous_path = None
+
+        # Note: Any run that gets here has written the whole result, so it does not matter which of them is renamed into place last
+        os.replace(path, JobRunner.result_path(job))
+        if previous_path is not None:
+            JobRunner.remove(previous_path)
+        JobRunner.save(job_id, token, status='completed')
+
+    @staticmethod
+    def copy(source, destination, length):
+        while length > 0:
+            data = source.read(min(length, 1 << 20))
+            if not data:
+                raise ValueError('The output of the previous run is shorter than its checkpoint')
+            destination.write(data)
+            length -= len(data)
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def save(job_id, token, **values):
+        # Raises JobInterrupted if the job no longer belongs to this run
+        table = Job.__table__
+        result = db.session.execute(
+            table.update().where(and_(table.c.id == job_id, table.c.token == token)).values(updated_at=datetime.utcnow(), **values)
+        )
+        db.session.commit()
+        if result.rowcount != 1:
+            raise JobInterrupted()
+
+    @staticmethod
+    def status(job):
+        # Queued or running jobs whose process stopped refreshing them were interrupted, e.g. by their worker being restarted
+        if job.status in JobRunner.ACTIVE_STATUSES and job.updated_at < JobRunner.stale_before():
+            return 'interrupted'
+        return job.status
+
+    @staticmethod
+    def resume(job_id):
+        # Takes over a failed or interrupted job, and continues it from its last checkpoint. Returns False if it cannot be resumed
+        table = Job.__table__
+        token = JobRunner.new_token()
+        resumable = or_(table.c.status == 'failed', and_(table.c.status.in_(JobRunner.ACTIVE_STATUSES), table.c.updated_at < JobRunner.stale_before()))
+        result = db.session.execute(
+            table.update().where(and_(table.c.id == job_id, resumable)).values(status='queued', token=token, updated_at=datetime.utcnow())
+        )
+        db.session.commit()
+        if result.rowcount != 1:
+            return False
+        JobRunner.enqueue(job_id, token)
+        return True
+
+    @staticmethod
+    def resume_on_first_request():
+        # Resumes interrupted jobs once per app, when it handles its first request. Returns the IDs of the jobs resumed, or None
+        # Note: Not done in create_app, as every flask CLI command (e.g. migrate-db) also creates the app, and would otherwise take
+        # over the interrupted jobs and run them to completion before exiting
+        app = current_app._get_current_object()
+        if app.extensions.get('grants.jobs.resumed'):
+            return None
+        with JobRunner.lock:
+            if app.extensions.get('grants.jobs.resumed'):
+                return None
+            app.extensions['grants.jobs.resumed'] = True
+        if not app.config['JOB_RESUME_ON_START']:
+            return None
+        return JobRunner.resume_interrupted()
+
+    @staticmethod
+    def resume_interrupted():
+        # Returns the IDs of the jobs resumed
+        stale_jobs = db.session.query(Job.id).filter(Job.status.in_(JobRunner.ACTIVE_STATUSES), Job.updated_at < JobRunner.stale_before()).all()
+        return [row.id for row in stale_jobs if JobRunner.resume(row.id)]
+
+    @staticmethod
+    def stale_before():
+        return datetime.utcnow() - timedelta(seconds=current_app.config['JOB_STALE_SECONDS'])
+
+    @staticmethod
+    def run_path(job, token):
+        return os.path.join(current_app.config['JOB_RESULTS_DIR'], f'{job.id}.{token.rsplit(":", 1)[-1]}.part')
+
+    @staticmethod
+    def result_path(job):
+        return os.path.join(current_app.config['JOB_RESULTS_DIR'], f'{job.id}.{JobRunner.KINDS[job.kind].EXTENSION}')
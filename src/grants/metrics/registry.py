@@ -0,0 +1,198 @@
+import atexit
+import copy
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from grants.helpers.utils import statement_cache
+
+# Upper bounds of the histogram buckets, in seconds and in bytes. Each histogram also has a +Inf bucket
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+LABELS = ('endpoint', 'method', 'grant_type')
+
+
+class MetricsRegistry():
+    # Request counts by status, error counts, and latency and response size histograms, per route (and grant type of the grants endpoint).
+    # Recorded in memory by each worker process. When a metrics directory is given, each worker also writes its metrics to its own file
+    # in it (at most every flush_seconds), so that the endpoint of any worker can report the sum of every worker's metrics
+    def __init__(self, metrics_dir=None, flush_seconds=5):
+        self.metrics_dir = metrics_dir
+        self.flush_seconds = flush_seconds
+        self.lock = threading.Lock()
+        self.pid = None
+        self.reset()
+        atexit.register(self.flush)
+
+    def reset(self):
+        # Note: A forked worker starts with a copy of its parent's metrics, which are already reported by the parent
+        self.pid = os.getpid()
+        self.path = os.path.join(self.metrics_dir, f'{self.pid}-{uuid.uuid4().hex}.json') if self.metrics_dir else None
+        self.series = {}
+        self.last_flush = time.monotonic()
+
+    def record(self, labels, status, seconds, size):
+        flush = False
+        with self.lock:
+            if os.getpid() != self.pid:
+                self.reset()
+
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = MetricsRegistry.new_series()
+            status = str(status)
+            series['statuses'][status] = series['statuses'].get(status, 0) + 1
+            if int(status) >= 400:
+                series['errors'] += 1
+            series['latency'][bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            series['latency_sum'] += seconds
+            series['size'][bisect_left(SIZE_BUCKETS, size)] += 1
+            series['size_sum'] += size
+
+            if self.path and time.monotonic() - self.last_flush >= self.flush_seconds:
+                self.last_flush = time.monotonic()
+                flush = True
+        if flush:
+            self.flush()
+
+    @staticmethod
+    def new_series():
+        return {
+            'statuses': {},
+            'errors': 0,
+            'latency': [0] * (len(LATENCY_BUCKETS) + 1),
+            'latency_sum': 0.0,
+            'size': [0] * (len(SIZE_BUCKETS) + 1),
+            'size_sum': 0,
+        }
+
+    def snapshot(self):
+        with self.lock:
+            if os.getpid() != self.pid:
+                self.reset()
+            return {
+                'pid': self.pid,
+                'series': [[list(labels), copy.deepcopy(series)] for labels, series in self.series.items()],
+                'statement_cache': statement_cache.to_json(),
+            }
+
+    def flush(self):
+        if not self.path:
+            return
+        snapshot = self.snapshot()
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        # Note: Written to a temporary file first, so that readers never see a partly written file
+        temporary_path = f'{self.path}.tmp'
+        with open(temporary_path, 'w') as file:
+            json.dump(snapshot, file)
+        os.replace(temporary_path, self.path)
+
+    def collect(self):
+        # Metrics of every worker, or of this worker alone when there is no metrics directory.
+        # Note: Other workers' metrics are as of their last flush. The requests of workers that stopped still count towards the totals,
+        # but the statement cache they held is gone, so only running workers count towards its size
+        if not self.path:
+            return MetricsRegistry.merge([self.snapshot()])
+
+        self.flush()
+        snapshots = []
+        for path in glob.glob(os.path.join(self.metrics_dir, '*.json')):
+            try:
+                with open(path) as file:
+                    snapshot = json.load(file)
+            except (OSError, ValueError):
+                continue
+            if not MetricsRegistry.is_running(snapshot.get('pid')):
+                snapshot['statement_cache']['Size'] = 0
+            snapshots.append(snapshot)
+        return MetricsRegistry.merge(snapshots)
+
+    @staticmethod
+    def is_running(pid):
+        if pid is None:
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    @staticmethod
+    def merge(snapshots):
+        series, cache = {}, {'Hits': 0, 'Misses': 0, 'Size': 0}
+        for snapshot in snapshots:
+            for labels, values in snapshot['series']:
+                merged = series.setdefault(tuple(labels), MetricsRegistry.new_series())
+                for status, count in values['statuses'].items():
+                    merged['statuses'][status] = merged['statuses'].get(status, 0) + count
+                for name in ['errors', 'latency_sum', 'size_sum']:
+                    merged[name] += values[name]
+                for name in ['latency', 'size']:
+                    merged[name] = [total + count for total, count in zip(merged[name], values[name])]
+            for name in cache:
+                cache[name] += snapshot['statement_cache'][name]
+        return series, cache
+
+
+class PrometheusFormat():
+    # Text exposition format (version 0.0.4)
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    @staticmethod
+    def render(series, cache):
+        lines = []
+        PrometheusFormat.family(lines, 'grants_http_requests_total', 'counter', 'Requests handled, by route and response status', [
+            ('', {**PrometheusFormat.labels(labels), 'status': status}, count)
+            for labels, values in sorted(series.items()) for status, count in sorted(values['statuses'].items())
+        ])
+        PrometheusFormat.family(lines, 'grants_http_request_errors_total', 'counter', 'Requests answered with a client or server error status', [
+            ('', PrometheusFormat.labels(labels), values['errors']) for labels, values in sorted(series.items())
+        ])
+        PrometheusFormat.histogram(lines, 'grants_http_request_duration_seconds', 'Time to handle requests, until the last byte of streamed responses',
+                                   series, 'latency', LATENCY_BUCKETS)
+        PrometheusFormat.histogram(lines, 'grants_http_response_size_bytes', 'Size of response bodies', series, 'size', SIZE_BUCKETS)
+        PrometheusFormat.family(lines, 'grants_statement_cache_hits_total', 'counter', 'Search statements found in the statement cache', [
+            ('', {}, cache['Hits'])
+        ])
+        PrometheusFormat.family(lines, 'grants_statement_cache_misses_total', 'counter', 'Search statements built and added to the statement cache', [
+            ('', {}, cache['Misses'])
+        ])
+        PrometheusFormat.family(lines, 'grants_statement_cache_size', 'gauge', 'Statements held by the statement caches of every running worker', [
+            ('', {}, cache['Size'])
+        ])
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def histogram(lines, name, description, series, key, buckets):
+        samples = []
+        for labels, values in sorted(series.items()):
+            labels = PrometheusFormat.labels(labels)
+            cumulative = 0
+            for bound, count in zip(buckets + ('+Inf',), values[key]):
+                cumulative += count
+                samples.append(('_bucket', {**labels, 'le': str(bound)}, cumulative))
+            samples.append(('_sum', labels, values[f'{key}_sum']))
+            samples.append(('_count', labels, cumulative))
+        PrometheusFormat.family(lines, name, 'histogram', description, samples)
+
+    @staticmethod
+    def family(lines, name, kind, description, samples):
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {kind}')
+        for suffix, labels, value in samples:
+            label_text = ','.join(f'{label}="{PrometheusFormat.escape(value)}"' for label, value in labels.items())
+            lines.append(f'{name}{suffix}{{{label_text}}} {value}' if label_text else f'{name}{suffix} {value}')
+
+    @staticmethod
+    def labels(values):
+        return dict(zip(LABELS, values))
+
+    @staticmethod
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
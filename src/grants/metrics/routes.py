@@ -0,0 +1,71 @@
+import time
+from flask import Blueprint, Response, current_app, g, request
+from grants.helpers.utils import QueryBuilder
+from grants.metrics.registry import MetricsRegistry, PrometheusFormat
+
+metrics = Blueprint('metrics', __name__)
+
+# Endpoints whose metrics are also labelled by the requested GrantType
+GRANT_TYPE_ENDPOINTS = {'households.search_households_grants'}
+
+
+@metrics.record_once
+def create_registry(state):
+    app = state.app
+    app.extensions['grants.metrics'] = MetricsRegistry(app.config['METRICS_DIR'], app.config['METRICS_FLUSH_SECONDS'])
+
+
+@metrics.before_app_request
+def start_timer():
+    g.metrics_start = time.perf_counter()
+
+
+@metrics.after_app_request
+def record_request(response):
+    start = g.get('metrics_start')
+    if start is None:
+        return response
+
+    registry = current_app.extensions['grants.metrics']
+    labels = (request.endpoint or '', request.method, grant_type_label())
+    status = response.status_code
+
+    if not response.is_streamed:
+        registry.record(labels, status, time.perf_counter() - start, response.content_length or 0)
+        return response
+
+    # Note: Streamed responses are recorded once their last chunk was sent, with the size of every chunk when it is not known up front
+    size = [response.content_length]
+    if size[0] is None and not response.direct_passthrough:
+        size[0] = 0
+        body = response.response
+
+        def counted_body():
+            try:
+                for chunk in body:
+                    # Note: Text chunks are sent encoded, so their size is counted in bytes
+                    size[0] += len(chunk.encode(response.charset) if isinstance(chunk, str) else chunk)
+                    yield chunk
+            finally:
+                if hasattr(body, 'close'):
+                    body.close()
+        response.response = counted_body()
+
+    response.call_on_close(lambda: registry.record(labels, status, time.perf_counter() - start, size[0] or 0))
+    return response
+
+
+@metrics.route('/metrics')
+def prometheus_metrics():
+    return Response(PrometheusFormat.render(*current_app.extensions['grants.metrics'].collect()), content_type=PrometheusFormat.CONTENT_TYPE)
+
+
+# Helpers
+def grant_type_label():
+    # Note: Unknown grant types share a label, so that arbitrary form values cannot create new series
+    if request.endpoint not in GRANT_TYPE_ENDPOINTS:
+        return ''
+    grant_type = request.form.get('GrantType')
+    if not grant_type:
+        return ''
+    return grant_type if grant_type in QueryBuilder.valid_grant_types() else 'invalid'
@@ -1,22 +1,21 @@
-from functools import reduce
 from grants import db
 from sqlalchemy.orm import validates
 from datetime import datetime, date
-from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.sql import func, select
 from dateutil.relativedelta import relativedelta
 
 
 class Household(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    housing_type = db.Column(db.String, nullable=False)
-    family_members = db.relationship('Person', back_populates='household')
+    housing_type = db.Column(db.String, nullable=False, index=True)
+    # Sum of the members' annual incomes, kept up to date by HouseholdStatsMaintainer so that income limits filter on an indexed column
+    total_annual_income = db.Column(db.Float, nullable=False, default=0, server_default='0', index=True)
+    family_members = db.relationship('Person', back_populates='household', order_by='Person.id')
 
     # Validations
 
     @validates('housing_type')
     def validate_housing_type(self, _, housing_type):
-        assert housing_type in Household.valid_housing_types()
+        assert housing_type in Household.valid_housing_types(), 'Invalid housing type'
         return housing_type
 
     # Valid Types
@@ -25,38 +24,28 @@ class Household(db.Model):
     def valid_housing_types():
         return {'Landed', 'Condominium', 'HDB'}
 
-    # Hybrid Properties
-
-    @hybrid_property
-    def total_annual_income(self):
-        total_annual_income = sum([person.annual_income for person in self.family_members])
-        return total_annual_income
-
-    @total_annual_income.expression
-    def total_annual_income(cls):
-        return (
-            select([func.sum(Person.annual_income)])
-            .where(Person.household_id == cls.id)
-            .label('total_annual_income')
-        )
-
     # Other Methods
 
-    def to_json(self, excludes=[], family_excludes=[], filter_person_criteria=[]):
+    def to_json(self, excludes=[], family_excludes=[], filter_person_criteria=[], family_members=None):
         data = {
             'ID': self.id,
             'HouseholdType': self.housing_type,
             'Family Members': []
         }
 
-        for family_member in self.family_members:
-            if filter_person_criteria:
-                def combine_function(fn1, fn2):
-                    return lambda x: fn1(x) and fn2(x)
+        # Note: family_members may be given to serialize members that were loaded in bulk, instead of lazy loading them per household
+        if family_members is None:
+            family_members = self.family_members
 
-                test_all_criteria_fn = reduce(combine_function, filter_person_criteria)
-                if not test_all_criteria_fn(family_member):
-                    continue
+        if filter_person_criteria:
+            # Note: The criteria are evaluated for all the members at once, instead of per member and criterion
+            from grants.helpers.ages import AgeClassifier
+
+            family_members = list(family_members)
+            mask = AgeClassifier.criteria_mask(family_members, filter_person_criteria)
+            family_members = [family_member for family_member, included in zip(family_members, mask) if included]
+
+        for family_member in family_members:
             data['Family Members'].append(family_member.to_json(excludes=family_excludes))
 
         for item in excludes:
@@ -65,6 +54,12 @@ class Household(db.Model):
 
 
 class Person(db.Model):
+    # Note: (household_id, date_of_birth) also serves lookups by household_id alone, e.g. when loading family members
+    __table_args__ = (
+        db.Index('ix_person_household_id_date_of_birth', 'household_id', 'date_of_birth'),
+        db.Index('ix_person_occupation_type_date_of_birth', 'occupation_type', 'date_of_birth'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
     gender = db.Column(db.String, nullable=False)
@@ -78,7 +73,7 @@ class Person(db.Model):
 
     occupation_type = db.Column(db.String, nullable=False)
     annual_income = db.Column(db.Float, nullable=False)
-    date_of_birth = db.Column(db.Date, nullable=False)
+    date_of_birth = db.Column(db.Date, nullable=False, index=True)
 
     household_id = db.Column(db.Integer, db.ForeignKey('household.id'), nullable=False)
     household = db.relationship('Household', back_populates='family_members')
@@ -87,12 +82,12 @@ class Person(db.Model):
 
     @validates('gender')
     def validate_gender(self, _, gender):
-        assert gender in Person.valid_genders()
+        assert gender in Person.valid_genders(), 'Invalid gender'
         return gender
 
     @validates('marital_status')
     def validate_marital_status(self, _, marital_status):
-        assert marital_status in Person.valid_marital_statuses()
+        assert marital_status in Person.valid_marital_statuses(), 'Invalid marital status'
         return marital_status
 
     @validates('spouse_id')
@@ -100,12 +95,12 @@ class Person(db.Model):
         if spouse_id is None:
             return
         spouse = Person.query.get(spouse_id)
-        assert spouse is not None
+        assert spouse is not None, 'Spouse does not exist'
         return spouse_id
 
     @validates('occupation_type')
     def validate_occupation_type(self, _, occupation_type):
-        assert occupation_type in Person.valid_occupation_types()
+        assert occupation_type in Person.valid_occupation_types(), 'Invalid occupation type'
         return occupation_type
 
     @validates('date_of_birth')
@@ -115,7 +110,7 @@ class Person(db.Model):
         else:
             date_of_birth_converted = date_of_birth
 
-        assert date_of_birth_converted <= datetime.today().date()
+        assert date_of_birth_converted <= datetime.today().date(), 'Date of birth cannot be in the future'
         return date_of_birth_converted
 
     # Valid Types
@@ -163,8 +158,74 @@ class Person(db.Model):
             'Spouse': self.spouse_id,
             'OccupationType': self.occupation_type,
             'AnnualIncome': self.annual_income,
-            'DOB': datetime.strftime(self.date_of_birth, '%Y-%m-%d'),
+            'DOB': self.date_of_birth.isoformat(),
         }
         for item in excludes:
             data.pop(item)
         return data
+
+
+class HouseholdStats(db.Model):
+    # Denormalized per-household counts, kept up to date by HouseholdStatsMaintainer so that searches filter on indexed columns
+    __tablename__ = 'household_stats'
+
+    household_id = db.Column(db.Integer, db.ForeignKey('household.id'), primary_key=True)
+    num_family_members = db.Column(db.Integer, nullable=False, default=0, index=True)
+    num_babies = db.Column(db.Integer, nullable=False, default=0, index=True)
+    num_children = db.Column(db.Integer, nullable=False, default=0, index=True)
+    num_adults = db.Column(db.Integer, nullable=False, default=0, index=True)
+    num_elders = db.Column(db.Integer, nullable=False, default=0, index=True)
+    num_teenage_students = db.Column(db.Integer, nullable=False, default=0, index=True)
+
+
+class HouseholdStatsRollover(db.Model):
+    # Single row recording the date that the age band counts in HouseholdStats were last computed for
+    __tablename__ = 'household_stats_rollover'
+
+    id = db.Column(db.Integer, primary_key=True)
+    rolled_over_on = db.Column(db.Date, nullable=False)
+
+
+class GrantEligibility(db.Model):
+    # Qualifying members of every household that is eligible for a grant, kept up to date by GrantEligibilityStore
+    __tablename__ = 'grant_eligibility'
+    __table_args__ = (db.Index('ix_grant_eligibility_grant_household_id', 'grant', 'household_id'),)
+
+    grant = db.Column(db.String, primary_key=True)
+    person_id = db.Column(db.Integer, db.ForeignKey('person.id'), primary_key=True)
+    household_id = db.Column(db.Integer, db.ForeignKey('household.id'), nullable=False, index=True)
+
+
+class DataVersion(db.Model):
+    # Single row counter, incremented within every transaction that changes household data. Used to derive response ETags
+    __tablename__ = 'data_version'
+
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+class Job(db.Model):
+    # Background job run by grants.jobs.runner.JobRunner. The checkpoint records how far its output got, so that an interrupted job resumes from it
+    id = db.Column(db.String, primary_key=True)
+    kind = db.Column(db.String, nullable=False)
+    params = db.Column(db.JSON, nullable=False, default=dict)
+    status = db.Column(db.String, nullable=False, default='queued', index=True)
+    # Identifies the run that currently owns the job, so that a job taken over by another worker is not written by both
+    token = db.Column(db.String)
+    checkpoint = db.Column(db.JSON)
+    num_rows = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.String)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def to_json(self, status=None):
+        return {
+            'ID': self.id,
+            'Kind': self.kind,
+            'Params': self.params,
+            'Status': status or self.status,
+            'Rows': self.num_rows,
+            'Error': self.error,
+            'CreatedAt': self.created_at.isoformat(),
+            'UpdatedAt': self.updated_at.isoformat(),
+        }
@@ -4,6 +4,7 @@ from faker import Faker
 from random import shuffle, randint
 from datetime import date, timedelta
 from dateutil.relativedelta import relativedelta
+from sqlalchemy import event
 
 
 class PersonBuilder():
@@ -219,3 +220,25 @@ class Utils():
 
         date_of_birth = earliest_birthdate + timedelta(days=random_number_of_days)
         return date_of_birth
+
+
+class StatementCounter():
+    # Counts the SQL statements executed by the engine while used as a context manager
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+        self.statements = []
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self.increment)
+        return self
+
+    def __exit__(self, *args):
+        event.remove(self.engine, 'before_cursor_execute', self.increment)
+
+    def increment(self, connection, cursor, statement, *args):
+        self.count += 1
+        self.statements.append(statement)
+
+    def count_matching(self, text):
+        return len([statement for statement in self.statements if text in statement])
@@ -1,10 +1,37 @@
-from grants import db
+from grants import db, create_app
 import pytest
-from grants.models import Household, Person
-from datetime import datetime, timedelta
-from flask import url_for
+from grants.models import Household, Person, HouseholdStats, HouseholdStatsRollover, GrantEligibility, Job
+from grants.helpers.utils import QueryBuilder, DateHelper
+from grants.helpers.stats import HouseholdStatsMaintainer
+from grants.helpers.eligibility import GrantEligibilityStore
+from grants.helpers.storage import StorageProfiles
+from grants.helpers.migrations import SchemaMigrator
+from grants.helpers.names import PersonNameIndex
+from grants.helpers.ages import AgeClassifier
+from grants.helpers.rules import GrantRules
+from grants.helpers.serializers import HouseholdSerializer, OrjsonProvider
+from grants.helpers.export import DisbursementExporter
+from grants.helpers.seed import DatasetSeeder
+from grants.jobs.runner import JobRunner, GrantSearchJob
+from grants.helpers.instrumentation import InstrumentedJSONProvider
+from grants.metrics.registry import MetricsRegistry, PrometheusFormat
+from grants.helpers.columnar import ColumnarSearchEngine
+from flask.json.provider import DefaultJSONProvider
+from dateutil.relativedelta import relativedelta
+from datetime import date, datetime, timedelta
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+import sqlite3
+import csv
+import os
+import subprocess
+import sys
+import threading
+import time
+import io
+from flask import url_for, current_app
 import json
-from helpers.utils import PersonBuilder
+from helpers.utils import PersonBuilder, HouseholdBuilder, StatementCounter
 
 
 # Tests For API 1
@@ -180,7 +207,7 @@ def test_search_for_household_by_household_type_multiple_types_success(client, a
 
     received_households_json = json.loads(response.get_data())
     expected_households_json = [household.to_json(excludes=['ID'], family_excludes=['ID', 'Spouse'])
-                                for household in Household.query.filter(Household.housing_type.in_(['HDB', 'Landed']))]
+                                for household in Household.query.filter(Household.housing_type.in_(['HDB', 'Landed'])).order_by(Household.id)]
 
     assert received_households_json == expected_households_json
 
@@ -497,3 +524,1279 @@ def test_spouse_to_spouse_in_add_person_to_household_endpoint(client, empty_hous
 
     assert saved_alice.spouse_id == saved_bob.id
     assert saved_bob.spouse_id == saved_alice.id
+
+
+# Tests for API 6 - Bulk Household Creation
+def test_bulk_create_households_success(client, empty_household_saved):
+    existing = PersonBuilder(empty_household_saved).name('Carol-123').gender_female().married().adult().employed().create_and_write()
+    data = {
+        'Households': [
+            {
+                'Housing Type': 'HDB',
+                'Family Members': [
+                    {'Ref': 'bob', 'Name': 'Bob-456', 'Gender': 'M', 'MaritalStatus': 'Married', 'SpouseRef': 'alice',
+                     'OccupationType': 'Employed', 'AnnualIncome': 30000, 'DOB': '1980-01-01'},
+                    {'Ref': 'alice', 'Name': 'Alice-456', 'Gender': 'F', 'MaritalStatus': 'Married',
+                     'OccupationType': 'Employed', 'AnnualIncome': 20000, 'DOB': '1982-01-01'},
+                ]
+            },
+            {
+                'Housing Type': 'Landed',
+                'Family Members': [
+                    {'Name': 'Dave-456', 'Gender': 'M', 'MaritalStatus': 'Married', 'Spouse': existing.id,
+                     'OccupationType': 'Unemployed', 'AnnualIncome': 0, 'DOB': '1960-01-01'},
+                ]
+            }
+        ]
+    }
+    response = client.post(url_for('households.bulk_create_households'), json=data)
+    assert response.status_code == 200
+
+    household_ids = json.loads(response.get_data())['Households']
+    assert [Household.query.get(household_id).housing_type for household_id in household_ids] == ['HDB', 'Landed']
+
+    bob = Person.query.filter_by(name='Bob-456').first()
+    alice = Person.query.filter_by(name='Alice-456').first()
+    dave = Person.query.filter_by(name='Dave-456').first()
+    db.session.refresh(existing)
+
+    assert bob.household_id == alice.household_id == household_ids[0]
+    assert bob.spouse_id == alice.id
+    assert alice.spouse_id == bob.id
+    assert dave.spouse_id == existing.id
+    assert existing.spouse_id == dave.id
+
+
+def test_bulk_create_households_invalid_records_fail(client):
+    data = {
+        'Households': [
+            {'Housing Type': 'Pulau Ubin', 'Family Members': []},
+            {
+                'Housing Type': 'HDB',
+                'Family Members': [
+                    {'Name': 'Eve-456', 'Gender': 'X', 'MaritalStatus': 'Single',
+                     'OccupationType': 'Employed', 'AnnualIncome': 30000, 'DOB': '1980-01-01'},
+                    {'Name': 'Frank-456', 'Gender': 'M', 'MaritalStatus': 'Married', 'SpouseRef': 'nobody',
+                     'OccupationType': 'Employed', 'AnnualIncome': 30000, 'DOB': '1980-01-01'},
+                ]
+            }
+        ]
+    }
+    response = client.post(url_for('households.bulk_create_households'), json=data)
+    assert response.status_code == 400
+
+    errors = json.loads(response.get_data())['Errors']
+    assert [(error['Household'], error['FamilyMember']) for error in errors] == [(0, None), (1, 0), (1, 1)]
+
+    # Nothing is written when any record is invalid
+    assert Household.query.count() == 0
+    assert Person.query.count() == 0
+
+
+EVE = {'Name': 'Eve-456', 'Gender': 'F', 'MaritalStatus': 'Single', 'OccupationType': 'Employed', 'AnnualIncome': 30000, 'DOB': '1980-01-01'}
+
+
+@pytest.mark.parametrize('family_members, error', [
+    (None, {'Household': 0, 'FamilyMember': None, 'Error': 'Invalid Family Members'}),
+    (EVE, {'Household': 0, 'FamilyMember': None, 'Error': 'Invalid Family Members'}),
+    ([{**EVE, 'Ref': ['eve']}], {'Household': 0, 'FamilyMember': 0, 'Error': 'Invalid Ref'}),
+    ([{**EVE, 'SpouseRef': {'Ref': 'bob'}}], {'Household': 0, 'FamilyMember': 0, 'Error': 'Invalid SpouseRef'}),
+    ([{**EVE, 'AnnualIncome': 'nan'}], {'Household': 0, 'FamilyMember': 0, 'Error': 'Invalid AnnualIncome'}),
+    ([{**EVE, 'AnnualIncome': '-inf'}], {'Household': 0, 'FamilyMember': 0, 'Error': 'Invalid AnnualIncome'}),
+])
+def test_bulk_create_households_malformed_records_fail(client, family_members, error):
+    data = {'Households': [{'Housing Type': 'HDB', 'Family Members': family_members}]}
+    response = client.post(url_for('households.bulk_create_households'), json=data)
+    assert response.status_code == 400
+    assert json.loads(response.get_data())['Errors'] == [error]
+    assert Household.query.count() == 0
+
+
+def test_bulk_create_households_concurrently_allocates_unique_ids(client):
+    def households(name):
+        return {'Households': [{'Housing Type': 'HDB', 'Family Members': [
+            {'Name': name, 'Gender': 'M', 'MaritalStatus': 'Single', 'OccupationType': 'Employed', 'AnnualIncome': 30000, 'DOB': '1980-01-01'}
+        ]}]}
+
+    app = current_app._get_current_object()
+    other_responses = []
+
+    def other_import():
+        with app.test_client() as other_client:
+            other_responses.append(other_client.post('/household/bulk/new', json=households('Bob-456')))
+
+    # A second import runs while the first is between reading the largest IDs and inserting its rows. It has to wait for the first to
+    # commit, instead of allocating the same IDs
+    other_thread = threading.Thread(target=other_import)
+
+    def start_other_import(connection, cursor, statement, *args):
+        if 'max(household.id)' in statement and threading.current_thread() is threading.main_thread() and not other_thread.is_alive():
+            other_thread.start()
+            other_thread.join(1)
+
+    event.listen(db.engine, 'after_cursor_execute', start_other_import)
+    try:
+        response = client.post(url_for('households.bulk_create_households'), json=households('Alice-456'))
+        other_thread.join()
+    finally:
+        event.remove(db.engine, 'after_cursor_execute', start_other_import)
+
+    assert response.status_code == 200
+    assert other_responses[0].status_code == 200
+    household_ids = json.loads(response.get_data())['Households'] + json.loads(other_responses[0].get_data())['Households']
+    assert sorted(household_ids) == [1, 2]
+    assert sorted(person.name for person in Person.query) == ['Alice-456', 'Bob-456']
+
+
+# Tests for API 7 - Bulk Family Member Creation
+def test_bulk_add_married_couple_to_household_success(client, family1):
+    data = {
+        'Family Members': [
+            {'Ref': 'bob', 'Name': 'Bob-789', 'Gender': 'M', 'MaritalStatus': 'Married', 'SpouseRef': 'alice',
+             'OccupationType': 'Employed', 'AnnualIncome': 30000, 'DOB': '1960-01-01'},
+            {'Ref': 'alice', 'Name': 'Alice-789', 'Gender': 'F', 'MaritalStatus': 'Married', 'SpouseRef': 'bob',
+             'OccupationType': 'Unemployed', 'AnnualIncome': 0, 'DOB': '1962-01-01'},
+        ]
+    }
+    with StatementCounter(db.engine) as counter:
+        response = client.post(url_for('households.bulk_add_people_to_household', household_id=family1.id), json=data)
+    assert response.status_code == 200
+
+    bob_id, alice_id = json.loads(response.get_data())['Family Members']
+    bob, alice = Person.query.get(bob_id), Person.query.get(alice_id)
+    assert bob.household_id == alice.household_id == family1.id
+    assert (bob.spouse_id, alice.spouse_id) == (alice_id, bob_id)
+    assert HouseholdStats.query.get(family1.id).num_elders == 2
+
+    # Spouses are resolved without looking each of them up, and the couple is written with a single insert
+    assert counter.count_matching('INSERT INTO person') == 1
+    assert counter.count_matching('FROM person WHERE person.id = ?') == 0
+
+
+def test_bulk_add_people_to_household_invalid_records_fail(client, family1):
+    data = {
+        'Family Members': [
+            {'Name': 'Bob-789', 'Gender': 'M', 'MaritalStatus': 'Married', 'Spouse': 9999,
+             'OccupationType': 'Employed', 'AnnualIncome': 30000, 'DOB': '1960-01-01'},
+            {'Name': 'Alice-789', 'Gender': 'F', 'MaritalStatus': 'Married', 'SpouseRef': 'nobody',
+             'OccupationType': 'Unemployed', 'AnnualIncome': 0, 'DOB': '1962-01-01'},
+        ]
+    }
+    response = client.post(url_for('households.bulk_add_people_to_household', household_id=family1.id), json=data)
+    assert response.status_code == 400
+
+    errors = json.loads(response.get_data())['Errors']
+    assert [(error['FamilyMember'], error['Error']) for error in errors] == [(1, 'Unknown SpouseRef nobody'), (0, 'Spouse does not exist')]
+    assert Person.query.filter(Person.name.in_(['Bob-789', 'Alice-789'])).count() == 0
+
+    response = client.post('/household/9999/family/bulk/new', json=data)
+    assert response.status_code == 404
+
+
+# Tests for Pagination and Streaming
+def test_list_all_households_paginated_success(client, all_families):
+    expected_households_json = [household.to_json(excludes=['ID']) for household in Household.query.order_by(Household.id)]
+
+    received_households_json = []
+    after_id = None
+    while True:
+        params = {'limit': 3} if after_id is None else {'limit': 3, 'after_id': after_id}
+        response = client.get(url_for('households.all_households', **params))
+        assert response.status_code == 200
+
+        received_households_json += json.loads(response.get_data())
+        after_id = response.headers.get('X-Next-After-Id')
+        if after_id is None:
+            break
+
+    assert received_households_json == expected_households_json
+
+
+def test_list_all_households_invalid_pagination_fail(client):
+    response = client.get(url_for('households.all_households', limit=0))
+    assert response.status_code == 400
+
+
+def test_search_for_household_ndjson_stream_success(client, all_families, family4, family5):
+    current_app.config['STREAM_CHUNK_SIZE'] = 1
+    data = {
+        'TotalAnnualIncomeLimits': [20000, 30000]
+    }
+    response = client.post(url_for('households.search_households', format='ndjson'), data=data)
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+
+    received_households_json = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+    expected_households = [family4, family5]
+    expected_households_json = [family.to_json(excludes=['ID'], family_excludes=['ID', 'Spouse']) for family in expected_households]
+
+    assert received_households_json == expected_households_json
+
+
+def test_search_for_household_by_grant_ndjson_stream_success(client, all_families, family3, family4, family5):
+    current_app.config['STREAM_CHUNK_SIZE'] = 2
+    data = {
+        'GrantType': 'Multigeneration Scheme'
+    }
+    response = client.post(url_for('households.search_households_grants', format='ndjson'), data=data)
+    assert response.status_code == 200
+
+    received_households_json = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+    expected_households = [family3, family4, family5]
+    expected_households_json = [family.to_json(excludes=['ID'], family_excludes=['ID', 'Spouse']) for family in expected_households]
+
+    assert received_households_json == expected_households_json
+
+
+# Tests for Query Counts: the number of statements per request must not grow with the number of households returned
+def create_multigeneration_families(count):
+    for _ in range(count):
+        household = HouseholdBuilder().hdb().create_and_write()
+        PersonBuilder(household).gender_male().married().employed(20000).adult().create_and_write()
+        PersonBuilder(household).unemployed().elder().create_and_write()
+        PersonBuilder(household).student().teenager().create_and_write()
+        PersonBuilder(household).baby().create_and_write()
+
+
+@pytest.mark.parametrize('endpoint, data', [
+    ('households.all_households', None),
+    ('households.search_households', {}),
+    ('households.search_households', {'HouseholdTypes': ['HDB'], 'NumAdultsLimits': [1, 0], 'TotalAnnualIncomeLimits': [0, 100000]}),
+    ('households.search_households', {'NumBabiesLimits': [1, 0], 'NumEldersLimits': [1, 0], 'NumTeenageStudentsLimits': [1, 0]}),
+    ('households.search_households_grants', {'GrantType': 'Student Encouragement Bonus'}),
+    ('households.search_households_grants', {'GrantType': 'Multigeneration Scheme'}),
+    ('households.search_households_grants', {'GrantType': 'Elder Bonus'}),
+    ('households.search_households_grants', {'GrantType': 'Baby Sunshine Grant'}),
+    ('households.search_households_grants', {'GrantType': 'YOLO GST Grant'}),
+])
+def test_statement_count_independent_of_number_of_households(client, endpoint, data):
+    # The once a day rollover of household stats and the resume of interrupted jobs by the first request are not part of the per request cost
+    HouseholdStatsMaintainer.rollover()
+    JobRunner.resume_on_first_request()
+
+    statement_counts = []
+    for count in [2, 6]:
+        create_multigeneration_families(count)
+        with StatementCounter(db.engine) as counter:
+            if data is None:
+                response = client.get(url_for(endpoint))
+            else:
+                response = client.post(url_for(endpoint), data=data)
+        assert response.status_code == 200
+        assert len(json.loads(response.get_data())) == Household.query.count()
+        statement_counts.append(counter.count)
+
+    assert statement_counts[0] == statement_counts[1]
+
+
+def test_search_for_household_by_family_member_name_paginated_success(client, all_families, family1, family2):
+    # Both members of family1 match, which must not cause the household to take up two rows of a page
+    data = {
+        'FamilyMemberNames': ['-123']
+    }
+    response = client.post(url_for('households.search_households', limit=2), data=data)
+    assert response.status_code == 200
+
+    received_households_json = json.loads(response.get_data())
+
+    expected_households = [family1, family2]
+    expected_households_json = [family.to_json(excludes=['ID'], family_excludes=['ID', 'Spouse']) for family in expected_households]
+
+    assert received_households_json == expected_households_json
+
+
+# Tests for the single pass search query: results must match the legacy query engine
+@pytest.mark.parametrize('params', [
+    {},
+    {'set_household_types': ['HDB', 'Condominium']},
+    {'set_family_member_names': ['-123', 'Family']},
+    {'set_family_member_names': ['alice-123']},
+    {'set_family_member_names': ['y1', 'Cody']},
+    {'set_limits_num_family_members': [4, 5]},
+    {'set_limits_num_adults': [0, 2]},
+    {'set_limits_num_elders': [0, 1]},
+    {'set_limits_num_teenage_students': [1, 0]},
+    {'set_limits_num_children': [0, 3]},
+    {'set_limits_num_babies': [0, 0]},
+    {'set_total_annual_income_limits': [25000, 200000]},
+    {'set_household_types': ['Landed'], 'set_limits_num_adults': [2, 0], 'set_total_annual_income_limits': [0, 190000]},
+    {'set_limits_num_adults': [1, 0], 'set_limits_num_elders': [1, 0], 'set_limits_num_children': [1, 0],
+     'set_limits_num_family_members': [1, 6], 'set_limits_num_teenage_students': [0, 3], 'set_total_annual_income_limits': [0, 150000]},
+])
+def test_search_query_matches_legacy_query(client, all_families, params):
+    query_builder = QueryBuilder()
+    for setter, value in params.items():
+        getattr(query_builder, setter)(value)
+
+    household_ids = [household.id for household in query_builder.generate_query().order_by(Household.id)]
+    aggregate_household_ids = [household.id for household in query_builder.generate_aggregate_query().order_by(Household.id)]
+    legacy_household_ids = [household.id for household in query_builder.generate_legacy_query().order_by(Household.id)]
+
+    assert household_ids == aggregate_household_ids == legacy_household_ids
+
+
+# Tests for Household Stats
+def test_household_stats_updated_on_add_person_success(client, family1):
+    person = PersonBuilder(family1).name('Eve-123').unemployed().elder().create()
+    response = client.post(url_for('households.add_person_to_household', household_id=family1.id), data=person.to_json())
+    assert response.status_code == 200
+
+    stats = HouseholdStats.query.get(family1.id)
+    assert (stats.num_family_members, stats.num_adults, stats.num_elders, stats.num_teenage_students, stats.num_children) == (5, 2, 1, 2, 2)
+    # The stored income of the household (which is in the session) is reloaded
+    assert family1.total_annual_income == 60000
+
+
+def test_household_total_annual_income_maintained_on_member_writes(client, family1, family2):
+    person = Person.query.filter_by(name='Bob-123').first()
+    person.annual_income = 50000
+    db.session.flush()
+    assert family1.total_annual_income == 80000
+
+    # Members moving household change the income of both households
+    person.household_id = family2.id
+    db.session.commit()
+    assert (family1.total_annual_income, family2.total_annual_income) == (30000, 230000)
+
+    query = QueryBuilder().set_total_annual_income_limits([200000, 300000]).generate_query()
+    assert [household.id for household in query] == [family2.id]
+    plan = db.session.execute(f'EXPLAIN QUERY PLAN {query.statement.compile(compile_kwargs={"literal_binds": True})}').all()
+    assert 'ix_household_total_annual_income' in ' '.join(row.detail for row in plan)
+
+
+def test_household_stats_rollover_only_refreshes_households_crossing_age_bands(client):
+    turned_adult_today = HouseholdBuilder().hdb().create_and_write()
+    PersonBuilder(turned_adult_today).unemployed().adult(18).create_and_write().date_of_birth = DateHelper.date_years_ago(18)
+    db.session.commit()
+    unchanged = HouseholdBuilder().hdb().create_and_write()
+    PersonBuilder(unchanged).employed().adult(30).create_and_write()
+
+    # Simulate stale stats from a rollover that last ran yesterday
+    db.session.merge(HouseholdStatsRollover(id=HouseholdStatsMaintainer.ROLLOVER_ID, rolled_over_on=date.today() - timedelta(days=1)))
+    HouseholdStats.query.update({HouseholdStats.num_adults: 99})
+    db.session.commit()
+
+    assert HouseholdStatsMaintainer.rollover() == 1
+    assert HouseholdStats.query.get(turned_adult_today.id).num_adults == 1
+    assert HouseholdStats.query.get(unchanged.id).num_adults == 99
+
+    assert HouseholdStatsMaintainer.rollover() is None
+
+
+# Tests for Grant Eligibility Store
+@pytest.mark.parametrize('grant', sorted(QueryBuilder.valid_grant_types()))
+def test_grant_eligibility_store_matches_grant_query(client, all_families, grant):
+    member_criteria = QueryBuilder.grant_member_criteria(grant)
+
+    live_households = QueryBuilder.process_grants(grant).order_by(Household.id).all()
+    live_members = QueryBuilder.load_family_members(live_households, member_criteria)
+
+    stored_households = GrantEligibilityStore.households_query(grant).order_by(Household.id).all()
+    stored_members = QueryBuilder.load_family_members(stored_households, GrantEligibilityStore.member_criteria(grant))
+
+    assert [household.id for household in stored_households] == [household.id for household in live_households]
+    assert {household_id: [person.id for person in members] for household_id, members in stored_members.items()} == \
+        {household_id: [person.id for person in members] for household_id, members in live_members.items()}
+
+
+def test_grant_eligibility_store_updated_on_add_person_success(client, all_families, family1, family6, family7):
+    baby = PersonBuilder(family1).name('Baby-123').baby().create()
+    response = client.post(url_for('households.add_person_to_household', household_id=family1.id), data=baby.to_json())
+    assert response.status_code == 200
+
+    eligible_household_ids = {row.household_id for row in GrantEligibility.query.filter_by(grant='Baby Sunshine Grant')}
+    assert eligible_household_ids == {family1.id, family6.id, family7.id}
+
+
+def test_search_for_household_by_invalid_grant_fail(client):
+    response = client.post(url_for('households.search_households_grants'), data={'GrantType': 'Lottery'})
+    assert response.status_code == 400
+
+
+# Tests for the Statement Cache
+def test_search_statement_cache_reused_for_same_shape_success(client, all_families, family2, family5):
+    def search_num_adults(limits):
+        response = client.post(url_for('households.search_households'), data={'NumAdultsLimits': limits, 'HouseholdTypes': ['Landed']})
+        assert response.status_code == 200
+        return json.loads(response.get_data())
+
+    search_num_adults([1, 2])
+    cache_stats = json.loads(client.get(url_for('households.search_statement_cache')).get_data())
+
+    # Same shape as the search above, with different limits
+    received_households_json = search_num_adults([3, 4])
+    new_cache_stats = json.loads(client.get(url_for('households.search_statement_cache')).get_data())
+
+    assert new_cache_stats['Hits'] == cache_stats['Hits'] + 1
+    assert new_cache_stats['Misses'] == cache_stats['Misses']
+
+    expected_households = [family2, family5]
+    expected_households_json = [family.to_json(excludes=['ID'], family_excludes=['ID', 'Spouse']) for family in expected_households]
+
+    assert received_households_json == expected_households_json
+
+
+# Tests for Conditional Requests
+def test_list_all_households_not_modified_success(client, family1):
+    response = client.get(url_for('households.all_households'))
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+
+    with StatementCounter(db.engine) as counter:
+        response = client.get(url_for('households.all_households'), headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.get_data() == b''
+    # Only the data version is read
+    assert counter.count == 1
+
+    response = client.post(url_for('households.create_household'), data={'Housing Type': 'HDB'})
+    assert response.status_code == 200
+
+    response = client.get(url_for('households.all_households'), headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert len(json.loads(response.get_data())) == 2
+
+
+def test_search_for_household_etag_depends_on_params_success(client, family1):
+    response = client.post(url_for('households.search_households'), data={'HouseholdTypes': ['HDB']})
+    etag = response.headers['ETag']
+
+    response = client.post(url_for('households.search_households'), data={'HouseholdTypes': ['HDB']}, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+    response = client.post(url_for('households.search_households'), data={'HouseholdTypes': ['Landed']}, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert json.loads(response.get_data()) == []
+
+
+# Tests for Storage Profiles
+def test_concurrent_storage_profile_applies_pragmas_success(tmp_path):
+    app = create_app(config={'SQLALCHEMY_DATABASE_URI': f'sqlite:///{tmp_path / "site.sqlite"}', 'STORAGE_PROFILE': 'concurrent'})
+    with app.app_context():
+        assert db.engine.pool.size() == StorageProfiles.PROFILES['concurrent']['pool_size']
+        with db.engine.connect() as connection:
+            assert connection.exec_driver_sql('PRAGMA journal_mode').scalar() == 'wal'
+            assert connection.exec_driver_sql('PRAGMA synchronous').scalar() == 1  # NORMAL
+            assert connection.exec_driver_sql('PRAGMA busy_timeout').scalar() == 5000
+        db.session.remove()
+        db.engine.dispose()
+
+
+def test_invalid_storage_profile_fail(tmp_path):
+    with pytest.raises(ValueError):
+        create_app(config={'SQLALCHEMY_DATABASE_URI': f'sqlite:///{tmp_path / "site.sqlite"}', 'STORAGE_PROFILE': 'Turbo'})
+
+
+# Tests for Schema Migrations
+def test_migrate_existing_database_adds_indexes_success(tmp_path):
+    # Schema of a database created before migrations and indexes existed
+    path = tmp_path / 'site.sqlite'
+    connection = sqlite3.connect(path)
+    connection.executescript('''
+        CREATE TABLE household (id INTEGER NOT NULL, housing_type VARCHAR NOT NULL, PRIMARY KEY (id));
+        CREATE TABLE person (
+            id INTEGER NOT NULL, name VARCHAR NOT NULL, gender VARCHAR NOT NULL, marital_status VARCHAR NOT NULL, spouse_id INTEGER,
+            occupation_type VARCHAR NOT NULL, annual_income FLOAT NOT NULL, date_of_birth DATE NOT NULL, household_id INTEGER NOT NULL,
+            PRIMARY KEY (id), FOREIGN KEY(spouse_id) REFERENCES person (id), FOREIGN KEY(household_id) REFERENCES household (id)
+        );
+        INSERT INTO household VALUES (1, 'HDB');
+        INSERT INTO person VALUES (1, 'Bob', 'M', 'Single', NULL, 'Employed', 30000, '1990-01-01', 1);
+    ''')
+    connection.close()
+
+    app = create_app(config={'SQLALCHEMY_DATABASE_URI': f'sqlite:///{path}'})
+    with app.app_context():
+        assert SchemaMigrator.current_version(db.engine) == SchemaMigrator.latest_version()
+        index_names = {index['name'] for index in db.inspect(db.engine).get_indexes('person')}
+        assert {'ix_person_date_of_birth', 'ix_person_household_id_date_of_birth'} <= index_names
+        assert 'ix_person_name' not in index_names
+
+        # Existing data is kept, and the tables added since are filled in
+        assert Household.query.get(1).family_members[0].name == 'Bob'
+        assert HouseholdStats.query.get(1).num_adults == 1
+        assert Household.query.get(1).total_annual_income == 30000
+        assert Household.query.filter(PersonNameIndex.households_matching(['%bob%'])).count() == 1
+
+        plan = db.session.execute('EXPLAIN QUERY PLAN SELECT * FROM person WHERE household_id IN (1, 2)').all()
+        assert 'ix_person_household_id_date_of_birth' in plan[0].detail
+
+        # Already up to date
+        assert SchemaMigrator.migrate(db.engine) == []
+        db.session.remove()
+        db.engine.dispose()
+
+
+def test_migrate_drops_person_name_index_success(tmp_path):
+    # A database at schema version 5, which still has the B-tree index on person names
+    path = tmp_path / 'site.sqlite'
+    create_app(config={'SQLALCHEMY_DATABASE_URI': f'sqlite:///{path}'})
+    connection = sqlite3.connect(path)
+    connection.executescript('CREATE INDEX ix_person_name ON person (name); PRAGMA user_version = 5;')
+    connection.close()
+
+    app = create_app(config={'SQLALCHEMY_DATABASE_URI': f'sqlite:///{path}'})
+    with app.app_context():
+        assert SchemaMigrator.current_version(db.engine) == SchemaMigrator.latest_version()
+        assert 'ix_person_name' not in {index['name'] for index in db.inspect(db.engine).get_indexes('person')}
+        db.session.remove()
+        db.engine.dispose()
+
+
+# Tests for the Person Name Index
+def test_person_name_index_kept_in_sync_success(client, family1):
+    def households_named(name):
+        query = Household.query.filter(PersonNameIndex.households_matching([f'%{name}%']))
+        return [household.id for household in query]
+
+    assert households_named('ice-12') == [family1.id]
+
+    person = Person.query.filter_by(name='Alice-123').first()
+    person.name = 'Alicia-123'
+    db.session.commit()
+    assert households_named('ice-12') == []
+    assert households_named('cia-12') == [family1.id]
+
+    db.session.delete(Person.query.filter_by(name='Family1').first())
+    db.session.commit()
+    assert households_named('Family1') == []
+
+
+# Tests for the Age Classifier
+@pytest.mark.parametrize('today', [date(2023, 2, 28), date(2024, 2, 29), date(2023, 3, 31), date(2023, 4, 30), date(2023, 12, 31)])
+def test_age_classifier_matches_relativedelta(today):
+    # Every date of birth within the last 60 years, including month ends and leap days
+    dates_of_birth = [today - timedelta(days=days) for days in range(0, 366 * 60)]
+    ages = AgeClassifier.ages_in_months(dates_of_birth, today)
+
+    expected_ages = []
+    for date_of_birth in dates_of_birth:
+        age = relativedelta(today, date_of_birth)
+        expected_ages.append(age.years * 12 + age.months)
+    assert ages.tolist() == expected_ages
+
+
+def test_age_classifier_criteria_match_person_criteria(client, all_families):
+    people = Person.query.all()
+    for criteria in [[Person.is_baby], [Person.is_elder], [Person.is_student, Person.is_teenager], [Person.is_teenager, Person.is_elder]]:
+        mask = AgeClassifier.criteria_mask(people, criteria)
+        assert mask.tolist() == [all(criterion(person) for criterion in criteria) for person in people]
+
+
+# Tests for Serializers
+@pytest.mark.parametrize('excludes, family_excludes', [([], []), (['ID'], []), (['ID'], ['ID', 'Spouse']), (['Family Members'], [])])
+def test_household_serializer_matches_to_json(client, all_families, excludes, family_excludes):
+    serializer = HouseholdSerializer(excludes=excludes, family_excludes=family_excludes)
+    for household in Household.query.all():
+        expected = household.to_json(excludes=excludes, family_excludes=family_excludes)
+        assert serializer.household(household, household.family_members) == expected
+
+
+def test_orjson_provider_matches_default_provider(client, all_families):
+    pytest.importorskip('orjson')
+    data = [HouseholdSerializer().household(household, household.family_members) for household in Household.query.all()]
+    data[0]['Family Members'][0]['Name'] = 'Zoë-123'
+
+    default_response = DefaultJSONProvider(current_app._get_current_object()).response(data)
+    orjson_response = OrjsonProvider(current_app._get_current_object()).response(data)
+    assert orjson_response.mimetype == default_response.mimetype
+    assert json.loads(orjson_response.get_data()) == json.loads(default_response.get_data())
+    # Keys are sorted and separators are compact, as with the default provider
+    assert orjson_response.get_data().decode() == json.dumps(data, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+
+    # Dates are encoded by the default provider (as HTTP dates), and the arguments of the json module are honoured
+    dated = {'Date': date(2020, 1, 2), 'DateTime': datetime(2020, 1, 2, 3, 4, 5), 'Households': data[:1]}
+    default_provider, orjson_provider = DefaultJSONProvider(current_app._get_current_object()), OrjsonProvider(current_app._get_current_object())
+    assert json.loads(orjson_provider.response(dated).get_data()) == json.loads(default_provider.response(dated).get_data())
+    assert json.loads(orjson_provider.dumps(dated))['Date'] == 'Thu, 02 Jan 2020 00:00:00 GMT'
+    assert orjson_provider.dumps(dated, indent=2) == default_provider.dumps(dated, indent=2)
+
+
+def test_json_backend_defaults_to_json_module(client):
+    assert type(current_app.json) is DefaultJSONProvider
+
+
+# Tests for SQL JSON Assembly: responses must match the Python serializers
+@pytest.mark.parametrize('endpoint, data, query_string', [
+    ('households.all_households', None, {}),
+    ('households.all_households', None, {'after_id': 2, 'limit': 3}),
+    ('households.search_households', {'HouseholdTypes': ['HDB', 'Landed'], 'NumAdultsLimits': [1, 0]}, {}),
+    ('households.search_households', {'FamilyMemberNames': ['-123']}, {'format': 'ndjson'}),
+    ('households.search_households_grants', {'GrantType': 'Student Encouragement Bonus'}, {}),
+    ('households.search_households_grants', {'GrantType': 'Multigeneration Scheme'}, {'format': 'ndjson'}),
+])
+def test_sql_json_assembly_matches_python_serializers(client, all_families, empty_household_saved, endpoint, data, query_string):
+    def fetch():
+        if data is None:
+            response = client.get(url_for(endpoint, **query_string))
+        else:
+            response = client.post(url_for(endpoint, **query_string), data=data)
+        assert response.status_code == 200
+        body = response.get_data().decode()
+        if query_string.get('format') == 'ndjson':
+            return [json.loads(line) for line in body.splitlines()], response.headers.get('X-Next-After-Id')
+        return json.loads(body), response.headers.get('X-Next-After-Id')
+
+    expected = fetch()
+    current_app.config['JSON_ASSEMBLY'] = 'sql'
+    assert fetch() == expected
+    assert expected[0]
+
+
+def test_sql_json_assembly_does_not_load_people(client, all_families):
+    current_app.config['JSON_ASSEMBLY'] = 'sql'
+    JobRunner.resume_on_first_request()
+    with StatementCounter(db.engine) as counter:
+        response = client.get(url_for('households.all_households'))
+    assert response.status_code == 200
+    assert len(json.loads(response.get_data())) == 8
+    # The data version (for the ETag) and the documents
+    assert counter.count == 2
+
+
+# Tests for the All Grants Endpoint
+def test_search_for_household_by_all_grants_matches_each_grant(client, all_families, empty_household_saved):
+    JobRunner.resume_on_first_request()
+    with StatementCounter(db.engine) as counter:
+        response = client.get(url_for('households.search_households_all_grants'))
+        received_json = json.loads(response.get_data())
+    assert response.status_code == 200
+    # Every grant is evaluated by the same statements: the data version, the rollover date, the households and their members
+    assert counter.count == 4
+
+    expected = {}
+    for row in GrantEligibility.query.order_by(GrantEligibility.household_id, GrantEligibility.person_id):
+        expected.setdefault(row.household_id, {}).setdefault(row.grant, []).append(Person.query.get(row.person_id).to_json(excludes=['ID', 'Spouse']))
+    expected_json = [
+        {'HouseholdType': Household.query.get(household_id).housing_type, 'Grants': grants} for household_id, grants in sorted(expected.items())
+    ]
+    assert received_json == expected_json
+    assert len(expected_json) == 7
+
+
+def test_search_for_household_by_all_grants_streamed_matches_pages(client, all_families, empty_household_saved):
+    pages, after_id = [], None
+    while True:
+        response = client.get(url_for('households.search_households_all_grants', after_id=after_id, limit=3))
+        assert response.status_code == 200
+        pages.extend(json.loads(response.get_data()))
+        after_id = response.headers.get('X-Next-After-Id')
+        if after_id is None:
+            break
+    assert len(pages) == 7
+
+    # Households are fetched a chunk at a time when there is no limit
+    current_app.config['STREAM_CHUNK_SIZE'] = 2
+    response = client.get(url_for('households.search_households_all_grants'))
+    assert response.is_streamed
+    assert json.loads(response.get_data()) == pages
+
+    response = client.get(url_for('households.search_households_all_grants', format='ndjson'))
+    assert response.mimetype == 'application/x-ndjson'
+    assert [json.loads(line) for line in response.get_data().decode().splitlines()] == pages
+
+    response = client.get(url_for('households.search_households_all_grants', after_id=999))
+    assert json.loads(response.get_data()) == []
+
+
+def test_grant_rules_household_criteria_match_grant_queries(client, all_families):
+    HouseholdStatsMaintainer.rollover()
+    aggregates = QueryBuilder.stored_aggregate_columns()
+    for grant in QueryBuilder.valid_grant_types():
+        rule = GrantRules.get(grant)
+        query = Household.query.outerjoin(HouseholdStats, HouseholdStats.household_id == Household.id).filter(rule.household_criteria(aggregates))
+        expected_household_ids = [household.id for household in QueryBuilder.process_grants(grant).order_by(Household.id)]
+        assert [household.id for household in query.order_by(Household.id)] == expected_household_ids
+
+    with pytest.raises(ValueError):
+        GrantRules.get('Free Money')
+
+
+# Tests for the Disbursement Export
+def expected_disbursement_rows(grants):
+    rows = []
+    for grant in grants:
+        eligibility = GrantEligibility.query.filter_by(grant=grant).order_by(GrantEligibility.household_id, GrantEligibility.person_id)
+        rows.extend((grant, str(row.household_id), str(row.person_id)) for row in eligibility)
+    return rows
+
+
+def test_export_disbursements_csv_success(client, all_families):
+    current_app.config['STREAM_CHUNK_SIZE'] = 2
+    response = client.get(url_for('households.export_disbursements', format='csv'))
+    assert response.status_code == 200
+    assert response.mimetype == 'text/csv'
+
+    rows = list(csv.DictReader(io.StringIO(response.get_data().decode())))
+    assert [(row['Grant'], row['HouseholdID'], row['PersonID']) for row in rows] == \
+        expected_disbursement_rows(sorted(QueryBuilder.valid_grant_types()))
+    person = Person.query.get(int(rows[0]['PersonID']))
+    assert rows[0]['Name'] == person.name
+    assert rows[0]['DOB'] == person.date_of_birth.isoformat()
+
+
+def test_export_disbursements_invalid_params_fail(client):
+    assert client.get(url_for('households.export_disbursements', format='xlsx')).status_code == 400
+    assert client.get(url_for('households.export_disbursements', GrantType='Free Money')).status_code == 400
+
+
+def test_export_disbursements_command_success(client, all_families, tmp_path):
+    output = tmp_path / 'disbursements.csv'
+    result = current_app.test_cli_runner().invoke(args=['export-disbursements', '--output', str(output), '--grant', 'Elder Bonus', '--chunk-size', '1'])
+    assert result.exit_code == 0
+    assert result.output.startswith('Exported 2 rows (Elder Bonus: 2) in ')
+
+    with open(output) as file:
+        rows = list(csv.DictReader(file))
+    assert [(row['Grant'], row['HouseholdID'], row['PersonID']) for row in rows] == expected_disbursement_rows(['Elder Bonus'])
+
+
+def test_export_disbursements_parquet_success(client, all_families):
+    pyarrow_parquet = pytest.importorskip('pyarrow.parquet')
+    response = client.get(url_for('households.export_disbursements', format='parquet', GrantType=['Multigeneration Scheme']))
+    assert response.status_code == 200
+
+    table = pyarrow_parquet.read_table(io.BytesIO(response.get_data()))
+    assert [(grant, str(household_id), str(person_id)) for grant, household_id, person_id in
+            zip(*[table.column(name).to_pylist() for name in ['Grant', 'HouseholdID', 'PersonID']])] == \
+        expected_disbursement_rows(['Multigeneration Scheme'])
+
+
+# Tests for Dataset Seeding
+def test_seed_db_command_success(client, family1):
+    result = current_app.test_cli_runner().invoke(args=['seed-db', '--people', '300', '--seed', '1', '--batch-size', '50'])
+    assert result.exit_code == 0
+    assert result.output.startswith('Seeded ')
+
+    people = Person.query.filter(Person.household_id != family1.id).all()
+    assert len(people) >= 300
+    assert HouseholdStats.query.count() == Household.query.count()
+    for person in people:
+        if person.spouse_id is not None:
+            spouse = db.session.get(Person, person.spouse_id)
+            assert spouse.spouse_id == person.id and spouse.household_id == person.household_id and person.marital_status == 'Married'
+
+    # Stored income, eligibility and the name index are the same as if the people had been added one at a time
+    for household in Household.query:
+        assert household.total_annual_income == sum(person.annual_income for person in household.family_members)
+    for grant in QueryBuilder.valid_grant_types():
+        live_households = QueryBuilder.process_grants(grant).order_by(Household.id).all()
+        assert [household.id for household in GrantEligibilityStore.households_query(grant).order_by(Household.id)] == \
+            [household.id for household in live_households]
+    name = people[0].name
+    assert [household.id for household in Household.query.filter(PersonNameIndex.households_matching([f'%{name}%'])).order_by(Household.id)] == \
+        [household.id for household in Household.query.filter(Household.family_members.any(Person.name.like(f'%{name}%'))).order_by(Household.id)]
+
+    # The name index trigger and the indexes dropped for the load are restored
+    PersonBuilder(family1).name('Seeded-123').create_and_write()
+    assert [household.id for household in Household.query.filter(PersonNameIndex.households_matching(['%Seeded-123%']))] == [family1.id]
+    assert {index['name'] for index in db.inspect(db.engine).get_indexes('person')} >= {index.name for index in Person.__table__.indexes}
+
+
+def test_dataset_seeder_is_deterministic():
+    def households(seed):
+        seeder = DatasetSeeder(seed)
+        return [seeder.household_members() for _ in range(50)]
+
+    assert households(3) == households(3)
+    assert households(3) != households(4)
+
+
+# Tests for Background Jobs
+def submit_job(client, data):
+    response = client.post(url_for('jobs.submit_job'), data=data)
+    assert response.status_code == 202
+    job_id = response.json['ID']
+    JobRunner.wait(job_id, timeout=60)
+    return job_id
+
+
+def test_disbursement_export_job_success(client, all_families, tmp_path):
+    current_app.config['JOB_RESULTS_DIR'] = str(tmp_path)
+    current_app.config['STREAM_CHUNK_SIZE'] = 2
+    job_id = submit_job(client, {'Kind': 'disbursement_export'})
+
+    status = client.get(url_for('jobs.job_status', job_id=job_id)).json
+    expected_rows = expected_disbursement_rows(sorted(QueryBuilder.valid_grant_types()))
+    assert status['Status'] == 'completed'
+    assert status['Rows'] == len(expected_rows)
+
+    response = client.get(url_for('jobs.job_result', job_id=job_id))
+    assert response.status_code == 200
+    assert response.mimetype == 'text/csv'
+    assert response.get_data() == client.get(url_for('households.export_disbursements', format='csv')).get_data()
+    response.close()
+
+
+def test_grant_search_job_matches_search_endpoint(client, all_families, tmp_path):
+    current_app.config['JOB_RESULTS_DIR'] = str(tmp_path)
+    current_app.config['STREAM_CHUNK_SIZE'] = 1
+    job_id = submit_job(client, {'Kind': 'grant_search', 'GrantType': 'Student Encouragement Bonus'})
+
+    response = client.get(url_for('jobs.job_result', job_id=job_id))
+    assert response.mimetype == 'application/x-ndjson'
+    search_response = client.post(url_for('households.search_households_grants', format='ndjson'), data={'GrantType': 'Student Encouragement Bonus'})
+    assert response.get_data() == search_response.get_data()
+    response.close()
+
+
+def test_interrupted_job_resumes_from_checkpoint_success(client, all_families, tmp_path, monkeypatch):
+    current_app.config['JOB_RESULTS_DIR'] = str(tmp_path)
+    current_app.config['STREAM_CHUNK_SIZE'] = 1
+    save = JobRunner.save
+    checkpoints = []
+
+    def interrupted_save(job_id, token, **values):
+        # Stops the run after its third chunk was written to the result file, but before that chunk was checkpointed
+        if 'checkpoint' in values:
+            if len(checkpoints) == 2:
+                raise RuntimeError('Worker stopped')
+            checkpoints.append(values['checkpoint'])
+        save(job_id, token, **values)
+
+    monkeypatch.setattr(JobRunner, 'save', interrupted_save)
+    job_id = submit_job(client, {'Kind': 'disbursement_export'})
+    assert client.get(url_for('jobs.job_status', job_id=job_id)).json['Status'] == 'failed'
+
+    # Jobs left running by a worker that stopped are reported as interrupted, and resumed when the app starts
+    table = Job.__table__
+    db.session.execute(table.update().values(status='running', updated_at=datetime.utcnow() - timedelta(hours=1)))
+    db.session.commit()
+    assert client.get(url_for('jobs.job_status', job_id=job_id)).json['Status'] == 'interrupted'
+
+    monkeypatch.setattr(JobRunner, 'save', save)
+    starts = []
+    iter_chunks = DisbursementExporter.iter_chunks
+
+    def recorded_iter_chunks(self, grant_index=0, after_id=None):
+        starts.append([grant_index, after_id])
+        return iter_chunks(self, grant_index, after_id)
+
+    monkeypatch.setattr(DisbursementExporter, 'iter_chunks', recorded_iter_chunks)
+    assert JobRunner.resume_interrupted() == [job_id]
+    JobRunner.wait(job_id, timeout=60)
+    assert starts == [checkpoints[-1]['position']]
+
+    status = client.get(url_for('jobs.job_status', job_id=job_id)).json
+    assert status['Status'] == 'completed'
+    assert status['Rows'] == len(expected_disbursement_rows(sorted(QueryBuilder.valid_grant_types())))
+    response = client.get(url_for('jobs.job_result', job_id=job_id))
+    assert response.get_data() == client.get(url_for('households.export_disbursements', format='csv')).get_data()
+    response.close()
+
+
+def test_interrupted_jobs_resumed_by_first_request_not_by_create_app(client, all_families, tmp_path):
+    job = Job(id='stale', kind='grant_search', params={'GrantType': 'Elder Bonus'}, token='old', status='running',
+              updated_at=datetime.utcnow() - timedelta(hours=1))
+    db.session.add(job)
+    db.session.commit()
+
+    # Note: flask CLI commands create the app too, so creating it must leave interrupted jobs alone
+    app = create_app(True, {'JOB_RESULTS_DIR': str(tmp_path)})
+    db.session.expire_all()
+    assert (db.session.get(Job, 'stale').token, db.session.get(Job, 'stale').status) == ('old', 'running')
+
+    db.session.remove()
+    test_client = app.test_client()
+    assert test_client.get(url_for('jobs.job_status', job_id='stale')).status_code == 200
+    with app.app_context():
+        JobRunner.wait('stale', timeout=60)
+        job = db.session.get(Job, 'stale')
+        assert job.token != 'old' and job.status == 'completed'
+        # Only the first request resumes jobs
+        assert JobRunner.resume_on_first_request() is None
+        db.session.remove()
+
+
+def test_queued_and_running_jobs_not_interrupted_while_their_process_is_alive(client, all_families, tmp_path, monkeypatch):
+    current_app.config.update(JOB_RESULTS_DIR=str(tmp_path), JOB_WORKERS=1, JOB_STALE_SECONDS=1, JOB_HEARTBEAT_SECONDS=0.1)
+    release = threading.Event()
+    iter_chunks = GrantSearchJob.iter_chunks
+
+    def blocked_iter_chunks(self, after_id):
+        # The first job holds the only thread for longer than JOB_STALE_SECONDS before its first chunk, while the second job waits for it
+        if self.grant == 'Elder Bonus':
+            release.wait(30)
+        yield from iter_chunks(self, after_id)
+
+    monkeypatch.setattr(GrantSearchJob, 'iter_chunks', blocked_iter_chunks)
+    running_id = client.post(url_for('jobs.submit_job'), data={'Kind': 'grant_search', 'GrantType': 'Elder Bonus'}).json['ID']
+    queued_id = client.post(url_for('jobs.submit_job'), data={'Kind': 'grant_search', 'GrantType': 'Baby Sunshine Grant'}).json['ID']
+    time.sleep(1.5)
+
+    try:
+        # The heartbeat of their process keeps both jobs from being taken over
+        for job_id, status in [(running_id, 'running'), (queued_id, 'queued')]:
+            assert client.get(url_for('jobs.job_status', job_id=job_id)).json['Status'] == status
+            assert client.post(url_for('jobs.resume_job', job_id=job_id)).status_code == 409
+        assert JobRunner.resume_interrupted() == []
+    finally:
+        release.set()
+    JobRunner.wait(running_id, timeout=60)
+    JobRunner.wait(queued_id, timeout=60)
+    db.session.expire_all()
+    assert [db.session.get(Job, job_id).status for job_id in [running_id, queued_id]] == ['completed', 'completed']
+
+
+def test_job_taken_over_does_not_write_to_the_result_of_the_new_run(client, all_families, tmp_path, monkeypatch):
+    current_app.config.update(JOB_RESULTS_DIR=str(tmp_path), STREAM_CHUNK_SIZE=1)
+    iter_chunks = GrantSearchJob.iter_chunks
+    takeover_tokens = []
+
+    def taken_over_iter_chunks(self, after_id):
+        for index, (position, data, num_rows) in enumerate(iter_chunks(self, after_id)):
+            if index == 1 and not takeover_tokens:
+                # Another run takes over the job (as if this run had stalled) and completes it, before this run writes its second chunk
+                job = Job.query.one()
+                takeover_tokens.append(JobRunner.new_token())
+                db.session.execute(Job.__table__.update().values(status='queued', token=takeover_tokens[0]))
+                db.session.commit()
+                JobRunner.enqueue(job.id, takeover_tokens[0]).result(60)
+                data = b'stale chunk\n'
+            yield position, data, num_rows
+
+    monkeypatch.setattr(GrantSearchJob, 'iter_chunks', taken_over_iter_chunks)
+    job_id = submit_job(client, {'Kind': 'grant_search', 'GrantType': 'Student Encouragement Bonus'})
+
+    db.session.expire_all()
+    job = db.session.get(Job, job_id)
+    assert (job.status, job.token) == ('completed', takeover_tokens[0])
+    response = client.get(url_for('jobs.job_result', job_id=job_id))
+    search_response = client.post(url_for('households.search_households_grants', format='ndjson'), data={'GrantType': 'Student Encouragement Bonus'})
+    assert response.get_data() == search_response.get_data()
+    response.close()
+    # The files of both runs are gone once the job completed
+    assert [path.name for path in tmp_path.iterdir()] == [f'{job_id}.ndjson']
+
+
+def test_jobs_invalid_requests_fail(client, tmp_path):
+    current_app.config['JOB_RESULTS_DIR'] = str(tmp_path)
+    assert client.post(url_for('jobs.submit_job'), data={'Kind': 'Free Money'}).status_code == 400
+    assert client.post(url_for('jobs.submit_job'), data={'Kind': 'grant_search'}).status_code == 400
+    assert client.post(url_for('jobs.submit_job'), data={'Kind': 'disbursement_export', 'GrantType': 'Free Money'}).status_code == 400
+    assert client.get(url_for('jobs.job_status', job_id='missing')).status_code == 404
+
+    job = Job(id='queued', kind='grant_search', params={'GrantType': 'Elder Bonus'})
+    db.session.add(job)
+    db.session.commit()
+    assert client.get(url_for('jobs.job_status', job_id='queued')).json['Status'] == 'queued'
+    assert client.get(url_for('jobs.job_result', job_id='queued')).status_code == 409
+    # Note: The job is neither failed nor stale, so it may still be picked up by the worker that queued it
+    assert client.post(url_for('jobs.resume_job', job_id='queued')).status_code == 409
+
+
+# Tests for SQL Instrumentation
+def instrumentation_logs(caplog):
+    return [json.loads(record.getMessage()) for record in caplog.records if record.name == 'grants.instrumentation']
+
+
+def test_sql_instrumentation_reports_request_metrics_success(client, all_families, caplog):
+    app = create_app(True, {'SQL_INSTRUMENTATION': True})
+    assert isinstance(app.json, InstrumentedJSONProvider)
+
+    # Note: Requests share the test's session, which is bound to the app of the client fixture and already holds the households
+    db.session.remove()
+    with caplog.at_level('INFO', logger='grants.instrumentation'):
+        response = app.test_client().post(url_for('households.search_households_grants'), data={'GrantType': 'Elder Bonus'})
+    assert response.status_code == 200
+    server_timing = dict(metric.split(';', 1) for metric in response.headers['Server-Timing'].split(', '))
+    assert set(server_timing) == {'db', 'serialize', 'app', 'total'}
+
+    [log_line] = instrumentation_logs(caplog)
+    assert log_line['endpoint'] == 'households.search_households_grants' and log_line['status'] == 200
+    assert f'desc="{log_line["statements"]} statements"' in server_timing['db']
+    assert log_line['statements'] > 0 and log_line['db_ms'] > 0
+    # Households and their qualifying members, along with the record of the last stats rollover
+    assert log_line['rows_loaded'] == 1 + len(response.json) + sum(len(household['Family Members']) for household in response.json)
+    assert log_line['rows_written'] == 0
+
+
+def test_sql_instrumentation_counts_written_rows_success(client, caplog):
+    app = create_app(True, {'SQL_INSTRUMENTATION': True})
+    households = [{'Housing Type': 'HDB', 'Family Members': [
+        {'Name': 'Dan', 'Gender': 'M', 'MaritalStatus': 'Single', 'OccupationType': 'Unemployed', 'AnnualIncome': 0, 'DOB': '1990-01-01'}
+    ]}]
+    db.session.remove()
+    with caplog.at_level('INFO', logger='grants.instrumentation'):
+        response = app.test_client().post(url_for('households.bulk_create_households'), json={'Households': households})
+    assert response.status_code == 200
+    # The household and person, and the stats, income, eligibility and data version maintained along with them
+    assert instrumentation_logs(caplog)[0]['rows_written'] >= 2
+
+
+def test_sql_instrumentation_logs_streamed_responses_on_close_success(client, all_families, caplog):
+    app = create_app(True, {'SQL_INSTRUMENTATION': True})
+    db.session.remove()
+    with caplog.at_level('INFO', logger='grants.instrumentation'):
+        response = app.test_client().get(url_for('households.all_households', format='ndjson'))
+        assert 'Server-Timing' not in response.headers
+        lines = response.get_data().decode().splitlines()
+        response.close()
+
+    [log_line] = instrumentation_logs(caplog)
+    assert log_line['rows_loaded'] == Household.query.count() + Person.query.count()
+    assert len(lines) == Household.query.count()
+
+
+def test_sql_instrumentation_forgets_statements_that_raise_success(client, family1, caplog):
+    app = create_app(True, {'SQL_INSTRUMENTATION': True})
+    with app.app_context():
+        with db.engine.connect() as connection:
+            with pytest.raises(OperationalError):
+                connection.exec_driver_sql('SELECT * FROM missing_table')
+            assert connection.info['query_start'] == {}
+            assert connection.exec_driver_sql('SELECT 1').scalar() == 1
+            assert connection.info['query_start'] == {}
+
+
+def test_sql_instrumentation_disabled_by_default(client, family1):
+    response = client.get(url_for('households.all_households'))
+    assert 'Server-Timing' not in response.headers
+
+
+# Tests for Slow Query Log
+def slow_query_entries(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def test_slow_query_log_records_search_filters_and_plan_success(client, all_families, tmp_path):
+    path = tmp_path / 'slow_queries.log'
+    app = create_app(True, {'SLOW_QUERY_SECONDS': 0, 'SLOW_QUERY_LOG': str(path)})
+    db.session.remove()
+    response = app.test_client().post(url_for('households.search_households'), data={'HouseholdTypes': ['HDB'], 'NumEldersLimits': [1, 3]})
+    assert response.status_code == 200
+
+    [entry] = [entry for entry in slow_query_entries(path) if entry['origin']]
+    assert entry['origin'] == {'filters': {'household_types': ['HDB'], 'num_elders': [1, 3]}}
+    assert entry['endpoint'] == 'households.search_households'
+    assert 'FROM household' in entry['sql'] and 'HDB' in entry['parameters']
+    assert entry['duration_ms'] >= 0
+    # Note: The plan is explained with the statement's own parameters, e.g. searching household_stats by its indexes
+    assert any('household_stats' in line for line in entry['plan'])
+
+
+def test_slow_query_log_records_grant_success(client, all_families, tmp_path):
+    path = tmp_path / 'slow_queries.log'
+    app = create_app(True, {'SLOW_QUERY_SECONDS': 0, 'SLOW_QUERY_LOG': str(path)})
+    with app.app_context():
+        QueryBuilder().run(grant='Elder Bonus')
+        db.session.remove()
+
+    origins = [entry['origin'] for entry in slow_query_entries(path)]
+    assert {'grant': 'Elder Bonus'} in origins
+    assert all(entry['plan'] for entry in slow_query_entries(path) if entry['origin'])
+
+
+def test_slow_query_log_rotates_success(client, family1, tmp_path):
+    path = tmp_path / 'slow_queries.log'
+    app = create_app(True, {'SLOW_QUERY_SECONDS': 0, 'SLOW_QUERY_LOG': str(path), 'SLOW_QUERY_LOG_MAX_BYTES': 2000, 'SLOW_QUERY_LOG_BACKUPS': 2})
+    db.session.remove()
+    for _ in range(10):
+        app.test_client().get(url_for('households.all_households'))
+    assert sorted(log.name for log in tmp_path.iterdir()) == ['slow_queries.log', 'slow_queries.log.1', 'slow_queries.log.2']
+
+
+def test_slow_query_log_skips_fast_statements_success(client, family1, tmp_path):
+    path = tmp_path / 'slow_queries.log'
+    app = create_app(True, {'SLOW_QUERY_SECONDS': 60, 'SLOW_QUERY_LOG': str(path)})
+    db.session.remove()
+    app.test_client().get(url_for('households.all_households'))
+    assert not path.exists()
+
+
+def test_slow_query_log_forgets_statements_that_raise_success(client, tmp_path):
+    app = create_app(True, {'SLOW_QUERY_SECONDS': 0, 'SLOW_QUERY_LOG': str(tmp_path / 'slow_queries.log')})
+    with app.app_context():
+        with db.engine.connect() as connection:
+            with pytest.raises(OperationalError):
+                connection.exec_driver_sql('SELECT * FROM missing_table')
+            assert connection.info['slow_query_start'] == {}
+            connection.exec_driver_sql('SELECT 1')
+            assert connection.info['slow_query_start'] == {}
+    assert [entry['sql'] for entry in slow_query_entries(tmp_path / 'slow_queries.log')][-1] == 'SELECT 1'
+
+
+def test_slow_query_log_written_per_process_success(client, family1, tmp_path, monkeypatch):
+    app = create_app(True, {'SLOW_QUERY_SECONDS': 0, 'SLOW_QUERY_LOG': str(tmp_path / 'slow_queries.{pid}.log')})
+    db.session.remove()
+    test_client = app.test_client()
+    test_client.get(url_for('households.all_households'))
+
+    # A worker forked after the app was created writes to a file of its own
+    pid = os.getpid()
+    monkeypatch.setattr(os, 'getpid', lambda: pid + 1)
+    test_client.get(url_for('households.all_households'))
+    assert slow_query_entries(tmp_path / f'slow_queries.{pid}.log')
+    assert slow_query_entries(tmp_path / f'slow_queries.{pid + 1}.log')
+
+
+# Tests for Metrics
+def metric_samples(text):
+    # Sample name with its labels => value
+    return {line.rsplit(' ', 1)[0]: float(line.rsplit(' ', 1)[1]) for line in text.splitlines() if not line.startswith('#')}
+
+
+def test_metrics_labels_grants_endpoint_by_grant_type_success(client, all_families):
+    response = client.post(url_for('households.search_households_grants'), data={'GrantType': 'Elder Bonus'})
+    client.post(url_for('households.search_households_grants'), data={'GrantType': 'Free Money'})
+
+    metrics_response = client.get(url_for('metrics.prometheus_metrics'))
+    assert metrics_response.status_code == 200
+    assert metrics_response.headers['Content-Type'] == PrometheusFormat.CONTENT_TYPE
+    samples = metric_samples(metrics_response.get_data(as_text=True))
+
+    labels = 'endpoint="households.search_households_grants",method="POST",grant_type="Elder Bonus"'
+    assert samples[f'grants_http_requests_total{{{labels},status="200"}}'] == 1
+    assert samples[f'grants_http_request_errors_total{{{labels}}}'] == 0
+    assert samples[f'grants_http_request_duration_seconds_bucket{{{labels},le="+Inf"}}'] == 1
+    assert samples[f'grants_http_request_duration_seconds_count{{{labels}}}'] == 1
+    assert samples[f'grants_http_response_size_bytes_sum{{{labels}}}'] == len(response.get_data())
+
+    invalid_labels = 'endpoint="households.search_households_grants",method="POST",grant_type="invalid"'
+    assert samples[f'grants_http_requests_total{{{invalid_labels},status="400"}}'] == 1
+    assert samples[f'grants_http_request_errors_total{{{invalid_labels}}}'] == 1
+
+
+def test_metrics_record_streamed_responses_on_close_success(client, all_families):
+    response = client.get(url_for('households.all_households', format='ndjson'))
+    body = response.get_data()
+    response.close()
+
+    samples = metric_samples(client.get(url_for('metrics.prometheus_metrics')).get_data(as_text=True))
+    labels = 'endpoint="households.all_households",method="GET",grant_type=""'
+    assert samples[f'grants_http_response_size_bytes_sum{{{labels}}}'] == len(body)
+    assert samples[f'grants_http_response_size_bytes_count{{{labels}}}'] == 1
+
+
+def test_metrics_count_streamed_text_in_bytes_success(client, family1):
+    PersonBuilder(family1).name('Zoë-123').adult().create_and_write()
+    current_app.config['JSON_ASSEMBLY'] = 'sql'
+    response = client.get(url_for('households.all_households', format='ndjson'))
+    body = response.get_data()
+    response.close()
+    assert len(body) > len(body.decode())
+
+    samples = metric_samples(client.get(url_for('metrics.prometheus_metrics')).get_data(as_text=True))
+    assert samples['grants_http_response_size_bytes_sum{endpoint="households.all_households",method="GET",grant_type=""}'] == len(body)
+
+
+def test_metrics_aggregated_across_workers_success(tmp_path):
+    # Each registry stands in for a worker process writing to the shared metrics directory
+    workers = [MetricsRegistry(str(tmp_path)) for _ in range(3)]
+    for seconds, worker in zip([0.001, 0.02, 3.0], workers):
+        worker.record(('households.all_households', 'GET', ''), 200, seconds, 100)
+        worker.flush()
+
+    series, _ = workers[0].collect()
+    assert len(list(tmp_path.glob('*.json'))) == 3
+    samples = metric_samples(PrometheusFormat.render(series, {'Hits': 0, 'Misses': 0, 'Size': 0}))
+    labels = 'endpoint="households.all_households",method="GET",grant_type=""'
+    assert samples[f'grants_http_requests_total{{{labels},status="200"}}'] == 3
+    assert samples[f'grants_http_request_duration_seconds_bucket{{{labels},le="0.005"}}'] == 1
+    assert samples[f'grants_http_request_duration_seconds_bucket{{{labels},le="0.025"}}'] == 2
+    assert samples[f'grants_http_request_duration_seconds_bucket{{{labels},le="+Inf"}}'] == 3
+    assert samples[f'grants_http_response_size_bytes_sum{{{labels}}}'] == 300
+
+
+def test_metrics_statement_cache_size_only_of_running_workers_success(tmp_path):
+    worker = MetricsRegistry(str(tmp_path))
+    worker.record(('households.all_households', 'GET', ''), 200, 0.001, 100)
+    stopped_worker = subprocess.run([sys.executable, '-c', 'import os; print(os.getpid())'], capture_output=True, text=True, check=True)
+    stopped_snapshot = {
+        'pid': int(stopped_worker.stdout), 'series': worker.snapshot()['series'], 'statement_cache': {'Hits': 5, 'Misses': 2, 'Size': 2}
+    }
+    (tmp_path / 'stopped.json').write_text(json.dumps(stopped_snapshot))
+
+    series, cache = worker.collect()
+    running_cache = worker.snapshot()['statement_cache']
+    # The requests and cache lookups of the stopped worker still count, but not the statements its cache held
+    assert series[('households.all_households', 'GET', '')]['statuses'] == {'200': 2}
+    assert cache == {'Hits': running_cache['Hits'] + 5, 'Misses': running_cache['Misses'] + 2, 'Size': running_cache['Size']}
+
+
+def test_metrics_report_statement_cache_success(client, all_families):
+    client.post(url_for('households.search_households'), data={'HouseholdTypes': ['HDB']})
+    samples = metric_samples(client.get(url_for('metrics.prometheus_metrics')).get_data(as_text=True))
+    cache = client.get(url_for('households.search_statement_cache')).json
+    assert samples['grants_statement_cache_hits_total'] + samples['grants_statement_cache_misses_total'] == cache['Hits'] + cache['Misses']
+    assert samples['grants_statement_cache_size'] == cache['Size']
+
+
+# Tests for Columnar Search Engine
+@pytest.mark.parametrize('params', [
+    {},
+    {'set_household_types': ['HDB', 'Condominium']},
+    {'set_household_types': ['Bungalow']},
+    {'set_family_member_names': ['Alice', 'Bob']},
+    {'set_limits_num_family_members': [1, 3]},
+    {'set_limits_num_elders': [0, 1]},
+    {'set_limits_num_teenage_students': [1, 0]},
+    {'set_limits_num_babies': [0, 0]},
+    {'set_total_annual_income_limits': [25000, 200000]},
+    {'set_household_types': ['Landed'], 'set_limits_num_adults': [2, 0], 'set_total_annual_income_limits': [0, 190000]},
+    {'set_limits_num_adults': [1, 0], 'set_limits_num_elders': [1, 0], 'set_limits_num_children': [1, 0],
+     'set_limits_num_family_members': [1, 6], 'set_limits_num_teenage_students': [0, 3], 'set_total_annual_income_limits': [0, 150000]},
+])
+def test_columnar_search_matches_search_query(client, all_families, empty_household_saved, params):
+    query_builder = QueryBuilder.from_params(params)
+    household_ids = [household.id for household in query_builder.generate_query().order_by(Household.id)]
+    assert ColumnarSearchEngine().search(query_builder).ids.tolist() == household_ids
+
+
+@pytest.mark.parametrize('grant', sorted(QueryBuilder.valid_grant_types()))
+def test_columnar_search_matches_grant_query(client, all_families, grant):
+    household_ids = [household.id for household in QueryBuilder.process_grants(grant).order_by(Household.id)]
+    assert ColumnarSearchEngine().search_grant(grant).ids.tolist() == household_ids
+
+
+def test_columnar_search_endpoints_match_sql_success(client, all_families):
+    requests = [
+        (url_for('households.search_households', limit=2, after_id=1), {'NumChildrenLimits': [1, 0]}),
+        (url_for('households.search_households', format='ndjson'), {'HouseholdTypes': ['HDB']}),
+        (url_for('households.search_households_grants'), {'GrantType': 'Elder Bonus'}),
+        (url_for('households.search_households_grants', format='ndjson'), {'GrantType': 'Student Encouragement Bonus'}),
+    ]
+    responses = {}
+    for search_engine in ['sql', 'columnar']:
+        test_client = create_app(True, {'SEARCH_ENGINE': search_engine}).test_client()
+        db.session.remove()
+        responses[search_engine] = []
+        for url, data in requests:
+            response = test_client.post(url, data=data)
+            assert response.status_code == 200
+            responses[search_engine].append((response.get_data(), response.headers.get('Link')))
+            response.close()
+    assert responses['columnar'] == responses['sql']
+
+
+def test_columnar_search_applies_writes_incrementally_success(client, all_families, family1, family6, family7, monkeypatch):
+    baby = PersonBuilder(family1).name('Baby-123').baby().create().to_json()
+    family1_id, family6_id, family7_id = family1.id, family6.id, family7.id
+    app = create_app(True, {'SEARCH_ENGINE': 'columnar'})
+    db.session.remove()
+    columnar_client = app.test_client()
+    search_engine = ColumnarSearchEngine.get(app)
+
+    def search_babies():
+        response = columnar_client.post(url_for('households.search_households'), data={'NumBabiesLimits': [1, 0]})
+        assert response.status_code == 200
+        with app.app_context():
+            return set(search_engine.search(QueryBuilder().set_limits_num_babies([1, 0])).ids.tolist())
+
+    assert search_babies() == {family6_id, family7_id}
+    loads = []
+    monkeypatch.setattr(search_engine, 'load', lambda version: loads.append(version))
+
+    response = columnar_client.post(url_for('households.add_person_to_household', household_id=family1_id), data=baby)
+    assert response.status_code == 200
+    response = columnar_client.post(url_for('households.bulk_create_households'), json={'Households': [
+        {'Housing Type': 'HDB', 'Family Members': [{**baby, 'Name': 'Baby-456'}]}
+    ]})
+    assert response.status_code == 200
+    household_id = Household.query.order_by(Household.id.desc()).first().id
+
+    # Only the written households were reloaded
+    assert search_babies() == {family1_id, family6_id, family7_id, household_id}
+    assert loads == []